@@ -21,18 +21,23 @@
 
 
 import base64
+import BaseHTTPServer
 import ConfigParser
 import errno
 import glob
+import httplib
 import os
-import shutil
+import socket
+import time
 import urllib2
 import uuid
 
+import catalog
 import config
 import constants
 import filesystem_utils
 import repository
+import test_framework
 import unicode_string_utils
 
 
@@ -76,6 +81,34 @@ class CannotOpenURL(Error):
     return "Cannot open the URL '%s' (HTTP error %s)" % (self.url, self.http_error_code)
 
 
+class CannotConnectToURL(Error):
+  def __init__(self, url, reason):
+    self.url = url
+    self.reason = reason
+  
+  def __str__(self):
+    return "Cannot connect to the URL '%s' (%s)" % (self.url, self.reason)
+
+
+class URLTooLarge(Error):
+  def __init__(self, url, max_num_bytes):
+    self.url = url
+    self.max_num_bytes = max_num_bytes
+  
+  def __str__(self):
+    return "The contents of the URL '%s' are larger than the limit of %s" % \
+        (self.url, get_human_readable_size(self.max_num_bytes))
+
+
+class URLTimedOut(Error):
+  def __init__(self, url, timeout):
+    self.url = url
+    self.timeout = timeout
+  
+  def __str__(self):
+    return "The URL '%s' could not be downloaded within %d seconds" % (self.url, self.timeout)
+
+
 class FileNotFoundInDirectory(Error):
   def __init__(self, fname, dirname):
     self.fname = fname
@@ -110,16 +143,16 @@ def store_new_attachment_incl_dirpath(filename, dirpath="", new_filename="", sho
   if STRIP_ALL_PUNCTUATION_AND_WHITESPACE(unicode(filename)) == "":
     raise InvalidFilename(filename)
 
-  if filename.startswith("http://"):
-    # Be ready to handle 404s, etc.
-    try:
-      # Assume it's a URL to fetch.
-      url_contents = urllib2.urlopen(filename, 'rb')
-      (attachment_id, attachment_path) = \
-          store_new_attachment(filename, short_descr, source_url, new_filename, url_contents)
-      return attachment_id
-    except urllib2.HTTPError as e:
-      raise CannotOpenURL(filename, e.code)
+  if is_url(filename):
+    # Assume it's a URL to fetch.  (Note that the webserver fetches URLs in
+    # the background instead, using 'url_fetches.start_fetch'.)
+    download_fname_abspath = get_download_fname_abspath(generate_unique_string_26())
+    download_url(filename, download_fname_abspath,
+        config.URL_FETCH_MAX_NUM_BYTES, config.URL_FETCH_TIMEOUT)
+    (attachment_id, attachment_path) = \
+        store_new_attachment(filename, short_descr, source_url, new_filename,
+            download_fname_abspath)
+    return attachment_id
   elif dirpath:
     # Ensure the dirname isn't empty, or just dots or some other punctuation.
     if STRIP_ALL_PUNCTUATION_AND_WHITESPACE(unicode(dirpath)) == "":
@@ -151,12 +184,12 @@ def store_new_attachment_incl_dirpath(filename, dirpath="", new_filename="", sho
 
 
 def store_new_attachment(attachment_fname, short_descr="", source_url="", new_fname="",
-    url_contents=None):
+    download_fname=None):
   """Store a new attachment in the doclib."""
 
-  if url_contents:
+  if download_fname:
     # The user specified a URL rather than the name of a file on disk.
-    # 'url_contents' is a file-like object that contains the contents of the URL.
+    # 'download_fname' is a file on disk that contains the contents of the URL.
     # Hence, don't test whether the 'attachment_fname' file exists on disk.
     pass
   elif not os.path.exists(attachment_fname):
@@ -180,11 +213,11 @@ def store_new_attachment(attachment_fname, short_descr="", source_url="", new_fn
   # we store each attachment in a subdirectory with a "unique" dirname.
   (dirname, dirname_abspath) = create_unique_dirname(target_fname)
 
-  if url_contents:
-    # Save the URL contents into an appropriately-named file.
-    target_fname_abspath = os.path.join(dirname_abspath, target_fname)
-    target_f = open(target_fname_abspath, 'wb')
-    shutil.copyfileobj(url_contents, target_f)
+  if download_fname:
+    # Move the downloaded URL contents into an appropriately-named file.
+    new_attachment_fname_abspath = \
+        filesystem_utils.move_and_rename(download_fname, dirname_abspath,
+            target_fname)
   else:
     # We want to move a file on disk.
     new_attachment_fname_abspath = \
@@ -206,11 +239,103 @@ def store_new_attachment(attachment_fname, short_descr="", source_url="", new_fn
   ]
 
   filesystem_utils.write_config_file(config_sections, os.path.join(dirname_abspath, ".metadata"))
+  catalog.update_attachment(dirname)
   repository.add_and_commit_new_attachment_dir(target_fname, dirname)
 
   return (dirname, dirname_abspath)
 
 
+def is_url(filename):
+  return filename.startswith("http://")
+
+
+def download_url(url, fname_abspath, max_num_bytes, timeout, progress_func=None):
+  """Download the contents of 'url' into the file 'fname_abspath', chunk by chunk.
+
+  If the contents are larger than 'max_num_bytes' bytes, or they can't be
+  downloaded within 'timeout' seconds, the download is abandoned, and the file
+  is removed.
+
+  If 'progress_func' is supplied, it will be invoked after each chunk as
+  'progress_func(num_bytes, total_num_bytes)', where 'total_num_bytes' is
+  the size reported by the server (or None, if the server didn't report it).
+  """
+  deadline = time.time() + timeout
+
+  # Be ready to handle 404s, etc.
+  try:
+    url_contents = urllib2.urlopen(url, timeout=timeout)
+  except urllib2.HTTPError as e:
+    raise CannotOpenURL(url, e.code)
+  except urllib2.URLError as e:
+    if isinstance(e.reason, socket.timeout):
+      raise URLTimedOut(url, timeout)
+    raise CannotConnectToURL(url, e.reason)
+  except socket.timeout:
+    raise URLTimedOut(url, timeout)
+  except (httplib.HTTPException, ValueError) as e:
+    # For example, 'httplib.InvalidURL' (for a non-numeric port) or
+    # 'httplib.BadStatusLine', or a 'ValueError' for an unknown URL type.
+    raise CannotConnectToURL(url, str(e) or e.__class__.__name__)
+
+  try:
+    content_length = url_contents.info().getheader("Content-Length", "")
+    if content_length.isdigit():
+      total_num_bytes = int(content_length)
+      if total_num_bytes > max_num_bytes:
+        raise URLTooLarge(url, max_num_bytes)
+    else:
+      total_num_bytes = None
+
+    f = open(fname_abspath, 'wb')
+    try:
+      num_bytes = 0
+      while True:
+        try:
+          chunk = url_contents.read(DOWNLOAD_CHUNK_SIZE)
+        except socket.timeout:
+          raise URLTimedOut(url, timeout)
+        except httplib.HTTPException as e:
+          # For example, 'httplib.IncompleteRead'.
+          raise CannotConnectToURL(url, str(e) or e.__class__.__name__)
+        if not chunk:
+          break
+        num_bytes += len(chunk)
+        if num_bytes > max_num_bytes:
+          raise URLTooLarge(url, max_num_bytes)
+        if time.time() > deadline:
+          raise URLTimedOut(url, timeout)
+
+        f.write(chunk)
+        if progress_func is not None:
+          progress_func(num_bytes, total_num_bytes)
+    finally:
+      f.close()
+  except:
+    if os.path.exists(fname_abspath):
+      os.remove(fname_abspath)
+    raise
+  finally:
+    url_contents.close()
+
+
+def get_download_fname_abspath(download_id):
+  """Return the absolute path of the file into which to download a URL.
+
+  Downloads are stored in the cache subdir of the doclib (rather than in a
+  temporary directory), so that they can be moved into the attachments subdir
+  without being copied.
+  """
+  return os.path.join(get_downloads_dir_abspath(), "%s.part" % download_id)
+
+
+def get_downloads_dir_abspath():
+  downloads_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR,
+      DOWNLOADS_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(downloads_dir_abspath)
+  return downloads_dir_abspath
+
+
 def get_attachment_attrs(dirname):
     dirname_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR, dirname)
 
@@ -231,8 +356,18 @@ def get_attachment_attrs(dirname):
 ### Anything below this point is not part of the exported API.
 
 
+# The subdirectory (of the cache subdir of the doclib) into which URLs are downloaded.
+DOWNLOADS_SUBDIR = "downloads"
+
+# The number of bytes to read from a URL at a time.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
 def get_human_readable_file_size(fname_abspath):
-  fsize = os.stat(fname_abspath).st_size
+  return get_human_readable_size(os.stat(fname_abspath).st_size)
+
+
+def get_human_readable_size(fsize):
   for suffix in ['bytes', 'kB', 'MB', 'GB', 'TB']:
     if fsize < 1024.0:
       return "%3.1f %s" % (fsize, suffix)
@@ -297,3 +432,77 @@ def generate_unique_string_22():
   """
   return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip('=')
 
+
+class StandInHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A stand-in for a remote webserver, for 'test_download_url'.
+
+  The path "/N" returns N bytes with a Content-Length header; the path
+  "/unsized/N" returns N bytes without one; any other path returns a 404.
+  """
+
+  def do_GET(self):
+    components = self.path.strip("/").split("/")
+    if not components[-1].isdigit():
+      self.send_error(404)
+      return
+
+    self.send_response(200)
+    if len(components) == 1:
+      self.send_header("Content-Length", components[-1])
+    self.end_headers()
+    self.wfile.write("x" * int(components[-1]))
+
+  def log_message(self, format, *args):
+    pass
+
+
+def test_download_url():
+  import shutil
+  import tempfile
+  import threading
+
+  server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StandInHTTPRequestHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  base_url = "http://127.0.0.1:%d" % server.server_address[1]
+  download_dir_abspath = tempfile.mkdtemp()
+  fname_abspath = os.path.join(download_dir_abspath, "download")
+  max_num_bytes = 100000
+
+  def download(path):
+    progress = []
+    download_url(base_url + path, fname_abspath, max_num_bytes, 10,
+        lambda num_bytes, total_num_bytes: progress.append(num_bytes))
+    return (os.path.getsize(fname_abspath), (progress or [None])[-1])
+
+  tests = [
+    ("/0", (0, None), None),
+    ("/1000", (1000, 1000), None),
+    ("/unsized/1000", (1000, 1000), None),
+    ("/100000", (100000, 100000), None),
+    ("/100001", None, URLTooLarge(base_url + "/100001", max_num_bytes)),
+    ("/unsized/100001", None, URLTooLarge(base_url + "/unsized/100001", max_num_bytes)),
+    ("/missing", None, CannotOpenURL(base_url + "/missing", 404)),
+  ]
+  invalid_url_tests = [
+    ("http://127.0.0.1:abc/", None,
+        CannotConnectToURL("http://127.0.0.1:abc/", "nonnumeric port: 'abc'")),
+  ]
+  try:
+    test_framework.test_and_compare_and_catch(tests, download, "Download URL")
+    test_framework.test_and_compare_and_catch(invalid_url_tests,
+        lambda url: download_url(url, fname_abspath, max_num_bytes, 10),
+        "Download invalid URL")
+  finally:
+    server.shutdown()
+    shutil.rmtree(download_dir_abspath)
+
+
+def main():
+  test_download_url()
+
+
+if __name__ == "__main__":
+  main()
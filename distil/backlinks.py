@@ -0,0 +1,215 @@
+# backlinks.py: An index of the links between wiki pages, notes and bib-entries.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import multiprocessing
+import os
+import sqlite3
+
+import config
+import constants
+import filesystem_utils
+import wiki_file_io
+import wiki_markup
+
+
+# To find which wiki pages and notes link to a cite-key (or to a wiki page, or
+# an attachment), we would otherwise have to read and scan the wiki-text of
+# every wiki page and the notes of every cite-key.
+#
+# Instead, whenever wiki-text is saved (see 'wiki_file_io.update_wiki_text'),
+# the targets of its links are extracted (see 'wiki_markup.get_link_targets'),
+# and stored in an SQLite database in the cache subdir of the doclib, with one
+# row per link.  The rows are indexed by target (for looking up the backlinks
+# of a page) and by referrer (for replacing the links of wiki-text that has
+# been saved again).
+#
+# A referrer is a pair of the referrer type ('NOTES' or 'WIKI_PAGE') and the
+# cite-key or wiki-word; a target is a pair of the link type (see
+# 'wiki_markup.CITE_LINK', etc.) and the cite-key, attachment ID or normalised
+# wiki-word.
+#
+# Like the catalog, the index is purely a cache:  it is never committed to the
+# repository, and it can be regenerated from the wiki-text at any time (see
+# 'regenerate_backlinks').
+
+
+# Increment this whenever the table definition changes; an index with any
+# other version will be discarded and re-created.
+SCHEMA_VERSION = 1
+
+BACKLINKS_FNAME = "backlinks.sqlite"
+
+# The types of referrer.
+NOTES = "notes"
+WIKI_PAGE = "wiki-page"
+
+CREATE_LINKS_TABLE = """CREATE TABLE IF NOT EXISTS links (
+    target_type TEXT,
+    target TEXT,
+    referrer_type TEXT,
+    referrer TEXT,
+    PRIMARY KEY (target_type, target, referrer_type, referrer))"""
+
+CREATE_REFERRER_INDEX = """CREATE INDEX IF NOT EXISTS links_by_referrer
+    ON links (referrer_type, referrer)"""
+
+INSERT_LINK = "INSERT OR IGNORE INTO links VALUES (?, ?, ?, ?)"
+
+
+### These are the public functions of the exported API.
+
+
+def update_links_from(referrer, wiki_text):
+  """Replace the links from 'referrer' with the links in 'wiki_text'."""
+  rows = get_link_rows(referrer, wiki_text)
+
+  conn = open_backlinks_db()
+  try:
+    delete_links_from(conn, referrer)
+    conn.executemany(INSERT_LINK, rows)
+    conn.commit()
+  finally:
+    conn.close()
+
+
+def rename_referrer(curr_referrer, new_referrer):
+  """Change the referrer of the links from 'curr_referrer' to 'new_referrer'
+  (for example, if a cite-key has been renamed).
+  """
+  conn = open_backlinks_db()
+  try:
+    delete_links_from(conn, new_referrer)
+    conn.execute("UPDATE links SET referrer_type = ?, referrer = ? WHERE referrer_type = ? AND referrer = ?",
+        (new_referrer[0], encode_if_unicode(new_referrer[1]),
+            curr_referrer[0], encode_if_unicode(curr_referrer[1])))
+    conn.commit()
+  finally:
+    conn.close()
+
+
+def get_backlinks(target):
+  """Return a sorted list of the referrers that link to 'target'."""
+  (target_type, target_text) = target
+  conn = open_backlinks_db()
+  try:
+    return sorted(conn.execute(
+        "SELECT referrer_type, referrer FROM links WHERE target_type = ? AND target = ?",
+        (target_type, encode_if_unicode(target_text))))
+  finally:
+    conn.close()
+
+
+def regenerate_backlinks():
+  """Regenerate the index from scratch, if it somehow gets out of sync (or it
+  was created before this index existed).
+
+  This function is not called by any other Distil code; it's purely
+  for administrator convenience.  (Since the index is never committed
+  to the repository, there is nothing to commit afterwards.)
+
+  The wiki-text is read and scanned in parallel, by a pool of worker processes.
+
+  Returns a pair (number of referrers, number of links).
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  wiki_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.WIKI_SUBDIR)
+  filesystem_utils.ensure_dir_exists(wiki_subdir_abspath)
+
+  referrers = [(NOTES, cite_key) for cite_key in sorted(os.listdir(bibs_subdir_abspath))] + \
+      [(WIKI_PAGE, wiki_word) for wiki_word in sorted(os.listdir(wiki_subdir_abspath))]
+
+  pool = multiprocessing.Pool()
+  try:
+    chunksize = max(1, len(referrers) / (8 * multiprocessing.cpu_count()))
+    rows_per_referrer = pool.map(read_link_rows, referrers, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+  num_links = 0
+  conn = open_backlinks_db()
+  try:
+    conn.execute("DELETE FROM links")
+    for rows in rows_per_referrer:
+      conn.executemany(INSERT_LINK, rows)
+      num_links += len(rows)
+    conn.commit()
+  finally:
+    conn.close()
+
+  return (len(referrers), num_links)
+
+
+### Anything below this point is not part of the exported API.
+
+
+def open_backlinks_db():
+  """Open (creating if necessary) the backlinks database, and return a connection."""
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  db_fname_abspath = os.path.join(cache_dir_abspath, BACKLINKS_FNAME)
+
+  # Several Distil processes may access the database simultaneously,
+  # so wait for locks rather than fail.
+  conn = sqlite3.connect(db_fname_abspath, timeout=30)
+  conn.text_factory = str
+
+  schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+  if schema_version != SCHEMA_VERSION:
+    conn.execute("DROP TABLE IF EXISTS links")
+    conn.execute(CREATE_LINKS_TABLE)
+    conn.execute(CREATE_REFERRER_INDEX)
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    conn.commit()
+
+  return conn
+
+
+def delete_links_from(conn, referrer):
+  (referrer_type, referrer_text) = referrer
+  conn.execute("DELETE FROM links WHERE referrer_type = ? AND referrer = ?",
+      (referrer_type, encode_if_unicode(referrer_text)))
+
+
+def get_link_rows(referrer, wiki_text):
+  """Return the rows of the links from 'referrer' in 'wiki_text'."""
+  if not isinstance(wiki_text, unicode):
+    wiki_text = wiki_text.decode("utf8")
+
+  (referrer_type, referrer_text) = referrer
+  return [(target_type, encode_if_unicode(target_text), referrer_type, encode_if_unicode(referrer_text))
+      for (target_type, target_text) in sorted(wiki_markup.get_link_targets(wiki_text.split('\n')))]
+
+
+def read_link_rows(referrer):
+  """Read the wiki-text of 'referrer', and return the rows of its links."""
+  (referrer_type, referrer_text) = referrer
+  if referrer_type == NOTES:
+    wiki_text = wiki_file_io.get_notes_for_cite_key(referrer_text)
+  else:
+    wiki_text = wiki_file_io.get_text_for_wiki_page(referrer_text)
+  return get_link_rows(referrer, wiki_text)
+
+
+def encode_if_unicode(s):
+  if isinstance(s, unicode):
+    return s.encode("utf8")
+  return s
@@ -27,6 +27,7 @@ import re
 
 from bibliograph_parsing_improved import bibtex
 
+import parsed_entries_cache
 import test_framework
 import unicode_string_utils
 
@@ -87,27 +88,59 @@ def replace_cite_key_in_file(new_cite_key, in_fname, out_fname=None):
   # 's' will now be a Unicode string.
   (s, contains_non_ascii, errors) = unicode_string_utils.open_file_read_unicode(in_fname)
 
-  obj = re.compile('^(@[^@{]+{)[^,]+,')
-  if not obj.match(s):
-    raise InvalidFormat(in_fname)
-  s = obj.sub(r'\1%s,' % new_cite_key, s, 1)
+  s = replace_cite_key_in_string(new_cite_key, s, in_fname)
 
   # Write 's' back out in UTF-8, in case it contains any non-ASCII code-points.
   codecs.open(out_fname, 'w', encoding="utf-8-sig").write(s)
 
 
+def replace_cite_key_in_string(new_cite_key, s, fname):
+  """Assumes that 's' contains only one BibTeX entry.
+
+  'fname' is the name of the file from which 's' was read (for error messages).
+  """
+  obj = re.compile('^(@[^@{]+{)[^,]+,')
+  if not obj.match(s):
+    raise InvalidFormat(fname)
+  return obj.sub(r'\1%s,' % new_cite_key, s, 1)
+
+
 def suggest_cite_keys_for_entries_in_file(fname):
   return suggest_cite_keys_for_entries(read_entries_from_file(fname))
 
 
 def read_entries_from_file(fname, should_complain_about_non_ascii=True):
+  # Parsing a bib-file is slow, so the parsed entries are cached (in memory,
+  # and on disk for bib-files in the doclib), keyed by the file path, size and
+  # mtime, and falling back to the hash of the file contents.
+  (contains_non_ascii, entries) = \
+      parsed_entries_cache.get_entries(fname, parse_entries_from_file)
+  if contains_non_ascii and should_complain_about_non_ascii:
+    complain_about_non_ascii(fname)
+
+  if entries is None:
+    raise InvalidFormat(fname)
+  return entries
+
+
+def parse_entries_from_file(fname):
+  """Parse the bib-file 'fname', returning a pair (contains_non_ascii, entries).
+
+  If the bib-file is not in a valid format, 'entries' will be None.  (We don't
+  raise InvalidFormat here, so that the verdict can be cached too.)
+  """
   #s = open(fname).read()
   # Handle possibly-screwed Unicode strings.
   # 's' will now be a Unicode string.
   (s, contains_non_ascii, errors) = unicode_string_utils.open_file_read_unicode(fname)
-  if contains_non_ascii and should_complain_about_non_ascii:
-    complain_about_non_ascii(fname)
+  return (contains_non_ascii, parse_entries_from_string(s, contains_non_ascii))
+
 
+def parse_entries_from_string(s, contains_non_ascii):
+  """Parse the Unicode string 's' of BibTeX, returning a list of entries.
+
+  If 's' is not in a valid format, None will be returned.
+  """
   b = bibtex.BibtexParser()
 
   # The method 'checkFormat' complains about some situations (like a space
@@ -127,10 +160,10 @@ def read_entries_from_file(fname, should_complain_about_non_ascii=True):
     # not one of the BibTeX syntax characters) and check.
     if not b.checkFormat(gloss_over_checkFormat_limitations(
         unicode_string_utils.replace_non_ascii_unicode(s))):
-      raise InvalidFormat(fname)
+      return None
   else:
     if not b.checkFormat(gloss_over_checkFormat_limitations(s)):
-      raise InvalidFormat(fname)
+      return None
 
   # The 'preprocess' method will accept either Unicode strings or regular
   # strings, and will always return a regular string (with any Unicode
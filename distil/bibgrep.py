@@ -42,10 +42,22 @@ class Error(Exception):
 
 
 def grep_in_fname(expr, fname):
+  # 'search_index' imports this module (for 'build_query' and
+  # 'extract_searchable_text'), so it's imported here to avoid an import cycle.
+  import search_index
+
   query = build_query(expr)
   searchable_entries = extract_searchable_entry_text_from_file(fname)
-  for cite_key, lines in searchable_entries:
-    foo(query, cite_key, lines)
+
+  # Rather than testing every line of every entry against every query token,
+  # build an inverted index of the entries, in which each query token can be
+  # looked up using binary search over the sorted terms.  (The entries are
+  # added by their position in the file, rather than by their cite-key, so
+  # entries with duplicate cite-keys are all printed, in file order.)
+  index = search_index.SearchIndex.build(
+      (i, lines) for i, (cite_key, lines) in enumerate(searchable_entries))
+  for i in index.search_doc_ids(query):
+    print searchable_entries[i][0]
 
 
 def foo(query, cite_key, lines):
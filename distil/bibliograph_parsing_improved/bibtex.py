@@ -7,6 +7,9 @@
 
 """BibtexParser class"""
 
+import bisect
+import hashlib
+import marshal
 import os
 import re
 import types
@@ -79,6 +82,131 @@ SKIP_MANGLED_ENTRY_REGEX =        re.compile(r"[^@]*^(?P<start_entry>@[A-Za-z]+[
 AT_SYMBOL_REGEX_ANY_POSITION =    re.compile(r"(?P<text>[^@]*)@", re.MULTILINE)
 
 
+# Added by JB, 2011-07-02.
+# The number of characters read at a time by the BibtexParser method 'iterEntries'.
+ITER_ENTRIES_CHUNK_SIZE = 64 * 1024
+
+
+# Added by JB, 2011-07-02.
+# Factored out of the BibtexParser method 'expandStringMacros', so that it may
+# also be used by the BibtexParser method 'iterEntries'.
+STRING_MACRO_SPLIT_REGEX = re.compile('[{=}]+')
+
+def _parse_string_macro(macro):
+    """Return the (abbreviation, expansion) pair of the '@String' definition 'macro'."""
+    raw_matches = STRING_MACRO_SPLIT_REGEX.split(macro)
+    matches = [m for m in raw_matches if m not in ['', ' ', '\r']]
+    # raise str(matches)
+    short = matches[1].strip()
+    long = matches[-1].strip()
+    return (short, long)
+
+
+# Added by JB, 2011-07-04.
+#
+# The original version of 'expandStringMacros' compiled a regex r'\bshort\b'
+# for each '@String' macro, and then made a full 're.sub' pass over the source
+# for each one, so its cost was O(number of macros * size of source).  Bib-files
+# exported from reference managers often define hundreds of macros (such as
+# journal abbreviations).
+#
+# Instead, all the abbreviations are compiled into a single regex (a trie, so
+# the regex engine doesn't try each abbreviation in turn at each position),
+# and the source is expanded in a single 're.sub' pass, looking up each
+# matched abbreviation in a dictionary.
+#
+# To keep exactly the same output as the sequence of 're.sub' passes:
+#  - The expansion of each macro is processed as a 're.sub' replacement
+#    template (so, for example, r'\t' becomes a tab), just as before.
+#  - In the sequence of 're.sub' passes, the expansion of a macro could in turn
+#    be expanded by any macros that are defined *after* it, so the expansion of
+#    each macro is precomputed in that way (in reverse order of definition).
+#  - An abbreviation is expanded using its first definition, since after the
+#    first 're.sub' pass, there are none of those abbreviations left to match.
+#  - The single pass can't reproduce the sequence of passes if abbreviations
+#    can overlap each other, so we fall back to the sequence of passes if any
+#    abbreviation is not a simple word (or hyphenated words), or if any part
+#    of a hyphenated abbreviation is itself an abbreviation.  (In theory, the
+#    sequence of passes could also have matched a hyphenated abbreviation
+#    spanning the end of an expansion and a hyphen after it; that is not
+#    reproduced, since that is not how BibTeX macros work anyway.)
+
+SINGLE_PASS_ABBREVIATION_REGEX = re.compile(r'^\w+(?:-\w+)*$')
+EMPTY_REGEX = re.compile('')
+
+def _compile_string_macros_as_sequence_of_passes(macros):
+    regexes_and_expansions = [(re.compile("\\b" + short + "\\b"), long)
+            for short, long in macros]
+
+    def expand_using_sequence_of_passes(source):
+        for old, long in regexes_and_expansions:
+            source = old.sub(long, source)
+        return source
+
+    return expand_using_sequence_of_passes
+
+
+def _compile_string_macros(macros):
+    """Return a function that expands the list of (abbreviation, expansion)
+    'macros' in a string, as if by a 're.sub' pass for each macro in turn.
+    """
+    if not macros:
+        return lambda source: source
+
+    definitions = {}
+    for i, (short, long) in enumerate(macros):
+        if not SINGLE_PASS_ABBREVIATION_REGEX.match(short):
+            return _compile_string_macros_as_sequence_of_passes(macros)
+        definitions.setdefault(short, []).append(i)
+
+    # Check whether any hyphenated abbreviations could overlap.
+    proper_prefixes = set()
+    proper_suffixes = set()
+    for short in definitions.keys():
+        words = short.split('-')
+        for start in range(len(words)):
+            for end in range(start + 1, len(words) + 1):
+                if (end - start) < len(words) and definitions.has_key('-'.join(words[start:end])):
+                    return _compile_string_macros_as_sequence_of_passes(macros)
+        for i in range(1, len(words)):
+            proper_prefixes.add('-'.join(words[:i]))
+            proper_suffixes.add('-'.join(words[i:]))
+    if proper_prefixes & proper_suffixes:
+        return _compile_string_macros_as_sequence_of_passes(macros)
+
+    try:
+        templates = [EMPTY_REGEX.sub(long, '') for short, long in macros]
+    except re.error:
+        # An invalid replacement template; let 're.sub' complain as before.
+        return _compile_string_macros_as_sequence_of_passes(macros)
+
+    trie = [{}, None]
+    for short in definitions.keys():
+        node = trie
+        for c in short:
+            node = node[0].setdefault(c, [{}, None])
+        node[1] = short
+    regex = re.compile(r'\b' + _trie_to_pattern(trie) + r'\b')
+
+    expansions = [None] * len(macros)
+    for i in xrange(len(macros) - 1, -1, -1):
+        def expand_later_macro(m, i=i):
+            later = definitions[m.group()]
+            j = bisect.bisect_right(later, i)
+            if j == len(later):
+                return m.group()
+            return expansions[later[j]]
+        expansions[i] = regex.sub(expand_later_macro, templates[i])
+
+    first_expansions = dict((short, expansions[indices[0]])
+            for short, indices in definitions.items())
+
+    def expand_in_single_pass(source):
+        return regex.sub(lambda m: first_expansions[m.group()], source)
+
+    return expand_in_single_pass
+
+
 # The impetus behind this optimisation is the observation that in the original
 # version of the BibtexParser method 'convertLaTeX2Unicode', 'string.replace'
 # was being called 2189 times per invocation of 'convertLaTeX2Unicode'.
@@ -164,6 +292,203 @@ def _replace_using_mapping_tree(s, mapping_tree):
     return s
 
 
+# Added by JB, 2011-07-03.
+#
+# Even with the mapping tree, 'convertLaTeX2Unicode' still makes hundreds of
+# 'string.replace' passes over the whole source (one for each LaTeX entity
+# whose common substring is found), so it remained the dominant cost of
+# 'preprocess'.  Instead, we find all the LaTeX entities in a single
+# left-to-right pass, using a single regex that is the trie of all the LaTeX
+# entities (so that at each position, the regex engine follows only the branch
+# that matches the characters at that position, rather than trying every
+# entity in turn), with a dictionary lookup for the replacement.
+#
+# To keep exactly the same output as the sequence of 'string.replace' calls:
+#  - Every LaTeX entity is ASCII, while every Unicode replacement contains only
+#    non-ASCII characters, so a replacement can never form part of a later
+#    match.  Hence, the sequence of 'string.replace' calls is equivalent to
+#    choosing, from the occurrences of LaTeX entities in the original source,
+#    the occurrences in the order that the entities are replaced (call it the
+#    "priority" of the entity), skipping any occurrence that overlaps an
+#    already-chosen occurrence.
+#  - At each position, the regex matches the longest entity; the entity that
+#    is chosen is the highest-priority entity that is a prefix of the match
+#    (ie, the highest-priority entity that occurs at that position).
+#  - This only differs from choosing in priority order if a higher-priority
+#    entity occurs *within* the chosen occurrence.  For each entity, we
+#    precompute the offsets at which a higher-priority entity could begin
+#    within it; if one actually does occur at such an offset, we fall back to
+#    the sequence of 'string.replace' calls.  (This doesn't happen in any sane
+#    BibTeX, but it guarantees the output is exactly the same.)
+#
+# Building the automaton (the regex pattern, and the table of the entity that
+# is chosen for each longest match) takes ~50 msecs, while loading it takes ~1,
+# so it's stored in a cache file beside this module (like a ".pyc" file), and
+# only rebuilt if the mappings change.  The regex itself must still be compiled
+# once per process (a compiled regex can't be serialised; that takes another
+# ~45 msecs), which happens the first time it's needed rather than at import.
+
+LATEX2UNICODE_AUTOMATON_CACHE_FNAME = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "latex2unicode-automaton.cache")
+
+# The compiled regex and the table of chosen entities, once they're needed.
+_latex2unicode_automaton = None
+
+
+def _flatten_mapping_tree(mapping_tree, flattened):
+    # Return the (latex_entity, unicode_character) pairs in 'mapping_tree' in the
+    # order in which '_replace_using_mapping_tree' replaces them.
+    for k, v in mapping_tree:
+        if type(v) == types.ListType:
+            _flatten_mapping_tree(v, flattened)
+        else:
+            flattened.append((k, v))
+    return flattened
+
+
+def _trie_to_pattern(node):
+    # Return a regex pattern that matches the longest string in the trie 'node',
+    # where each trie node is a list whose first two elements are:
+    # [dictionary of child nodes, the string ending at this node (or None)].
+    alternatives = [re.escape(c) + _trie_to_pattern(child)
+            for c, child in sorted(node[0].items())]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and node[1] is None:
+        return alternatives[0]
+    # The alternatives are optional if a string ends at this node; since '?' is
+    # greedy, the regex will match the longest string.
+    return '(?:%s)%s' % ('|'.join(alternatives), (node[1] is not None) and '?' or '')
+
+
+def _build_latex2unicode_automaton(mapping_items):
+    # 'mapping_items' is the list of (latex_entity, unicode_character) pairs,
+    # in priority order.  If an entity occurs more than once, only its first
+    # occurrence can ever be replaced.
+    priorities = {}
+    replacements = {}
+    for priority, (k, v) in enumerate(mapping_items):
+        if not priorities.has_key(k):
+            priorities[k] = priority
+            replacements[k] = v
+
+    # Each trie node is a list: [children, entity ending here (or None),
+    # highest priority (ie, the minimum) of the entities in the sub-trie].
+    no_priority = len(mapping_items)
+    trie = [{}, None, no_priority]
+    for k, priority in priorities.items():
+        node = trie
+        node[2] = min(node[2], priority)
+        for c in k:
+            node = node[0].setdefault(c, [{}, None, no_priority])
+            node[2] = min(node[2], priority)
+        node[1] = k
+
+    def get_overlap_offsets(k):
+        # Return the offsets within 'k' at which a higher-priority entity
+        # could begin:  either an entity that is a prefix of the rest of 'k',
+        # or an entity that begins with the rest of 'k'.
+        priority = priorities[k]
+        offsets = []
+        for i in range(1, len(k)):
+            node = trie
+            for c in k[i:]:
+                node = node[0].get(c)
+                if node is None or node[2] >= priority:
+                    break
+                if node[1] is not None and priorities[node[1]] < priority:
+                    offsets.append(i)
+                    break
+            else:
+                # The rest of 'k' is a prefix of a higher-priority entity.
+                offsets.append(i)
+        return tuple(offsets)
+
+    # For each entity that the regex could match (the longest entity at that
+    # position), look up the highest-priority entity that is a prefix of it.
+    chosen_entities = {}
+    for k in priorities.keys():
+        node = trie
+        chosen = None
+        for c in k:
+            node = node[0][c]
+            if node[1] is not None and (chosen is None or
+                    priorities[node[1]] < priorities[chosen]):
+                chosen = node[1]
+        chosen_entities[k] = (len(chosen), replacements[chosen], priorities[chosen],
+                get_overlap_offsets(chosen))
+
+    return (_trie_to_pattern(trie), chosen_entities)
+
+
+def _get_latex2unicode_automaton():
+    global _latex2unicode_automaton
+    if _latex2unicode_automaton is not None:
+        return _latex2unicode_automaton
+
+    # The simple mapping is applied before the full mapping.
+    mapping_items = _flatten_mapping_tree(LATEX2UTF8ENC_MAPPING_SIMPLE_TREE, [])
+    mapping_items = _flatten_mapping_tree(LATEX2UTF8ENC_MAPPING_TREE, mapping_items)
+    fingerprint = hashlib.md5(repr(mapping_items)).hexdigest()
+
+    pattern = chosen_entities = None
+    try:
+        f = open(LATEX2UNICODE_AUTOMATON_CACHE_FNAME, 'rb')
+        try:
+            (cached_fingerprint, pattern, chosen_entities) = marshal.load(f)
+        finally:
+            f.close()
+        if cached_fingerprint != fingerprint:
+            pattern = chosen_entities = None
+    except (IOError, EOFError, ValueError, TypeError):
+        # The cache file is missing or corrupt.
+        pass
+
+    if pattern is None:
+        (pattern, chosen_entities) = _build_latex2unicode_automaton(mapping_items)
+        try:
+            tmp_fname = "%s.tmp.%d" % (LATEX2UNICODE_AUTOMATON_CACHE_FNAME, os.getpid())
+            f = open(tmp_fname, 'wb')
+            try:
+                marshal.dump((fingerprint, pattern, chosen_entities), f)
+            finally:
+                f.close()
+            os.rename(tmp_fname, LATEX2UNICODE_AUTOMATON_CACHE_FNAME)
+        except (IOError, OSError):
+            # The directory isn't writable, so we'll just rebuild it next time.
+            pass
+
+    _latex2unicode_automaton = (re.compile(pattern), chosen_entities)
+    return _latex2unicode_automaton
+
+
+def _replace_using_automaton(s):
+    # Return 's' with all the LaTeX entities replaced, or None if there is an
+    # overlap that requires falling back to '_replace_using_mapping_tree'.
+    regex, chosen_entities = _get_latex2unicode_automaton()
+    search = regex.search
+    match = regex.match
+
+    result = []
+    pos = 0
+    m = search(s)
+    while m:
+        start = m.start()
+        length, replacement, priority, overlap_offsets = chosen_entities[m.group()]
+        for i in overlap_offsets:
+            m_overlap = match(s, start + i)
+            if m_overlap and chosen_entities[m_overlap.group()][2] < priority:
+                return None
+
+        result.append(s[pos:start])
+        result.append(replacement)
+        pos = start + length
+        m = search(s, pos)
+
+    result.append(s[pos:])
+    return u''.join(result)
+
+
 class BibtexParser(BibliographyParser):
     """
     A specific parser to process input in BiBTeX-format.
@@ -247,17 +572,10 @@ class BibtexParser(BibliographyParser):
             else:
                 sourcelns.append(line)
         source = '\n'.join(sourcelns)
-        for macro in macros:
-            split_on = re.compile('[{=}]+')
-            raw_matches = split_on.split(macro)
-            matches = [m for m in raw_matches if m not in ['', ' ', '\r']]
-            # raise str(matches)
-            short = matches[1].strip()
-            long = matches[-1].strip()
-            pattern = "\\b" + short + "\\b"
-            old = re.compile(pattern)
-            source = old.sub(long, source)
-        return source
+        # Changed by JB, 2011-07-04:  Expand all the macros in a single pass.
+        # (For more info, read the comment immediately above '_compile_string_macros'.)
+        expand = _compile_string_macros([_parse_string_macro(macro) for macro in macros])
+        return expand(source)
 
     def stripCommands(self, source):
         oldstyle_cmd = re.compile(r'{\\[a-zA-Z]{2,}')
@@ -470,15 +788,27 @@ class BibtexParser(BibliographyParser):
         # 1.198 CPU secs per call (on the ~1M benchmark BibTeX file) down to 0.259.
         # The total speedup of this function was now >35x: 9.615 down to 0.259.
 
-        source = _decode(source)
-        #for latex_entity, unicode_code_point in _latex2utf8enc_mapping_simple.items():
-            #source = source.replace(latex_entity, unicode_code_point)
-        source = _replace_using_mapping_tree(source, LATEX2UTF8ENC_MAPPING_SIMPLE_TREE)
+        #
+        # Next, the mapping trees were replaced by a single regex (for both
+        # mappings) that converts all the LaTeX entities in a single pass.
+        # (For more info, read the comment immediately above
+        # '_build_latex2unicode_automaton'.)
+        #
+        # This yielded a further 7x speedup for this function (0.126 CPU secs
+        # down to 0.017, on a 700K-character test file), with the same output.
 
-        #for latex_entity, unicode_code_point in _latex2utf8enc_mapping.items():
-            #source = source.replace(latex_entity, unicode_code_point)
-        source = _replace_using_mapping_tree(source, LATEX2UTF8ENC_MAPPING_TREE)
-        source = _encode(source)
+        source = _decode(source)
+        converted = _replace_using_automaton(source)
+        if converted is None:
+            # Entities overlap in a way that the single pass can't reproduce.
+            #for latex_entity, unicode_code_point in _latex2utf8enc_mapping_simple.items():
+                #source = source.replace(latex_entity, unicode_code_point)
+            source = _replace_using_mapping_tree(source, LATEX2UTF8ENC_MAPPING_SIMPLE_TREE)
+
+            #for latex_entity, unicode_code_point in _latex2utf8enc_mapping.items():
+                #source = source.replace(latex_entity, unicode_code_point)
+            converted = _replace_using_mapping_tree(source, LATEX2UTF8ENC_MAPPING_TREE)
+        source = _encode(converted)
 
         return source
 
@@ -697,3 +1027,248 @@ class BibtexParser(BibliographyParser):
             lst[j][k] = p[i]
 
         return map(tuple, lst)
+
+    # streaming parsing (added by JB, 2011-07-02)
+
+    def iterEntries(self, fileobj, chunk_size=ITER_ENTRIES_CHUNK_SIZE):
+        """
+        reads BibTeX from 'fileobj' in chunks of 'chunk_size' characters,
+        and yields each parsed entry (the same as 'getEntries' would return
+        for that entry) as soon as it is complete
+        """
+        # 'preprocess' and 'getEntries' process the whole file as a single
+        # string, several times over (and 'getEntries' splits it again into
+        # a list), so the peak memory usage is several copies of the file,
+        # and no entry is available until the whole file has been processed.
+        #
+        # Instead, we read the file in chunks of complete lines, expand the
+        # '@String' macros in each chunk (using the definitions that have been
+        # read so far), and feed the chunks to the same regex event machinery
+        # as 'stripComments' (see '_iterEntryTexts' below), which tracks the
+        # brace nesting level across chunk boundaries and returns the text of
+        # each entry as soon as it is complete.  The rest of the preprocessing
+        # is applied to each entry individually, before it's parsed.  Hence,
+        # memory usage is bounded by the chunk size and the largest entry.
+        #
+        # Differences from 'getEntries':
+        #  - an '@String' macro is only expanded in the entries *after* its
+        #    definition (which is where BibTeX requires it to be anyway);
+        #  - the external Bibutils clean-up (FIX_BIBTEX) is not applied, since
+        #    it must process the whole file at once;
+        #  - a file containing no entries yields nothing (rather than a single
+        #    "Bibtex Parser Error").
+        #
+        # In 'getEntries', the entries are split using the delimiter r'}\s*@',
+        # which consumes the closing brace of each entry (except the last) and
+        # the '@' of the next entry.  To yield exactly the same pieces, we hold
+        # back each entry until we know whether another entry follows it.
+        delimiter = self.delimiter
+        is_first_entry = True
+        prev_entry_text = None
+
+        chunks = self._iterMacroExpandedChunks(fileobj, chunk_size)
+        for entry_text in self._iterEntryTexts(chunks):
+            entry_text = self.checkEncoding(self.stripCommands(self.convertChars(entry_text)))
+            if prev_entry_text is not None:
+                # The closing brace of the previous entry is consumed by the delimiter.
+                for piece in delimiter.split(prev_entry_text + '@')[:-1]:
+                    yield self.parseEntry(piece)
+
+            if is_first_entry:
+                is_first_entry = False
+            else:
+                # The '@' of this entry is consumed by the delimiter.
+                entry_text = entry_text[1:]
+            prev_entry_text = entry_text
+
+        if prev_entry_text is not None:
+            for piece in delimiter.split(prev_entry_text):
+                yield self.parseEntry(piece)
+
+    def iterEntryTexts(self, fileobj, chunk_size=ITER_ENTRIES_CHUNK_SIZE):
+        """
+        reads BibTeX from 'fileobj' in chunks of 'chunk_size' characters,
+        and yields the text of each entry (with the '@String' macros expanded
+        and the comments stripped, but otherwise unprocessed) as soon as it
+        is complete
+        """
+        # Added by JB, 2011-07-08.  Each entry text is a complete BibTeX source
+        # of a single entry, so (unlike the entries yielded by 'iterEntries')
+        # it may be written out to a bib-file of its own.  Hence, each macro
+        # expansion is enclosed in braces, so that it's a valid field value.
+        chunks = self._iterMacroExpandedChunks(fileobj, chunk_size,
+                brace_expansions=True)
+        return self._iterEntryTexts(chunks)
+
+    def _iterMacroExpandedChunks(self, fileobj, chunk_size, brace_expansions=False):
+        """
+        yields the contents of 'fileobj' in chunks that end at line boundaries,
+        with the '@String' macro definitions removed and expanded
+        """
+        macros = []
+        if brace_expansions:
+            compile = lambda macros: _compile_string_macros(
+                    [(short, '{%s}' % long) for (short, long) in macros])
+        else:
+            compile = _compile_string_macros
+        expand = compile(macros)
+        partial_line = ''
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+
+            # Hold back any partial line at the end of the chunk until the rest
+            # of the line has been read.
+            end_of_last_line = chunk.rfind('\n') + 1
+            if end_of_last_line == 0:
+                partial_line += chunk
+                continue
+            lines = partial_line + chunk[:end_of_last_line]
+            partial_line = chunk[end_of_last_line:]
+
+            if lines.find('@String') > -1:
+                lines = self._removeStringMacros(lines, macros)
+                expand = compile(macros)
+            yield expand(lines)
+
+        if partial_line:
+            if partial_line.find('@String') > -1:
+                partial_line = self._removeStringMacros(partial_line, macros)
+                expand = compile(macros)
+            yield expand(partial_line)
+
+    def _removeStringMacros(self, lines, macros):
+        # As in 'expandStringMacros', a line that contains '@String' is removed,
+        # and its macro definition is appended to 'macros'.
+        sourcelns = []
+        for line in lines.splitlines(True):
+            if line.find('@String') > -1:
+                macros.append(_parse_string_macro(line.rstrip('\n')))
+            else:
+                sourcelns.append(line)
+        return ''.join(sourcelns)
+
+    def _iterEntryTexts(self, chunks):
+        """
+        yields the text of each entry in the sequence of 'chunks' (which must
+        end at line boundaries), exactly as it would appear in the output of
+        'stripComments'
+        """
+        # This is the same algorithm as 'stripComments' (read the comment in
+        # that method first), but the loops have been unrolled into a state
+        # machine, so that it can stop and wait for more input whenever it
+        # runs out.  A regex that *matches* can't be affected by more input
+        # (since every chunk ends at a line boundary, and none of the regexes
+        # matches across a line boundary without consuming the newline), but
+        # a regex that *fails* might only have failed because the input ended.
+        #
+        # The consumed text is discarded whenever more input is read, except
+        # for the single character that precedes the current position (so that
+        # '^' and the look-behind assertions see the same context as before).
+
+        # Bring global variables into local scope, since they will be accessed repeatedly.
+        start_of_entry_regex = START_OF_ENTRY_REGEX
+        brace_and_backslash_regex = BRACE_AND_BACKSLASH_REGEX
+        at_symbol_regex_not_start_of_line = AT_SYMBOL_REGEX_NOT_START_OF_LINE
+        skip_mangled_entry_regex = SKIP_MANGLED_ENTRY_REGEX
+        at_symbol_regex_any_position = AT_SYMBOL_REGEX_ANY_POSITION
+
+        chunks = iter(chunks)
+        source = ''
+        pos = 0
+        at_eof = False
+
+        inside_entry = False
+        brace_nesting_level = 0
+        current_entry = []
+
+        while True:
+            need_more_input = False
+
+            if not inside_entry:
+                m = start_of_entry_regex.match(source, pos)
+                if m:
+                    inside_entry = True
+                    brace_nesting_level = 1
+                    current_entry = [m.group("start_entry")]
+                    pos = m.end("start_entry")
+                elif at_eof:
+                    # No (more) entry-starts found.
+                    return
+                else:
+                    # No entry-starts in the rest of the input so far, so skip it.
+                    pos = len(source)
+                    need_more_input = True
+
+            else:
+                m = brace_and_backslash_regex.match(source, pos)
+                if m:
+                    current_entry.append(m.group("text"))
+
+                    event = m.group("event")
+                    current_entry.append(event)
+                    pos = m.end("event")
+
+                    if event == "{":
+                        brace_nesting_level += 1
+                    elif event == "}":
+                        brace_nesting_level -= 1
+                        if brace_nesting_level == 0:
+                            # An entry was completed.
+                            inside_entry = False
+                            current_entry.append('\n')
+                            yield ''.join(current_entry)
+                            current_entry = []
+
+                elif not at_eof and source.find('@', pos) == -1:
+                    # There might be more braces (or @ symbols) in the input to come.
+                    need_more_input = True
+
+                else:
+                    # No braces or double backslashes found before the next @ symbol.
+                    # Try the at-symbol regexes.
+                    m = at_symbol_regex_not_start_of_line.match(source, pos)
+                    if m:
+                        current_entry.append(m.group("text") + '@')
+                        pos = m.end("text") + 1
+                        continue
+
+                    m = skip_mangled_entry_regex.match(source, pos)
+                    if m:
+                        # Skip the rest of this mangled entry; 'start_of_entry_regex'
+                        # will then match the start of the next entry.
+                        inside_entry = False
+                        current_entry = []
+                        continue
+
+                    m = at_symbol_regex_any_position.match(source, pos)
+                    if m:
+                        current_entry.append(m.group("text") + '@')
+                        pos = m.end("text") + 1
+                        continue
+
+                    # Otherwise, we weren't able to match anything (and we're at
+                    # the end of the input), so discard this unfinished entry.
+                    inside_entry = False
+                    current_entry = []
+
+            if need_more_input:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    at_eof = True
+                else:
+                    if pos > 0:
+                        source = source[pos - 1:]
+                        pos = 1
+                    source += chunk
+
+
+def iter_entries(fileobj, chunk_size=ITER_ENTRIES_CHUNK_SIZE):
+    """Yield each parsed entry in the BibTeX file-object 'fileobj', one at a time."""
+    return BibtexParser().iterEntries(fileobj, chunk_size)
+
+
+def iter_entry_texts(fileobj, chunk_size=ITER_ENTRIES_CHUNK_SIZE):
+    """Yield the text of each entry in the BibTeX file-object 'fileobj', one at a time."""
+    return BibtexParser().iterEntryTexts(fileobj, chunk_size)
@@ -0,0 +1,532 @@
+# catalog.py: A persistent catalog of the metadata of stored bib entries.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import errno
+import multiprocessing
+import operator
+import os
+import sqlite3
+
+import attachments
+import config
+import constants
+import filesystem_utils
+import stored_bibs
+import topic_tag_file_io
+
+
+# Listing the cite-keys (for example, on the "/cite-keys" page) requires the
+# title, authors, year, doc attributes, date-added and topic tags of every
+# cite-key.  Obtaining these from the files in each cite-key dir involves
+# re-reading and re-parsing every bib-file (through the whole BibtexParser
+# preprocessing pipeline), listing every cite-key dir and reading several
+# small files per cite-key; with thousands of cite-keys, this takes tens of
+# seconds.
+#
+# Instead, we store these attributes in an SQLite database in the cache subdir
+# of the doclib, with one row per cite-key.  Each row also records the mtimes
+# of the files from which it was derived:
+#  - the cite-key dir (which changes when a doc is added or renamed, or when
+#    a topic-tags file is created);
+#  - the bib-file (which changes if the bib-entry is edited);
+#  - the topic-tags file (which changes when the tags are updated).
+# A row is re-derived from the files only when one of these mtimes no longer
+# matches, so a listing costs one indexed read plus a few 'stat' calls per
+# cite-key, rather than a full parse per cite-key.
+#
+# The catalog is purely a cache:  it is never committed to the repository,
+# and it can be deleted at any time (it will be re-created on demand).
+#
+# Every Distil operation that modifies a cite-key dir (or an attachment dir)
+# also updates the affected catalog row directly, before the change is
+# committed to the repository, so the mtime checks above should only ever
+# detect changes that were made outside of Distil.  Each such update touches
+# only the rows of the cite-keys involved, so it costs the same no matter how
+# large the doclib becomes.
+#
+# The attachments are catalogued in the same way (in a separate table), since
+# listing the attachments otherwise requires a ConfigParser parse of the
+# ".metadata" file of every attachment.
+
+
+# Increment this whenever the table definition changes; a catalog with any
+# other version will be discarded and re-created.
+SCHEMA_VERSION = 2
+
+CATALOG_FNAME = "catalog.sqlite"
+
+# The columns of the 'cite_keys' table, in order.
+CITE_KEY_COLUMNS = [
+  "cite_key",
+  "title",
+  "author_lastnames",
+  "year_published",
+  "doc_name",
+  "doc_suffix",
+  "doc_type",
+  "date_added",
+  "topic_tags",
+  "dir_mtime",
+  "bib_mtime",
+  "tags_mtime",
+]
+
+CREATE_CITE_KEYS_TABLE = """CREATE TABLE IF NOT EXISTS cite_keys (
+    cite_key TEXT PRIMARY KEY,
+    title TEXT,
+    author_lastnames TEXT,
+    year_published TEXT,
+    doc_name TEXT,
+    doc_suffix TEXT,
+    doc_type TEXT,
+    date_added TEXT,
+    topic_tags TEXT,
+    dir_mtime REAL,
+    bib_mtime REAL,
+    tags_mtime REAL)"""
+
+SELECT_ALL_ROWS = "SELECT %s FROM cite_keys" % ", ".join(CITE_KEY_COLUMNS)
+INSERT_OR_REPLACE_ROW = "INSERT OR REPLACE INTO cite_keys VALUES (%s)" % \
+    ", ".join(["?"] * len(CITE_KEY_COLUMNS))
+
+# The columns of the 'attachments' table, in order.
+ATTACHMENT_COLUMNS = [
+  "attachment_id",
+  "fname",
+  "fsize",
+  "descr",
+  "source_url",
+  "suffix",
+  "ftype",
+  "dir_mtime",
+  "metadata_mtime",
+]
+
+CREATE_ATTACHMENTS_TABLE = """CREATE TABLE IF NOT EXISTS attachments (
+    attachment_id TEXT PRIMARY KEY,
+    fname TEXT,
+    fsize TEXT,
+    descr TEXT,
+    source_url TEXT,
+    suffix TEXT,
+    ftype TEXT,
+    dir_mtime REAL,
+    metadata_mtime REAL)"""
+
+SELECT_ALL_ATTACHMENT_ROWS = "SELECT %s FROM attachments" % ", ".join(ATTACHMENT_COLUMNS)
+INSERT_OR_REPLACE_ATTACHMENT_ROW = "INSERT OR REPLACE INTO attachments VALUES (%s)" % \
+    ", ".join(["?"] * len(ATTACHMENT_COLUMNS))
+
+# SQLite limits the number of host parameters in a single statement (the
+# default limit is 999), so "IN (?, ?, ...)" queries are issued in chunks.
+MAX_PARAMS_PER_QUERY = 500
+
+# Lists of strings (author lastnames, topic tags) are stored joined by newlines,
+# since neither can contain a newline.
+LIST_SEPARATOR = "\n"
+
+
+### These are the public functions of the exported API.
+
+
+def get_cite_keys_and_attrs(cite_keys=None):
+  """Return a list of (cite_key, attrs) pairs for the specified 'cite_keys'.
+
+  If 'cite_keys' is None, all the cite-keys in the bibs subdir will be returned
+  (and any catalog rows for cite-keys that no longer exist will be removed).
+
+  The 'attrs' dictionary contains the same keys as the dictionary returned by
+  'stored_bibs.get_doc_attrs', plus the key "topic-tags" (a sorted list of the
+  topic tags of the cite-key).  A fresh dictionary is returned for each call,
+  so the caller may modify it freely.
+
+  If any cite-key dir does not exist, 'filesystem_utils.DirectoryNotFound'
+  will be raised.
+  """
+  return convert_rows_to_cite_keys_and_attrs(get_cite_key_rows(cite_keys))
+
+
+def get_cite_key_rows(cite_keys=None):
+  """Return a list of the catalog rows for the specified 'cite_keys', exactly
+  as 'get_cite_keys_and_attrs' would (but without converting the rows).
+
+  Each row is a tuple of the columns in 'CITE_KEY_COLUMNS', so a list of rows
+  can be sorted and filtered by its columns (see 'get_column_getter' and
+  'get_topic_tags_of_row') before converting just the rows that are needed
+  by 'convert_rows_to_cite_keys_and_attrs'.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+
+  prune_missing_rows = (cite_keys is None)
+  if cite_keys is None:
+    cite_keys = os.listdir(bibs_subdir_abspath)
+
+  conn = open_catalog()
+  try:
+    if prune_missing_rows:
+      rows = read_all_rows(conn)
+    else:
+      rows = read_rows(conn, cite_keys)
+
+    current_rows = []
+    stale_rows = []
+    for cite_key in cite_keys:
+      mtimes = get_mtimes(bibs_subdir_abspath, cite_key)
+      row = rows.get(cite_key)
+      if row is None or tuple(row[-3:]) != mtimes:
+        # This row is missing or out-of-date, so re-derive it from the files.
+        row = derive_row(cite_key, mtimes)
+        stale_rows.append(row)
+      current_rows.append(tuple(row))
+
+    if stale_rows:
+      conn.executemany(INSERT_OR_REPLACE_ROW, stale_rows)
+    if prune_missing_rows:
+      missing_cite_keys = set(rows.keys()) - set(cite_keys)
+      conn.executemany("DELETE FROM cite_keys WHERE cite_key = ?",
+          [(ck,) for ck in missing_cite_keys])
+    conn.commit()
+  finally:
+    conn.close()
+
+  return current_rows
+
+
+def convert_rows_to_cite_keys_and_attrs(rows):
+  """Return a list of (cite_key, attrs) pairs for the catalog rows 'rows'
+  (as described in 'get_cite_keys_and_attrs').
+  """
+  return [(row[0], convert_row_to_attrs(row)) for row in rows]
+
+
+def get_column_getter(column):
+  """Return a function that returns the value of the column 'column' of a row."""
+  return operator.itemgetter(CITE_KEY_COLUMNS.index(column))
+
+
+def get_topic_tags_of_row(row):
+  """Return the list of the topic tags in the catalog row 'row'."""
+  return split_list(row[CITE_KEY_COLUMNS.index("topic_tags")])
+
+
+def get_attachments_attrs():
+  """Return a list of the attributes of all the attachments in the attachments subdir.
+
+  Each element of the list is the same tuple as would be returned by
+  'attachments.get_attachment_attrs' for that attachment.
+  """
+  attachments_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(attachments_subdir_abspath)
+  attachment_ids = os.listdir(attachments_subdir_abspath)
+
+  conn = open_catalog()
+  try:
+    rows = dict((row[0], row) for row in conn.execute(SELECT_ALL_ATTACHMENT_ROWS))
+
+    attachments_attrs = []
+    stale_rows = []
+    for attachment_id in attachment_ids:
+      mtimes = get_attachment_mtimes(attachments_subdir_abspath, attachment_id)
+      row = rows.get(attachment_id)
+      if row is None or tuple(row[-2:]) != mtimes:
+        row = derive_attachment_row(attachment_id, mtimes)
+        stale_rows.append(row)
+      attachments_attrs.append(convert_attachment_row_to_attrs(row))
+
+    if stale_rows:
+      conn.executemany(INSERT_OR_REPLACE_ATTACHMENT_ROW, stale_rows)
+    missing_attachment_ids = set(rows.keys()) - set(attachment_ids)
+    conn.executemany("DELETE FROM attachments WHERE attachment_id = ?",
+        [(a,) for a in missing_attachment_ids])
+    conn.commit()
+  finally:
+    conn.close()
+
+  return attachments_attrs
+
+
+def update_cite_key(cite_key):
+  """Re-derive the catalog row for 'cite_key' from the files in its cite-key dir.
+
+  This should be invoked whenever a cite-key dir is created, or the bib-file
+  or doc within it is changed.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  row = derive_row(cite_key, get_mtimes(bibs_subdir_abspath, cite_key))
+  execute_and_commit(INSERT_OR_REPLACE_ROW, row)
+
+
+def insert_rows(rows):
+  """Insert (or replace) catalog rows that have already been derived by
+  'derive_row_for_cite_key' (for example, by worker processes in a bulk import).
+  """
+  conn = open_catalog()
+  try:
+    conn.executemany(INSERT_OR_REPLACE_ROW, rows)
+    conn.commit()
+  finally:
+    conn.close()
+
+
+def remove_cite_key(cite_key):
+  """Remove the catalog row for 'cite_key' (for example, if it has been renamed)."""
+  execute_and_commit("DELETE FROM cite_keys WHERE cite_key = ?", (cite_key,))
+
+
+def update_cite_key_mtimes(cite_key, topic_tags=None):
+  """Record that files (other than the bib-file) in the cite-key dir of 'cite_key'
+  have been written, so the catalog row does not appear to be out-of-date.
+
+  If 'topic_tags' is not None, the topic tags of the cite-key will be updated
+  to 'topic_tags' at the same time.
+
+  If the bib-file has *also* changed since the row was derived, or there is no
+  row for 'cite_key' yet, the whole row will be re-derived instead.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  (dir_mtime, bib_mtime, tags_mtime) = get_mtimes(bibs_subdir_abspath, cite_key)
+
+  conn = open_catalog()
+  try:
+    row = read_rows(conn, [cite_key]).get(cite_key)
+    if row is None or row[-2] != bib_mtime:
+      row = derive_row(cite_key, (dir_mtime, bib_mtime, tags_mtime))
+      conn.execute(INSERT_OR_REPLACE_ROW, row)
+    elif topic_tags is None:
+      conn.execute("UPDATE cite_keys SET dir_mtime = ?, tags_mtime = ? WHERE cite_key = ?",
+          (dir_mtime, tags_mtime, cite_key))
+    else:
+      conn.execute("UPDATE cite_keys SET topic_tags = ?, dir_mtime = ?, tags_mtime = ? WHERE cite_key = ?",
+          (LIST_SEPARATOR.join(sorted(topic_tags)), dir_mtime, tags_mtime, cite_key))
+    conn.commit()
+  finally:
+    conn.close()
+
+
+def update_attachment(attachment_id):
+  """Re-derive the catalog row for the attachment 'attachment_id'."""
+  attachments_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR)
+  row = derive_attachment_row(attachment_id,
+      get_attachment_mtimes(attachments_subdir_abspath, attachment_id))
+  execute_and_commit(INSERT_OR_REPLACE_ATTACHMENT_ROW, row)
+
+
+def regenerate_catalog():
+  """Regenerate the catalog from scratch, if it somehow gets out of sync.
+
+  This function is not called by any other Distil code; it's purely
+  for administrator convenience.  (Since the catalog is never committed
+  to the repository, there is nothing to commit afterwards.)
+
+  The bib-files are parsed in parallel, by a pool of worker processes.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  all_cite_keys = os.listdir(bibs_subdir_abspath)
+
+  attachments_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(attachments_subdir_abspath)
+  all_attachment_ids = os.listdir(attachments_subdir_abspath)
+
+  pool = multiprocessing.Pool()
+  try:
+    # Hand each worker a reasonably-sized batch of cite-keys at a time,
+    # to amortise the inter-process communication overhead.
+    chunksize = max(1, len(all_cite_keys) / (8 * multiprocessing.cpu_count()))
+    rows = pool.map(derive_row_for_cite_key, all_cite_keys, chunksize)
+    attachment_rows = pool.map(derive_row_for_attachment, all_attachment_ids, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+  conn = open_catalog()
+  try:
+    conn.execute("DELETE FROM cite_keys")
+    conn.execute("DELETE FROM attachments")
+    conn.executemany(INSERT_OR_REPLACE_ROW, rows)
+    conn.executemany(INSERT_OR_REPLACE_ATTACHMENT_ROW, attachment_rows)
+    conn.commit()
+  finally:
+    conn.close()
+
+  return (len(rows), len(attachment_rows))
+
+
+### Anything below this point is not part of the exported API.
+
+
+def open_catalog():
+  """Open (creating if necessary) the catalog database, and return a connection."""
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  catalog_fname_abspath = os.path.join(cache_dir_abspath, CATALOG_FNAME)
+
+  # Several Distil processes (for example, the webserver and an import command)
+  # may access the catalog simultaneously, so wait for locks rather than fail.
+  conn = sqlite3.connect(catalog_fname_abspath, timeout=30)
+
+  # Store and return regular (UTF-8-encoded) strings, exactly as they are
+  # returned by the BibTeX parser, rather than Unicode strings.
+  conn.text_factory = str
+
+  schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+  if schema_version != SCHEMA_VERSION:
+    conn.execute("DROP TABLE IF EXISTS cite_keys")
+    conn.execute("DROP TABLE IF EXISTS attachments")
+    conn.execute(CREATE_CITE_KEYS_TABLE)
+    conn.execute(CREATE_ATTACHMENTS_TABLE)
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    conn.commit()
+
+  return conn
+
+
+def execute_and_commit(statement, params):
+  conn = open_catalog()
+  try:
+    conn.execute(statement, params)
+    conn.commit()
+  finally:
+    conn.close()
+
+
+def read_all_rows(conn):
+  return dict((row[0], row) for row in conn.execute(SELECT_ALL_ROWS))
+
+
+def read_rows(conn, cite_keys):
+  rows = {}
+  for i in xrange(0, len(cite_keys), MAX_PARAMS_PER_QUERY):
+    chunk = cite_keys[i:i + MAX_PARAMS_PER_QUERY]
+    query = "%s WHERE cite_key IN (%s)" % (SELECT_ALL_ROWS, ", ".join(["?"] * len(chunk)))
+    for row in conn.execute(query, chunk):
+      rows[row[0]] = row
+  return rows
+
+
+def get_mtimes(bibs_subdir_abspath, cite_key):
+  """Return a tuple of the mtimes (dir, bib-file, topic-tags file) of 'cite_key'.
+
+  A file that does not exist has an mtime of None.
+  """
+  cite_key_dir_abspath = os.path.join(bibs_subdir_abspath, cite_key)
+  dir_mtime = get_mtime(cite_key_dir_abspath)
+  if dir_mtime is None:
+    raise filesystem_utils.DirectoryNotFound(cite_key_dir_abspath)
+
+  bib_mtime = get_mtime(os.path.join(cite_key_dir_abspath, cite_key + ".bib"))
+  tags_mtime = get_mtime(os.path.join(cite_key_dir_abspath, constants.TOPIC_TAGS_FNAME))
+  return (dir_mtime, bib_mtime, tags_mtime)
+
+
+def get_mtime(fname_abspath):
+  try:
+    return os.stat(fname_abspath).st_mtime
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+
+
+def derive_row(cite_key, mtimes):
+  """Derive the catalog row for 'cite_key' from the files in its cite-key dir."""
+  doc_attrs = stored_bibs.get_doc_attrs(cite_key)
+  topic_tags = topic_tag_file_io.get_topic_tags_for_cite_key(cite_key)
+
+  return (cite_key,
+      doc_attrs["title"],
+      LIST_SEPARATOR.join(doc_attrs["author-lastnames"]),
+      doc_attrs["year-published"],
+      doc_attrs.get("doc-name"),
+      doc_attrs.get("doc-suffix"),
+      doc_attrs.get("doc-type"),
+      doc_attrs["date-added"],
+      LIST_SEPARATOR.join(topic_tags)) + mtimes
+
+
+def derive_row_for_cite_key(cite_key):
+  """Derive the catalog row for 'cite_key', including its mtimes.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'regenerate_catalog'.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  return derive_row(cite_key, get_mtimes(bibs_subdir_abspath, cite_key))
+
+
+def convert_row_to_attrs(row):
+  (cite_key, title, author_lastnames, year_published, doc_name, doc_suffix,
+      doc_type, date_added, topic_tags) = row[:9]
+
+  attrs = {
+    "title": title,
+    "author-lastnames": split_list(author_lastnames),
+    "year-published": year_published,
+    "date-added": date_added,
+    "topic-tags": split_list(topic_tags),
+  }
+  if doc_name is not None:
+    # There is a doc in this cite-key dir.
+    attrs["doc-name"] = doc_name
+    attrs["doc-suffix"] = doc_suffix
+    attrs["doc-type"] = doc_type
+
+  return attrs
+
+
+def split_list(s):
+  if not s:
+    return []
+  return s.split(LIST_SEPARATOR)
+
+
+def get_attachment_mtimes(attachments_subdir_abspath, attachment_id):
+  """Return a tuple of the mtimes (dir, metadata file) of 'attachment_id'."""
+  attachment_dir_abspath = os.path.join(attachments_subdir_abspath, attachment_id)
+  dir_mtime = get_mtime(attachment_dir_abspath)
+  if dir_mtime is None:
+    raise filesystem_utils.DirectoryNotFound(attachment_dir_abspath)
+
+  metadata_mtime = get_mtime(os.path.join(attachment_dir_abspath, ".metadata"))
+  return (dir_mtime, metadata_mtime)
+
+
+def derive_attachment_row(attachment_id, mtimes):
+  (fname, dirname, fsize, descr, source_url, suffix, ftype, static_path) = \
+      attachments.get_attachment_attrs(attachment_id)
+  return (attachment_id, fname, fsize, descr, source_url, suffix, ftype) + mtimes
+
+
+def derive_row_for_attachment(attachment_id):
+  """Derive the catalog row for 'attachment_id', including its mtimes.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'regenerate_catalog'.
+  """
+  attachments_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR)
+  return derive_attachment_row(attachment_id,
+      get_attachment_mtimes(attachments_subdir_abspath, attachment_id))
+
+
+def convert_attachment_row_to_attrs(row):
+  (attachment_id, fname, fsize, descr, source_url, suffix, ftype) = row[:7]
+  static_path = "/static/%s/attachments/%s/%s" % (config.DOCLIB_SYMLINK_NAME, attachment_id, fname)
+  return (fname, attachment_id, fsize, descr, source_url, suffix, ftype, static_path)
@@ -165,3 +165,42 @@ if not COOKIE_SECRET:
 # For example: /var/lib/distil/.htpasswd (or) ~/.distil-htpasswd
 HTPASSWD_ABSPATH = os.path.expanduser(_CP.get(_SECTION, 'htpasswd_abspath'))
 
+
+
+# The commit queue: rather than committing every change to the repository as
+# soon as it's made, Distil queues the changes, and commits them all at once
+# (in a single commit) when the oldest change has waited 'commit_queue_max_delay'
+# seconds, or when 'commit_queue_max_operations' changes have been queued.
+#
+# These variables are optional.  Set 'commit_queue_max_delay' to 0 to commit
+# every change as soon as it's made.
+#
+# For example: 2.0 (and) 20
+def _get_optional_value(option, default, get_func):
+  if _CP.has_option(_SECTION, option):
+    return get_func(_SECTION, option)
+  return default
+
+COMMIT_QUEUE_MAX_DELAY = _get_optional_value('commit_queue_max_delay', 2.0, _CP.getfloat)
+COMMIT_QUEUE_MAX_OPERATIONS = _get_optional_value('commit_queue_max_operations', 20, _CP.getint)
+
+
+# The repository backend, which commits the changes to the repository:
+#  - "subprocess" forks a Git process for each Git command (the default);
+#  - "fast-import" streams the changes to a long-lived "git fast-import"
+#    process, avoiding the cost of forking Git processes.
+#
+# This variable is optional.
+#
+# For example: subprocess (or) fast-import
+REPOSITORY_BACKEND = _get_optional_value('repository_backend', "subprocess", _CP.get)
+
+
+# The limits on downloading a URL attachment:  the maximum size (in megabytes)
+# of the contents of the URL, and the maximum time (in seconds) to download it.
+#
+# These variables are optional.
+#
+# For example: 100 (and) 300
+URL_FETCH_MAX_NUM_BYTES = int(_get_optional_value('url_fetch_max_megabytes', 100, _CP.getfloat) * 1024 * 1024)
+URL_FETCH_TIMEOUT = _get_optional_value('url_fetch_timeout', 300, _CP.getint)
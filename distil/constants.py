@@ -16,8 +16,14 @@ WIKI_SUBDIR = "wiki"
 # that contains the topic-tag indices.
 TOPIC_TAG_INDEX_SUBDIR = ".topic-tag-index"
 
+# 'CACHE_SUBDIR' specifies the subdirectory (relative to 'DOCLIB_BASE_ABSPATH')
+# that contains derived data (catalogs, indices, etc.) which can always be
+# regenerated from the rest of the doclib, and so is never committed.
+CACHE_SUBDIR = ".distil-cache"
+
 # Various filenames of files.
 ABSTRACT_FNAME = "_abstract.txt"
+DOC_ATTRS_FNAME = ".doc-attrs.json"
 NOTES_FNAME = "_notes.wiki"
 NOTES_CHANGE_DESCRS_FNAME = ".notes-change-descrs"
 TOPIC_TAGS_FNAME = "_topic-tags"
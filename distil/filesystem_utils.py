@@ -153,6 +153,24 @@ def ensure_dir_exists(dir_abspath):
     os.makedirs(dir_abspath)
 
 
+def ensure_cache_dir_exists(dir_abspath):
+  """Ensure the cache directory 'dir_abspath' exists, and is ignored by Git.
+
+  The contents of a cache directory can always be regenerated, so they should
+  never show up as untracked files in the repository.  Rather than requiring
+  the user to edit the ".gitignore" of the enclosing repository, we place a
+  ".gitignore" that ignores everything (including itself) inside the directory.
+  """
+  ensure_dir_exists(dir_abspath)
+  gitignore_abspath = os.path.join(dir_abspath, ".gitignore")
+  if not os.path.exists(gitignore_abspath):
+    f = open(gitignore_abspath, 'w')
+    try:
+      f.write("*\n")
+    finally:
+      f.close()
+
+
 def create_empty_file(fname):
   """A convenience function to ensure a file is closed and flushed to disk
   before any other operations (like a Git add) occur.
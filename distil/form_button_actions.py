@@ -18,9 +18,17 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 
+import repository_executor
 import topic_tag_file_io
 
 
+# Each button action is invoked on the IOLoop thread as
+# 'action(handler, wiki_id, render_page_args, callback)', and will invoke
+# 'callback' (with no arguments) when it has finished setting 'render_page_args'.
+# The actions that change the doclib do so on the repository executor thread
+# (see 'repository_executor'), so the IOLoop is not blocked in the meantime.
+
+
 class WikiButtonActions(object):
   def __init__(self, title, name, get_wiki_text_func, update_wiki_text_func):
     self.title = title
@@ -35,7 +43,7 @@ class WikiButtonActions(object):
     self.update_wiki_text_func = update_wiki_text_func
     self.other_unsaved_form_data_to_retain = []
 
-  def preview_wiki_text(self, handler, wiki_id, render_page_args):
+  def preview_wiki_text(self, handler, wiki_id, render_page_args, callback):
     self.set_args_wiki_text(render_page_args, self.get_wiki_text(handler))
     self.set_args_change_descr(render_page_args, self.get_change_descr(handler))
     self.set_args_message_class(render_page_args, "message-preview")
@@ -43,30 +51,48 @@ class WikiButtonActions(object):
 
     for func in self.other_unsaved_form_data_to_retain:
       func(handler, wiki_id, render_page_args)
+    callback()
 
-  def reset_wiki_text(self, handler, wiki_id, render_page_args):
+  def reset_wiki_text(self, handler, wiki_id, render_page_args, callback):
     self.set_args_message_class(render_page_args, "message-reset")
     self.set_args_message(render_page_args, "%s Reset" % self.title)
 
     for func in self.other_unsaved_form_data_to_retain:
       func(handler, wiki_id, render_page_args)
+    callback()
 
-  def save_wiki_text(self, handler, wiki_id, render_page_args):
+  def save_wiki_text(self, handler, wiki_id, render_page_args, callback):
     wiki_text = self.get_wiki_text(handler)
+    change_descr = self.get_change_descr(handler)
+
+    def on_saved(wiki_text_was_changed):
+      if wiki_text_was_changed:
+        self.set_args_message_class(render_page_args, "message-saved")
+        self.set_args_message(render_page_args, "%s Saved!" % self.title)
+      else:
+        # The wiki-text has not been changed.  So we did nothing.
+        self.set_args_change_descr(render_page_args, change_descr)
+        self.set_args_message_class(render_page_args, "message-no-change")
+        self.set_args_message(render_page_args, "No Changes to %s" % self.title)
+
+      for func in self.other_unsaved_form_data_to_retain:
+        func(handler, wiki_id, render_page_args)
+      callback()
+
+    repository_executor.submit(self.save_wiki_text_if_changed,
+        (wiki_id, wiki_text, change_descr), on_saved)
+
+  def save_wiki_text_if_changed(self, wiki_id, wiki_text, change_descr):
+    """Save the wiki-text if it has been changed; return whether it was changed.
+
+    This is invoked on the repository executor thread.
+    """
     if wiki_text != self.get_wiki_text_func(wiki_id):
       # The wiki-text has been changed.  So we should save it.
-      self.update_wiki_text_func(wiki_id, wiki_text,
-          handler.get_input_text("%s-change-descr" % self.name))
-      self.set_args_message_class(render_page_args, "message-saved")
-      self.set_args_message(render_page_args, "%s Saved!" % self.title)
+      self.update_wiki_text_func(wiki_id, wiki_text, change_descr)
+      return True
     else:
-      # The wiki-text has not been changed.  So we do nothing.
-      self.set_args_change_descr(render_page_args, self.get_change_descr(handler))
-      self.set_args_message_class(render_page_args, "message-no-change")
-      self.set_args_message(render_page_args, "No Changes to %s" % self.title)
-
-    for func in self.other_unsaved_form_data_to_retain:
-      func(handler, wiki_id, render_page_args)
+      return False
 
   def retain_unsaved_wiki_text(self, handler, wiki_id, render_page_args):
     # Retain any unsaved text in the wiki-text textarea, or in the "change-descr" field.
@@ -96,17 +122,56 @@ class TagButtonActions(object):
   def __init__(self):
     self.other_unsaved_form_data_to_retain = []
 
-  def save_tags(self, handler, cite_key, render_page_args):
-    topic_tag_file_io.update_topic_tags_for_cite_key(cite_key,
-        handler.get_arguments("tag"), handler.get_input_text("new-tags"))
-    render_page_args["tags_message_class"] = "message-saved"
-    render_page_args["tags_message"] = "Tags Saved!"
+  def save_tags(self, handler, cite_key, render_page_args, callback):
+    def on_saved(result):
+      render_page_args["tags_message_class"] = "message-saved"
+      render_page_args["tags_message"] = "Tags Saved!"
 
-    for func in self.other_unsaved_form_data_to_retain:
-      func(handler, cite_key, render_page_args)
+      for func in self.other_unsaved_form_data_to_retain:
+        func(handler, cite_key, render_page_args)
+      callback()
+
+    repository_executor.submit(topic_tag_file_io.update_topic_tags_for_cite_key,
+        (cite_key, handler.get_arguments("tag"), handler.get_input_text("new-tags")),
+        on_saved)
 
   def retain_unsaved_tags(self, handler, cite_key, render_page_args):
     # Retain any unsaved topic tags, and any text in the "new-tags" text field.
     render_page_args["tags"] = handler.get_arguments("tag")
     render_page_args["new_tags"] = handler.get_input_text("new-tags")
 
+
+class BatchTagButtonActions(object):
+  """The button actions of the form (on the cite-key list pages) that updates
+  the topic tags of all the selected cite-keys at once.
+  """
+
+  def update_tags(self, handler, list_id, render_page_args, callback):
+    cite_keys = handler.get_arguments("selected-cite-key")
+    added_tags = topic_tag_file_io.split_at_whitespace_and_commas(handler.get_input_text("add-tags"))
+    removed_tags = topic_tag_file_io.split_at_whitespace_and_commas(handler.get_input_text("remove-tags"))
+
+    if not cite_keys or not (added_tags or removed_tags):
+      render_page_args["batch_tags_message_class"] = "message-error"
+      render_page_args["batch_tags_message"] = \
+          "Select some items, and specify the tags to add or remove."
+      self.retain_unsaved_tags(handler, list_id, render_page_args)
+      callback()
+      return
+
+    def on_updated(num_changed):
+      render_page_args["batch_tags_message_class"] = "message-saved"
+      if num_changed == 1:
+        render_page_args["batch_tags_message"] = "Tags updated for 1 item."
+      else:
+        render_page_args["batch_tags_message"] = "Tags updated for %d items." % num_changed
+      callback()
+
+    repository_executor.submit(topic_tag_file_io.update_topic_tags_for_cite_keys,
+        (cite_keys, added_tags, removed_tags), on_updated)
+
+  def retain_unsaved_tags(self, handler, list_id, render_page_args):
+    # Retain the selected cite-keys, and any text in the tag text fields.
+    render_page_args["selected_cite_keys"] = handler.get_arguments("selected-cite-key")
+    render_page_args["add_tags"] = handler.get_input_text("add-tags")
+    render_page_args["remove_tags"] = handler.get_input_text("remove-tags")
@@ -0,0 +1,358 @@
+# git_fast_import.py: Commit to a Git repository through a long-lived "git fast-import".
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import hashlib
+import os
+import stat
+import subprocess
+import time
+
+
+# The "subprocess" repository backend (in 'repository') forks a Git process
+# for each of "git rm", "git add", "git diff" and "git commit", every time the
+# commit queue is flushed.  Each fork+exec costs 5-20ms, and "git add -A" must
+# also lstat every file in the index.
+#
+# Instead, this backend keeps three Git processes alive for the lifetime of the
+# Distil process:
+#  - "git fast-import", to which we stream the contents of the changed files
+#    (blobs) and the commits;
+#  - "git cat-file --batch", from which we read the trees of the branch tip,
+#    to work out which of the queued paths have actually changed (so that we
+#    only stream the files that have changed, and we don't create empty
+#    commits);
+#  - "git cat-file --batch-check", to check whether a blob is already in the
+#    repository (for example, when a file has been moved), so that we don't
+#    need to stream its contents again.
+#
+# The blob IDs are computed in this process (they're just the SHA-1 of the
+# file contents, with a short header), so we can compare them directly to the
+# entries in the trees.
+#
+# "git fast-import" updates the branch ref, but it knows nothing about the
+# index, so after each commit, the index entries of the committed paths are
+# reset to match the new commit (which is the only fork per flush).
+#
+# "git fast-import" writes a new pack-file at every checkpoint (which is needed
+# to update the branch ref after each commit), and unlike "git commit", it never
+# runs "git gc --auto" to consolidate them.  So every 'CHECKPOINTS_PER_GC'
+# checkpoints, the Git processes are restarted around a "git gc --auto" (which
+# repacks once there are more pack-files than "gc.autoPackLimit").
+#
+# Note that (unlike "git add -A"), this backend doesn't consult ".gitignore";
+# every file in a queued directory is committed.
+
+
+### Errors that may be thrown by this module.
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+
+class DetachedHead(Error):
+  def __init__(self, repo_abspath):
+    self.repo_abspath = repo_abspath
+
+  def __str__(self):
+    return "HEAD is not on a branch in the Git repository at '%s'" % self.repo_abspath
+
+
+class ProcessDied(Error):
+  def __init__(self, command):
+    self.command = command
+
+  def __str__(self):
+    return "Git process '%s' exited unexpectedly" % self.command
+
+
+### These are the public functions of the exported API.
+
+
+class FastImportBackend(object):
+  """A repository backend that commits through a long-lived "git fast-import".
+
+  The methods 'commit' and 'close' have the same interface as those of
+  'repository.SubprocessBackend'.
+  """
+
+  def __init__(self, git_executable, doclib_abspath):
+    self.git_executable = git_executable
+
+    # The doclib may be anywhere in the Git repository, but "git fast-import"
+    # expects paths relative to the top of the repository.
+    (toplevel, prefix) = read_git_output(git_executable, doclib_abspath,
+        ["rev-parse", "--show-toplevel", "--show-prefix"]).split("\n")[:2]
+    self.toplevel_abspath = toplevel
+    self.doclib_prefix = prefix
+
+    branch_ref = read_git_output(git_executable, toplevel,
+        ["symbolic-ref", "-q", "HEAD"]).strip()
+    if not branch_ref:
+      raise DetachedHead(toplevel)
+    self.branch_ref = branch_ref
+
+    # Something like "Name <email> 1309999999 +1000"; we'll supply the time.
+    committer_ident = read_git_output(git_executable, toplevel, ["var", "GIT_COMMITTER_IDENT"])
+    self.committer = committer_ident.strip().rsplit(" ", 2)[0]
+
+    self.start_git_processes()
+    self.num_checkpoints = 0
+
+  def commit(self, existing_paths, missing_paths, commit_message):
+    """Commit the current state of the paths (relative to the doclib base),
+    unless none of them have changed since the last commit.
+
+    Returns True if a commit was created.
+    """
+    parent_commit = self.get_object_id(self.branch_ref)
+
+    file_changes = []
+    all_paths = [self.doclib_prefix + path for path in existing_paths + missing_paths]
+    for path in remove_nested_paths(all_paths):
+      (dirname, basename) = os.path.split(path)
+      parent_tree = self.read_tree(parent_commit, dirname)
+      self.diff_path(parent_commit, path, parent_tree.get(basename), file_changes)
+
+    if not file_changes:
+      return False
+
+    commit_message = commit_message + "\n"
+    self.write_to_fast_import("commit %s\n" % self.branch_ref)
+    self.write_to_fast_import("committer %s %d %s\n" %
+        (self.committer, int(time.time()), get_timezone_offset()))
+    self.write_to_fast_import("data %d\n%s\n" % (len(commit_message), commit_message))
+    if parent_commit:
+      self.write_to_fast_import("from %s\n" % parent_commit)
+    for (path, mode, blob_id, contents) in file_changes:
+      if mode is None:
+        self.write_to_fast_import("D %s\n" % path)
+      elif contents is None:
+        self.write_to_fast_import("M %s %s %s\n" % (mode, blob_id, path))
+      else:
+        self.write_to_fast_import("M %s inline %s\ndata %d\n" % (mode, path, len(contents)))
+        self.write_to_fast_import(contents)
+        self.write_to_fast_import("\n")
+    self.write_to_fast_import("\n")
+
+    # The branch ref (and the pack-file) are only written at a checkpoint,
+    # so request a checkpoint, then wait until it has been done.
+    self.num_checkpoints += 1
+    progress_message = "checkpoint %d" % self.num_checkpoints
+    self.write_to_fast_import("checkpoint\n\nprogress %s\n\n" % progress_message)
+    self.fast_import.stdin.flush()
+    while True:
+      line = self.fast_import.stdout.readline()
+      if not line:
+        raise ProcessDied("git fast-import")
+      if line == "progress %s\n" % progress_message:
+        break
+
+    # Bring the index up to date with the new commit.
+    for i in range(0, len(all_paths), MAX_PATHS_PER_COMMAND):
+      subprocess.check_call(
+          [self.git_executable, "reset", "-q", "--"] + all_paths[i:i+MAX_PATHS_PER_COMMAND],
+          cwd=self.toplevel_abspath)
+
+    if self.num_checkpoints % CHECKPOINTS_PER_GC == 0:
+      self.collect_garbage()
+
+    return True
+
+  def close(self):
+    try:
+      self.write_to_fast_import("done\n")
+    except Error:
+      pass
+    for p in [self.fast_import, self.cat_file, self.cat_file_check]:
+      p.stdin.close()
+      p.wait()
+
+  def collect_garbage(self):
+    # Don't let "git gc" remove the pack-files from under the Git processes.
+    self.close()
+    subprocess.call([self.git_executable, "gc", "--auto", "--quiet"], cwd=self.toplevel_abspath)
+    self.start_git_processes()
+
+  def start_git_processes(self):
+    self.fast_import = self.start_git_process(["fast-import", "--quiet", "--done"])
+    self.cat_file = self.start_git_process(["cat-file", "--batch"])
+    self.cat_file_check = self.start_git_process(["cat-file", "--batch-check"])
+
+  def start_git_process(self, git_args):
+    return subprocess.Popen([self.git_executable] + git_args, cwd=self.toplevel_abspath,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+  def write_to_fast_import(self, s):
+    try:
+      self.fast_import.stdin.write(s)
+    except IOError:
+      raise ProcessDied("git fast-import")
+
+  def get_object_id(self, object_name):
+    """Return the object ID of 'object_name', or None if there is no such object."""
+    self.cat_file_check.stdin.write(object_name + "\n")
+    self.cat_file_check.stdin.flush()
+    line = self.cat_file_check.stdout.readline()
+    if not line:
+      raise ProcessDied("git cat-file --batch-check")
+    if line.endswith(" missing\n"):
+      return None
+    return line.split()[0]
+
+  def read_tree(self, commit, dirname):
+    """Return a dictionary that maps each name in the tree 'dirname' of 'commit'
+    to a pair (mode, object ID).
+
+    If there is no such tree, an empty dictionary will be returned.
+    """
+    if not commit:
+      return {}
+
+    self.cat_file.stdin.write("%s:%s\n" % (commit, dirname))
+    self.cat_file.stdin.flush()
+    header = self.cat_file.stdout.readline()
+    if not header:
+      raise ProcessDied("git cat-file --batch")
+    if header.endswith(" missing\n"):
+      return {}
+    (object_id, object_type, size) = header.split()
+    # The contents are followed by a newline.
+    contents = self.cat_file.stdout.read(int(size) + 1)[:-1]
+    if object_type != "tree":
+      return {}
+    return parse_tree(contents)
+
+  def diff_path(self, commit, path, head_entry, file_changes):
+    """Append to 'file_changes' the changes that will bring 'path' in the new
+    commit up to date with 'path' in the working tree.
+
+    'head_entry' is the (mode, object ID) of 'path' in 'commit', or None.
+    Each change is a tuple (path, mode, blob ID, contents); the mode is None
+    for a deletion, and the contents are None for a blob that is already in
+    the repository.
+    """
+    path_abspath = os.path.join(self.toplevel_abspath, path)
+    try:
+      st = os.lstat(path_abspath)
+    except OSError:
+      st = None
+
+    if st is None:
+      if head_entry is not None:
+        file_changes.append((path, None, None, None))
+      return
+
+    if stat.S_ISDIR(st.st_mode):
+      if head_entry is not None and head_entry[0] == TREE_MODE:
+        head_tree = self.read_tree(commit, path)
+      else:
+        if head_entry is not None:
+          # A file has been replaced by a directory.
+          file_changes.append((path, None, None, None))
+        head_tree = {}
+      names = os.listdir(path_abspath)
+      for name in sorted(names):
+        self.diff_path(commit, path + "/" + name, head_tree.get(name), file_changes)
+      for name in sorted(set(head_tree.keys()) - set(names)):
+        file_changes.append((path + "/" + name, None, None, None))
+      return
+
+    if stat.S_ISLNK(st.st_mode):
+      mode = SYMLINK_MODE
+      contents = os.readlink(path_abspath)
+    else:
+      if st.st_mode & stat.S_IXUSR:
+        mode = EXECUTABLE_MODE
+      else:
+        mode = REGULAR_MODE
+      f = open(path_abspath, 'rb')
+      try:
+        contents = f.read()
+      finally:
+        f.close()
+
+    blob_id = hashlib.sha1("blob %d\0%s" % (len(contents), contents)).hexdigest()
+    if head_entry == (mode, blob_id):
+      return
+    if self.get_object_id(blob_id) is not None:
+      # The blob is already in the repository (for example, the file has been
+      # moved), so we don't need to send its contents again.
+      contents = None
+    file_changes.append((path, mode, blob_id, contents))
+
+
+### Anything below this point is not part of the exported API.
+
+
+# The maximum number of paths to supply on a single Git command-line.
+MAX_PATHS_PER_COMMAND = 500
+
+# The number of checkpoints (so commits, and pack-files) between each "git gc --auto".
+CHECKPOINTS_PER_GC = 20
+
+TREE_MODE = "40000"
+SYMLINK_MODE = "120000"
+EXECUTABLE_MODE = "100755"
+REGULAR_MODE = "100644"
+
+
+def read_git_output(git_executable, cwd, git_args):
+  return subprocess.Popen([git_executable] + git_args, cwd=cwd,
+      stdout=subprocess.PIPE).communicate()[0]
+
+
+def parse_tree(contents):
+  """Parse the contents of a Git tree object into a dictionary that maps each
+  name to a pair (mode, object ID).
+  """
+  # Each tree entry is "<mode> <name>\0<20-byte binary object ID>".
+  entries = {}
+  pos = 0
+  while pos < len(contents):
+    end_of_name = contents.index("\0", pos)
+    (mode, name) = contents[pos:end_of_name].split(" ", 1)
+    entries[name] = (mode, contents[end_of_name+1:end_of_name+21].encode("hex"))
+    pos = end_of_name + 21
+  return entries
+
+
+def remove_nested_paths(paths):
+  """Return the paths in 'paths' that are not inside any other path in 'paths'."""
+  result = []
+  for path in sorted(set(paths)):
+    if result and path.startswith(result[-1] + "/"):
+      continue
+    result.append(path)
+  return result
+
+
+def get_timezone_offset():
+  """Return the local timezone offset in the format "+HHMM" (as Git expects)."""
+  if time.localtime().tm_isdst and time.daylight:
+    offset_seconds = -time.altzone
+  else:
+    offset_seconds = -time.timezone
+  sign = "+"
+  if offset_seconds < 0:
+    sign = "-"
+    offset_seconds = -offset_seconds
+  return "%s%02d%02d" % (sign, offset_seconds / 3600, (offset_seconds / 60) % 60)
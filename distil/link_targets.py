@@ -0,0 +1,119 @@
+# link_targets.py: Keep track of the possible targets of wiki links.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import ConfigParser
+import os
+
+import config
+import constants
+
+
+# When wiki markup is transformed into HTML, each link to a cite-key, wiki-word
+# or attachment is marked according to whether its target exists, and a link
+# to an attachment displays the filename of the attachment.  This used to cost
+# an 'os.path.exists' per link (and, for an attachment, the parsing of its
+# ".metadata" file and a 'stat' of the file).
+#
+# Instead, this module keeps the names in each of the bibs, wiki and attachments
+# subdirs of the doclib in an in-memory set, which is re-read whenever the mtime
+# of the subdir changes (that is, whenever a cite-key, wiki-word or attachment
+# is created or removed, by this process or any other).  The filenames of the
+# attachments are read when they are first needed, and kept until the
+# attachments subdir changes.
+
+
+### These are the public functions of the exported API.
+
+
+def get_cite_keys():
+  """Return the set of the existing cite-keys."""
+  return _CITE_KEYS.get_names()
+
+
+def get_wiki_words():
+  """Return the set of the existing wiki-words."""
+  return _WIKI_WORDS.get_names()
+
+
+def get_attachment_ids():
+  """Return the set of the existing attachment IDs."""
+  return _ATTACHMENT_IDS.get_names()
+
+
+def get_attachment_fname(attachment_id):
+  """Return the filename of the existing attachment 'attachment_id'."""
+  # Ensure the filenames are discarded if the attachments subdir has changed.
+  _ATTACHMENT_IDS.get_names()
+
+  fname = _ATTACHMENT_FNAMES.get(attachment_id)
+  if fname is None:
+    metadata_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR,
+        attachment_id, ".metadata")
+    cp = ConfigParser.SafeConfigParser()
+    cp.read(metadata_abspath)
+    fname = cp.get("Cache", "filename")
+    _ATTACHMENT_FNAMES[attachment_id] = fname
+  return fname
+
+
+class SubdirNames(object):
+  """The set of names in a subdir of the doclib, re-read whenever the mtime of
+  the subdir changes.
+
+  If 'on_change' is supplied, it will be invoked (with no arguments) whenever
+  the names are re-read.
+  """
+
+  def __init__(self, subdir, on_change=None):
+    self.subdir = subdir
+    self.on_change = on_change
+    self.mtime = None
+    self.names = frozenset()
+
+  def get_names(self):
+    subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, self.subdir)
+    try:
+      mtime = os.stat(subdir_abspath).st_mtime
+    except OSError:
+      # The subdir doesn't exist yet, so neither do any names.
+      mtime = None
+
+    if mtime != self.mtime:
+      # Note that we obtain the mtime *before* listing the directory, so if
+      # the directory changes while we're listing it, we'll re-read it next time.
+      if mtime is None:
+        self.names = frozenset()
+      else:
+        self.names = frozenset(os.listdir(subdir_abspath))
+      self.mtime = mtime
+      if self.on_change is not None:
+        self.on_change()
+
+    return self.names
+
+
+### Anything below this point is not part of the exported API.
+
+
+_ATTACHMENT_FNAMES = {}
+
+_CITE_KEYS = SubdirNames(constants.BIBS_SUBDIR)
+_WIKI_WORDS = SubdirNames(constants.WIKI_SUBDIR)
+_ATTACHMENT_IDS = SubdirNames(constants.ATTACHMENTS_SUBDIR, _ATTACHMENT_FNAMES.clear)
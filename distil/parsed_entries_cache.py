@@ -0,0 +1,311 @@
+# parsed_entries_cache.py: A two-tier cache of the parsed entries of bib-files.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import cPickle
+import hashlib
+import os
+import sqlite3
+
+import config
+import constants
+import filesystem_utils
+import test_framework
+
+
+# The function 'bibfile_utils.read_entries_from_file' is invoked to display
+# a bib-entry, to derive the catalog row of a cite-key, to index a cite-key
+# for searching, and so on.  Every invocation decodes, preprocesses and parses
+# the bib-file from scratch.
+#
+# Instead, we keep the parsed entries in a two-tier cache:
+#
+#  1. An in-process LRU cache, bounded by the total size of the cached values,
+#     keyed by the absolute path, size and mtime of the bib-file.
+#
+#  2. An SQLite database in the cache subdir of the doclib, with two tables:
+#      - 'files' maps the absolute path of a bib-file to its size, mtime and
+#        the hash of its contents (when it was last parsed);
+#      - 'entries' maps the hash of the contents of a bib-file to the parsed
+#        entries.
+#     If the size or mtime of the bib-file has changed, the contents are hashed
+#     again, so if the contents are unchanged (for example, the file has been
+#     touched, or checked-out again by Git), the parsed entries are still found.
+#     Only bib-files inside the doclib are cached on disk, since the cache is
+#     stored in the doclib (and bib-files outside the doclib, such as those
+#     being imported, are typically only parsed once or twice anyway).
+#
+# The parsed entries are stored pickled in both tiers, so that every caller
+# receives its own fresh copy of the entries (which it may modify freely).
+#
+# Like the catalog, this cache is purely a cache:  it is never committed to the
+# repository, and it can be deleted at any time.
+
+
+# Increment this whenever the parser output (or the table definitions) change;
+# a database with any other version will be discarded and re-created.
+SCHEMA_VERSION = 1
+
+PARSED_ENTRIES_FNAME = "parsed-entries.sqlite"
+
+# The maximum total size (in bytes) of the pickled values in the LRU cache.
+MAX_MEMORY_CACHE_SIZE = 16 * 1024 * 1024
+
+CREATE_FILES_TABLE = """CREATE TABLE IF NOT EXISTS files (
+    fname TEXT PRIMARY KEY,
+    fsize INTEGER,
+    mtime REAL,
+    content_hash TEXT)"""
+
+CREATE_ENTRIES_TABLE = """CREATE TABLE IF NOT EXISTS entries (
+    content_hash TEXT PRIMARY KEY,
+    pickled_entries BLOB)"""
+
+
+### These are the public functions of the exported API.
+
+
+def get_entries(fname, parse_func):
+  """Return the parsed entries of the bib-file 'fname'.
+
+  If the entries are not in the cache, they are obtained by invoking
+  'parse_func(fname)', which may return any picklable value.
+  """
+  fname_abspath = os.path.abspath(fname)
+  st = os.stat(fname_abspath)
+  stat_key = (fname_abspath, st.st_size, st.st_mtime)
+
+  pickled = _MEMORY_CACHE.get(stat_key)
+  if pickled is not None:
+    STATS["memory-hits"] += 1
+    return cPickle.loads(pickled)
+
+  if is_in_doclib(fname_abspath):
+    pickled = get_pickled_entries_from_disk(fname_abspath, st, parse_func)
+  else:
+    STATS["misses"] += 1
+    pickled = cPickle.dumps(parse_func(fname), cPickle.HIGHEST_PROTOCOL)
+
+  _MEMORY_CACHE.put(stat_key, pickled, len(pickled))
+  return cPickle.loads(pickled)
+
+
+def get_stats():
+  """Return a dictionary of the hit and miss counters of this process.
+
+  The keys are:
+   - "memory-hits":  found in the in-process LRU cache;
+   - "disk-hits":  found on disk, by path, size and mtime;
+   - "content-hash-hits":  found on disk, by the hash of the file contents;
+   - "misses":  not found, so the bib-file was parsed.
+  """
+  return dict(STATS)
+
+
+def clear_memory_cache():
+  _MEMORY_CACHE.clear()
+
+
+class LRUCache(object):
+  """A least-recently-used cache, bounded by the total size of its values.
+
+  (The 'collections.OrderedDict' class would make this simpler, but it's not
+  available in Python 2.6.)
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.total_size = 0
+
+    # Each item is a doubly-linked list node: [prev, next, key, value, size].
+    # The list is circular; 'self.root' is a sentinel node, with the most
+    # recently-used node after it, and the least recently-used node before it.
+    self.items = {}
+    self.root = []
+    self.root[:] = [self.root, self.root, None, None, 0]
+
+  def __len__(self):
+    return len(self.items)
+
+  def get(self, key, default=None):
+    node = self.items.get(key)
+    if node is None:
+      return default
+
+    # Move the node to the front of the list.
+    self.unlink(node)
+    self.link_at_front(node)
+    return node[3]
+
+  def put(self, key, value, size):
+    if self.items.has_key(key):
+      self.remove(key)
+    if size > self.max_size:
+      # It would just evict everything else, and then be evicted itself.
+      return
+
+    node = [None, None, key, value, size]
+    self.link_at_front(node)
+    self.items[key] = node
+    self.total_size += size
+
+    while self.total_size > self.max_size:
+      # Evict the least recently-used node.
+      self.remove(self.root[0][2])
+
+  def remove(self, key):
+    node = self.items.pop(key)
+    self.unlink(node)
+    self.total_size -= node[4]
+
+  def clear(self):
+    self.items.clear()
+    self.root[:] = [self.root, self.root, None, None, 0]
+    self.total_size = 0
+
+  def unlink(self, node):
+    (prev_node, next_node) = node[0:2]
+    prev_node[1] = next_node
+    next_node[0] = prev_node
+
+  def link_at_front(self, node):
+    first_node = self.root[1]
+    node[0] = self.root
+    node[1] = first_node
+    first_node[0] = node
+    self.root[1] = node
+
+
+### Anything below this point is not part of the exported API.
+
+
+_MEMORY_CACHE = LRUCache(MAX_MEMORY_CACHE_SIZE)
+
+STATS = {
+  "memory-hits": 0,
+  "disk-hits": 0,
+  "content-hash-hits": 0,
+  "misses": 0,
+}
+
+
+def is_in_doclib(fname_abspath):
+  return fname_abspath.startswith(os.path.join(config.DOCLIB_BASE_ABSPATH, ""))
+
+
+def get_pickled_entries_from_disk(fname_abspath, st, parse_func):
+  conn = open_parsed_entries_db()
+  try:
+    row = conn.execute("SELECT fsize, mtime, content_hash FROM files WHERE fname = ?",
+        (fname_abspath,)).fetchone()
+    if row is not None and row[0:2] == (st.st_size, st.st_mtime):
+      pickled = get_pickled_entries_for_hash(conn, row[2])
+      if pickled is not None:
+        STATS["disk-hits"] += 1
+        return pickled
+
+    # The file has changed (or it has never been parsed), so check whether its
+    # contents have changed too.
+    f = open(fname_abspath, 'rb')
+    try:
+      content_hash = hashlib.sha1(f.read()).hexdigest()
+    finally:
+      f.close()
+
+    pickled = get_pickled_entries_for_hash(conn, content_hash)
+    if pickled is not None:
+      STATS["content-hash-hits"] += 1
+    else:
+      STATS["misses"] += 1
+      pickled = cPickle.dumps(parse_func(fname_abspath), cPickle.HIGHEST_PROTOCOL)
+      conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)",
+          (content_hash, sqlite3.Binary(pickled)))
+
+    conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+        (fname_abspath, st.st_size, st.st_mtime, content_hash))
+    if row is not None and row[2] != content_hash:
+      # Remove the entries of the previous contents, unless another file
+      # has the same contents.
+      conn.execute("DELETE FROM entries WHERE content_hash = ? AND NOT EXISTS "
+          "(SELECT 1 FROM files WHERE content_hash = ?)", (row[2], row[2]))
+    conn.commit()
+    return pickled
+  finally:
+    conn.close()
+
+
+def get_pickled_entries_for_hash(conn, content_hash):
+  row = conn.execute("SELECT pickled_entries FROM entries WHERE content_hash = ?",
+      (content_hash,)).fetchone()
+  if row is None:
+    return None
+  return str(row[0])
+
+
+def open_parsed_entries_db():
+  """Open (creating if necessary) the parsed-entries database, and return a connection."""
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  db_fname_abspath = os.path.join(cache_dir_abspath, PARSED_ENTRIES_FNAME)
+
+  # Several Distil processes may access the database simultaneously,
+  # so wait for locks rather than fail.
+  conn = sqlite3.connect(db_fname_abspath, timeout=30)
+  conn.text_factory = str
+
+  schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+  if schema_version != SCHEMA_VERSION:
+    conn.execute("DROP TABLE IF EXISTS files")
+    conn.execute("DROP TABLE IF EXISTS entries")
+    conn.execute(CREATE_FILES_TABLE)
+    conn.execute(CREATE_ENTRIES_TABLE)
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    conn.commit()
+
+  return conn
+
+
+def test_lru_cache():
+  def put_and_get(keys_and_sizes):
+    cache = LRUCache(10)
+    for key, size in keys_and_sizes:
+      if size is None:
+        cache.get(key)
+      else:
+        cache.put(key, key.upper(), size)
+    return sorted(cache.items.keys())
+
+  tests = [
+    ([], []),
+    ([("a", 3), ("b", 3), ("c", 3)], ["a", "b", "c"]),
+    ([("a", 3), ("b", 3), ("c", 3), ("d", 3)], ["b", "c", "d"]),
+    ([("a", 3), ("b", 3), ("c", 3), ("a", None), ("d", 3)], ["a", "c", "d"]),
+    ([("a", 3), ("b", 3), ("a", 6)], ["a", "b"]),
+    ([("a", 3), ("b", 3), ("c", 11)], ["a", "b"]),
+    ([("a", 9), ("b", 2)], ["b"]),
+  ]
+  test_framework.test_and_compare(tests, put_and_get, "LRU cache")
+
+
+def main():
+  test_lru_cache()
+
+
+if __name__ == "__main__":
+  main()
@@ -18,74 +18,504 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 
+import atexit
+import errno
+import fcntl
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 
 import config
 import constants
+import filesystem_utils
+import git_fast_import
+import test_framework
 
 
-def add_and_commit_new_cite_key_dir(cite_key):
-  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+# Every repository operation used to fork a Git process (or two) as soon as it
+# was invoked, which dominated the latency of saving topic tags or notes (and
+# serialised concurrent edits on the Git index lock).  Instead, the files are
+# changed immediately in the working tree, but the Git operations are queued
+# in a commit queue, which is flushed as a single commit of all the queued
+# paths (whose message lists the reasons for all the queued operations):
+#  - when the oldest queued operation has waited 'config.COMMIT_QUEUE_MAX_DELAY'
+#    seconds;
+#  - when 'config.COMMIT_QUEUE_MAX_OPERATIONS' operations have been queued;
+#  - when 'flush' is invoked, or 'commit' is invoked with 'wait=True' (for a
+#    caller that needs to know that its changes are in the repository);
+#  - when 'close' is invoked, or the process exits.  (The webserver invokes
+#    'close' when a server process is terminated by SIGTERM, or is about to be
+#    restarted by the autoreload module, since the 'atexit' functions are not
+#    invoked in either case.)
+#
+# The commit queue is flushed through a repository backend, which is selected
+# by 'config.REPOSITORY_BACKEND':
+#  - "subprocess" (the default) forks a Git process for each Git command.
+#    The commit is built in a temporary index (a copy of the tree of HEAD, in
+#    which only the queued paths are updated), so any other changes that have
+#    been added to the index (by someone other than Distil, in the enclosing
+#    repository) are left in the index, uncommitted.
+#  - "fast-import" streams the changed files and the commits to a long-lived
+#    "git fast-import" process (see 'git_fast_import').  If it fails, Distil
+#    falls back to the "subprocess" backend.
+#
+# Several Distil processes (for example, the worker processes of a webserver
+# started with "--processes", or an import command) may change the doclib and
+# commit to the repository simultaneously, so each commit (and, in the
+# webserver, each operation that changes the doclib) holds the doclib lock,
+# an exclusive lock on a file in the cache subdir of the doclib.
+
+
+### Errors that may be thrown by this module.
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+
+class UnknownBackend(Error):
+  def __init__(self, backend_name):
+    self.backend_name = backend_name
+
+  def __str__(self):
+    return "unknown repository backend '%s' (expected 'subprocess' or 'fast-import')" % \
+        self.backend_name
+
+
+# The maximum number of paths to supply on a single Git command-line.
+MAX_PATHS_PER_COMMAND = 500
+
+# The name of the lock file (in the cache subdir of the doclib).
+DOCLIB_LOCK_FNAME = "doclib.lock"
+
+
+### These are the public functions of the exported API.
+
+
+def add_and_commit_new_cite_key_dir(cite_key, wait=False):
+  cite_key_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR, cite_key)
   commit_message = "Distil created bib-entry %s." % cite_key
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "add", cite_key],
-      cwd=bibs_subdir_abspath)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "commit", "-m", commit_message, cite_key],
-      cwd=bibs_subdir_abspath)
+  _COMMIT_QUEUE.enqueue([cite_key_dir_abspath], commit_message, wait)
+
+
+def add_and_commit_new_cite_key_dirs(cite_keys, other_dir_abspaths, reason):
+  """Add and commit many new cite-key dirs at once, in a single commit.
 
+  The directories 'other_dir_abspaths' (such as the topic tag index) will be
+  added and committed along with them.  This function waits for the commit.
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  dir_abspaths = [os.path.join(bibs_subdir_abspath, cite_key) for cite_key in cite_keys]
+  commit_message = "Distil operation: %s" % reason
+  _COMMIT_QUEUE.enqueue(dir_abspaths + list(other_dir_abspaths), commit_message, wait=True)
 
-def add_and_commit_new_attachment_dir(fname, dirname):
-  attachments_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR)
+
+def add_and_commit_new_attachment_dir(fname, dirname, wait=False):
+  attachment_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR, dirname)
   commit_message = 'Distil stored file attachment "%s" in new directory %s.' % (fname, dirname)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "add", dirname],
-      cwd=attachments_subdir_abspath)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "commit", "-m", commit_message, dirname],
-      cwd=attachments_subdir_abspath)
+  _COMMIT_QUEUE.enqueue([attachment_dir_abspath], commit_message, wait)
 
 
 def add(fname_abspath):
-  """A generic repository "add" function."""
-  rel_fname = path_rel_doclib_base(fname_abspath)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "add", rel_fname],
-      cwd=config.DOCLIB_BASE_ABSPATH)
+  """A generic repository "add" function.
+
+  The file will be added to the repository by the next commit that includes it.
+  """
+  _COMMIT_QUEUE.stage(fname_abspath)
 
 
 def remove(fname_abspath):
-  """A generic repository "remove" function."""
-  rel_fname = path_rel_doclib_base(fname_abspath)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "rm", rel_fname],
-      cwd=config.DOCLIB_BASE_ABSPATH)
+  """A generic repository "remove" function.
+
+  The file is removed immediately; its removal will be recorded in the repository
+  by the next commit that includes it.
+  """
+  os.remove(fname_abspath)
+  _COMMIT_QUEUE.stage(fname_abspath)
 
 
 def move(src_fname_abspath, dest_fname_abspath):
-  """A generic repository "move" function."""
-  rel_src_fname = path_rel_doclib_base(src_fname_abspath)
-  rel_dest_fname = path_rel_doclib_base(dest_fname_abspath)
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "mv", rel_src_fname, rel_dest_fname],
-      cwd=config.DOCLIB_BASE_ABSPATH)
+  """A generic repository "move" function.
+
+  The file (or directory) is moved immediately; the move will be recorded in the
+  repository by the next commit that includes both paths.
+  """
+  if os.path.exists(dest_fname_abspath):
+    # This is what "git mv" would complain about.
+    raise OSError(errno.EEXIST, "destination exists", dest_fname_abspath)
+  os.rename(src_fname_abspath, dest_fname_abspath)
+  _COMMIT_QUEUE.stage(src_fname_abspath)
+  _COMMIT_QUEUE.stage(dest_fname_abspath)
 
 
-def commit(fname_abspaths, reason):
+def commit(fname_abspaths, reason, wait=False):
   """A generic repository "commit" function.
   
   'fname_abspaths' is a list of filename absolute-paths;
   'reason' is a reason for the commit.
+
+  The commit is queued in the commit queue; if 'wait' is True, the commit queue
+  will be flushed before this function returns.
   """
-  relative_fnames = map(path_rel_doclib_base, fname_abspaths)
   commit_message = "Distil operation: %s" % reason
-  subprocess.check_call(
-      [config.GIT_EXECUTABLE, "commit", "-m", commit_message] + relative_fnames,
-      cwd=config.DOCLIB_BASE_ABSPATH)
+  _COMMIT_QUEUE.enqueue(fname_abspaths, commit_message, wait)
+
+
+def flush():
+  """Flush the commit queue, so that all the queued operations are committed
+  to the repository before this function returns.
+  """
+  _COMMIT_QUEUE.flush()
+
+
+def close():
+  """Flush the commit queue, and close the repository backend.
+
+  This is invoked automatically when the process exits, but not if the process
+  is terminated by a signal, or replaced by 'os.execv'.  The repository may be
+  used again after this function returns (the backend will be re-created).
+
+  The doclib lock is acquired before the commit queue is flushed (in the same
+  order as by an operation that enqueues a commit while it holds the doclib
+  lock), so this function may be invoked on any thread.
+  """
+  lock_doclib()
+  try:
+    _COMMIT_QUEUE.close()
+  finally:
+    unlock_doclib()
+
+
+def set_flush_scheduler(schedule_func):
+  """Set the function that will be used to schedule a delayed flush of the
+  commit queue.
+
+  'schedule_func' will be invoked as 'schedule_func(delay, callback)', and
+  should arrange for 'callback' to be invoked (with no arguments) after 'delay'
+  seconds.  It should return a function (with no arguments) that will cancel
+  the invocation of 'callback'.
+
+  The default scheduler uses a 'threading.Timer'; the webserver sets a scheduler
+  that submits the flush to the repository executor thread instead, so that a
+  flush can't occur while an operation is part-way through changing some files.
+  """
+  _COMMIT_QUEUE.schedule_func = schedule_func
+
+
+def lock_doclib():
+  """Acquire the doclib lock, waiting until no other process holds it.
+
+  The lock is re-entrant (within this process), so each invocation of this
+  function must be matched by an invocation of 'unlock_doclib'.
+  """
+  _DOCLIB_LOCK.acquire()
+
+
+def unlock_doclib():
+  _DOCLIB_LOCK.release()
 
 
 def path_rel_doclib_base(fname_abspath):
   """Return the path of 'fname_abspath' relative to the doclib base."""
   return os.path.relpath(os.path.normpath(fname_abspath), config.DOCLIB_BASE_ABSPATH)
 
+
+### Anything below this point is not part of the exported API.
+
+
+def schedule_using_timer(delay, callback):
+  timer = threading.Timer(delay, callback)
+  # Don't let the timer keep the process alive; the queue will be flushed
+  # at exit anyway.
+  timer.daemon = True
+  timer.start()
+  return timer.cancel
+
+
+class CommitQueue(object):
+  def __init__(self, max_delay, max_operations):
+    self.max_delay = max_delay
+    self.max_operations = max_operations
+    self.schedule_func = schedule_using_timer
+
+    # The relative paths to be added (using "git add -A") in the next commit.
+    self.staged_paths = set()
+    # The commit message of each queued operation, in order.
+    self.commit_messages = []
+    # If a flush has been scheduled, this is a function that will cancel it.
+    self.cancel_scheduled_flush = None
+    # The repository backend is created when it's first needed.
+    self.backend = None
+
+    # A re-entrant lock, since the flush at the end of 'enqueue' re-acquires it.
+    self.lock = threading.RLock()
+
+  def stage(self, fname_abspath):
+    self.lock.acquire()
+    try:
+      self.staged_paths.add(path_rel_doclib_base(fname_abspath))
+    finally:
+      self.lock.release()
+
+  def enqueue(self, fname_abspaths, commit_message, wait=False):
+    self.lock.acquire()
+    try:
+      for fname_abspath in fname_abspaths:
+        self.staged_paths.add(path_rel_doclib_base(fname_abspath))
+      self.commit_messages.append(commit_message)
+
+      if wait or (self.max_delay <= 0) or \
+          (len(self.commit_messages) >= self.max_operations):
+        self.flush()
+      elif self.cancel_scheduled_flush is None:
+        self.cancel_scheduled_flush = self.schedule_func(self.max_delay, self.flush)
+    finally:
+      self.lock.release()
+
+  def flush(self):
+    self.lock.acquire()
+    try:
+      if self.cancel_scheduled_flush is not None:
+        # Ensure the scheduled flush won't occur after this one (for example,
+        # after the flush at exit, as the process is shutting down).
+        self.cancel_scheduled_flush()
+        self.cancel_scheduled_flush = None
+      if not self.commit_messages:
+        return
+
+      staged_paths = sorted(self.staged_paths)
+      commit_message = get_aggregate_commit_message(self.commit_messages)
+      self.staged_paths = set()
+      self.commit_messages = []
+
+      existing_paths = []
+      missing_paths = []
+      for path in staged_paths:
+        if os.path.exists(os.path.join(config.DOCLIB_BASE_ABSPATH, path)):
+          existing_paths.append(path)
+        else:
+          missing_paths.append(path)
+
+      if self.backend is None:
+        self.backend = create_backend(config.REPOSITORY_BACKEND)
+      lock_doclib()
+      try:
+        try:
+          self.backend.commit(existing_paths, missing_paths, commit_message)
+        except git_fast_import.Error as e:
+          # The changes are still in the working tree, so they can still be
+          # committed by the subprocess backend.
+          print >> sys.stderr, "Warning: %s; falling back to the subprocess repository backend." % e
+          self.backend = SubprocessBackend(config.GIT_EXECUTABLE, config.DOCLIB_BASE_ABSPATH)
+          self.backend.commit(existing_paths, missing_paths, commit_message)
+      finally:
+        unlock_doclib()
+    finally:
+      self.lock.release()
+
+  def close(self):
+    self.flush()
+    if self.backend is not None:
+      self.backend.close()
+      self.backend = None
+
+
+class SubprocessBackend(object):
+  """The default repository backend, which forks a Git process for each Git command."""
+
+  def __init__(self, git_executable, doclib_abspath):
+    self.git_executable = git_executable
+    self.doclib_abspath = doclib_abspath
+
+  def commit(self, existing_paths, missing_paths, commit_message):
+    """Commit the current state of the paths (relative to the doclib base),
+    unless none of them have changed since the last commit.
+
+    Returns True if a commit was created.
+    """
+    # Bring the index up to date with the queued paths, so that it will agree
+    # with the new commit.
+    self.update_index(existing_paths, missing_paths)
+
+    # The commit is built in a temporary index, which starts as the tree of
+    # HEAD, so that it contains the changes to the queued paths (including the
+    # removals), but none of the other changes in the index (which are none of
+    # our business).  This way, a single "git commit" commits any number of
+    # paths.
+    temp_dir_abspath = tempfile.mkdtemp()
+    env = dict(os.environ, GIT_INDEX_FILE=os.path.join(temp_dir_abspath, "index"))
+    try:
+      if self.has_head():
+        self.check_call_git(["read-tree", "HEAD"], env)
+      self.update_index(existing_paths, missing_paths, env)
+
+      # If none of the queued operations actually changed anything, there will
+      # be nothing to commit (and "git commit" would fail).
+      if subprocess.call([self.git_executable, "diff", "--cached", "--quiet"],
+          cwd=self.doclib_abspath, env=env) == 0:
+        return False
+      self.check_call_git(["commit", "-q", "-m", commit_message], env)
+    finally:
+      shutil.rmtree(temp_dir_abspath)
+    return True
+
+  def close(self):
+    pass
+
+  def update_index(self, existing_paths, missing_paths, env=None):
+    # "git add -A" will record the removal of a path that no longer exists,
+    # but only if it matches something in the index (otherwise, it complains
+    # that the path did not match any files), so the paths that no longer
+    # exist are removed from the index separately.
+    #
+    # There might be thousands of paths (for example, in a bulk import), which
+    # would be too many for a single command-line.
+    for i in range(0, len(missing_paths), MAX_PATHS_PER_COMMAND):
+      self.check_call_git(["rm", "-r", "-q", "--cached", "--ignore-unmatch", "--"] +
+          missing_paths[i:i+MAX_PATHS_PER_COMMAND], env)
+    for i in range(0, len(existing_paths), MAX_PATHS_PER_COMMAND):
+      self.check_call_git(["add", "-A", "--"] +
+          existing_paths[i:i+MAX_PATHS_PER_COMMAND], env)
+
+  def has_head(self):
+    # There is no HEAD commit in a new repository.
+    p = subprocess.Popen([self.git_executable, "rev-parse", "-q", "--verify", "HEAD"],
+        cwd=self.doclib_abspath, stdout=subprocess.PIPE)
+    p.communicate()
+    return (p.returncode == 0)
+
+  def check_call_git(self, git_args, env=None):
+    subprocess.check_call([self.git_executable] + git_args, cwd=self.doclib_abspath, env=env)
+
+
+class DoclibLock(object):
+  """A re-entrant lock that excludes other threads of this process, and other
+  processes (using 'fcntl.flock' on the file 'fname_abspath').
+  """
+
+  def __init__(self, fname_abspath):
+    self.fname_abspath = fname_abspath
+    self.thread_lock = threading.RLock()
+    # The number of times the lock is currently held by the owning thread.
+    self.depth = 0
+    self.f = None
+
+  def acquire(self):
+    self.thread_lock.acquire()
+    if self.depth == 0:
+      try:
+        filesystem_utils.ensure_cache_dir_exists(os.path.dirname(self.fname_abspath))
+        self.f = open(self.fname_abspath, 'a')
+        # Don't let the lock be inherited across 'os.execv' (as by the
+        # autoreload module), or by any Git processes forked while it's held.
+        fcntl.fcntl(self.f.fileno(), fcntl.F_SETFD,
+            fcntl.fcntl(self.f.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+      except:
+        if self.f is not None:
+          self.f.close()
+          self.f = None
+        self.thread_lock.release()
+        raise
+    self.depth += 1
+
+  def release(self):
+    self.depth -= 1
+    if self.depth == 0:
+      # Closing the file releases the lock.
+      self.f.close()
+      self.f = None
+    self.thread_lock.release()
+
+
+def create_backend(backend_name):
+  if backend_name == "subprocess":
+    return SubprocessBackend(config.GIT_EXECUTABLE, config.DOCLIB_BASE_ABSPATH)
+  elif backend_name == "fast-import":
+    try:
+      return git_fast_import.FastImportBackend(config.GIT_EXECUTABLE, config.DOCLIB_BASE_ABSPATH)
+    except git_fast_import.Error as e:
+      print >> sys.stderr, "Warning: %s; falling back to the subprocess repository backend." % e
+      return SubprocessBackend(config.GIT_EXECUTABLE, config.DOCLIB_BASE_ABSPATH)
+  else:
+    raise UnknownBackend(backend_name)
+
+
+def get_aggregate_commit_message(commit_messages):
+  if len(commit_messages) == 1:
+    return commit_messages[0]
+
+  # The first line is the summary; then each operation is listed on its own line.
+  lines = ["Distil operations: %d changes" % len(commit_messages), ""]
+  lines.extend(["- " + msg for msg in commit_messages])
+  return "\n".join(lines)
+
+
+_DOCLIB_LOCK = DoclibLock(os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR,
+    DOCLIB_LOCK_FNAME))
+
+_COMMIT_QUEUE = CommitQueue(config.COMMIT_QUEUE_MAX_DELAY, config.COMMIT_QUEUE_MAX_OPERATIONS)
+atexit.register(_COMMIT_QUEUE.close)
+
+
+def test_subprocess_backend():
+  # The doclib is a subdir of a new Git repository, in which the user has
+  # staged a change of their own.
+  repo_abspath = tempfile.mkdtemp()
+  doclib_abspath = os.path.join(repo_abspath, "doclib")
+  def write_file(path, contents):
+    fname_abspath = os.path.join(doclib_abspath, path)
+    filesystem_utils.ensure_dir_exists(os.path.dirname(fname_abspath))
+    f = open(fname_abspath, 'w')
+    try:
+      f.write(contents)
+    finally:
+      f.close()
+  def read_git_output(git_args):
+    return subprocess.Popen([config.GIT_EXECUTABLE] + git_args, cwd=repo_abspath,
+        stdout=subprocess.PIPE).communicate()[0].splitlines()
+
+  try:
+    backend = SubprocessBackend(config.GIT_EXECUTABLE, doclib_abspath)
+    for git_args in [["init", "-q"], ["config", "user.name", "Distil"],
+        ["config", "user.email", "distil@localhost"]]:
+      subprocess.check_call([config.GIT_EXECUTABLE] + git_args, cwd=repo_abspath)
+    write_file("bibs/smith-2009/smith-2009.bib", "@article{smith-2009}\n")
+    write_file("bibs/smith-2009/_topic-tags", "new\n")
+    backend.commit(["bibs/smith-2009"], [], "created bib-entry smith-2009")
+    write_file("../thesis.tex", "\\chapter{Introduction}\n")
+    subprocess.check_call([config.GIT_EXECUTABLE, "add", "thesis.tex"], cwd=repo_abspath)
+
+    # Rename the cite-key (as 'stored_bibs.change_cite_key_and_rename_dir' does).
+    os.rename(os.path.join(doclib_abspath, "bibs/smith-2009"),
+        os.path.join(doclib_abspath, "bibs/smith-2009a"))
+    os.rename(os.path.join(doclib_abspath, "bibs/smith-2009a/smith-2009.bib"),
+        os.path.join(doclib_abspath, "bibs/smith-2009a/smith-2009a.bib"))
+    backend.commit(["bibs/smith-2009a", "bibs/smith-2009a/smith-2009a.bib"],
+        ["bibs/smith-2009", "bibs/smith-2009a/smith-2009.bib"],
+        "renamed cite-key smith-2009 to smith-2009a")
+    # Nothing has changed since the last commit.
+    backend.commit(["bibs/smith-2009a"], [], "no change")
+
+    tests = [
+      (["ls-tree", "-r", "--name-only", "HEAD"],
+          ["doclib/bibs/smith-2009a/_topic-tags", "doclib/bibs/smith-2009a/smith-2009a.bib"]),
+      (["status", "--porcelain"], ["A  thesis.tex"]),
+      (["log", "--format=%s"],
+          ["renamed cite-key smith-2009 to smith-2009a", "created bib-entry smith-2009"]),
+    ]
+    test_framework.test_and_compare(tests, read_git_output, "Subprocess backend")
+  finally:
+    shutil.rmtree(repo_abspath)
+
+
+def main():
+  test_subprocess_backend()
+
+
+if __name__ == "__main__":
+  main()
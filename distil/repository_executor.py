@@ -0,0 +1,125 @@
+# repository_executor.py: Run repository operations on a dedicated thread.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import Queue
+import sys
+import threading
+
+from tornado import stack_context
+
+import repository
+
+
+# The webserver handles every request on a single thread (the thread of the
+# Tornado IOLoop), so while a request handler is writing files, updating the
+# catalog, or committing to the repository, every other request must wait.
+#
+# Instead, the webserver starts an executor thread, and the request handlers
+# submit each operation that changes the doclib to it.  The operations are
+# executed one at a time, in the order they were submitted (so they can't
+# interfere with each other), and when an operation is complete, its callback
+# is invoked back on the IOLoop thread (to render the page).  The webserver
+# also submits the commit-queue flushes to the executor thread, so they are
+# serialised with the operations too.  Each operation holds the doclib lock
+# (see 'repository.lock_doclib'), so it is also serialised with the operations
+# of any other Distil processes (such as the other webserver processes).
+#
+# If the executor thread has not been started (for example, in a command-line
+# program), operations are simply executed immediately, on the calling thread.
+
+
+### These are the public functions of the exported API.
+
+
+def start(run_on_main_thread):
+  """Start the executor thread.
+
+  'run_on_main_thread' will be invoked as 'run_on_main_thread(func)' (on the
+  executor thread), and should arrange for 'func' to be invoked (with no
+  arguments) on the main thread; for example, 'IOLoop.add_callback'.
+  """
+  global _EXECUTOR
+  _EXECUTOR = Executor(run_on_main_thread)
+
+
+def submit(func, args, callback=None):
+  """Execute 'func(*args)' on the executor thread, then invoke 'callback(result)'
+  on the main thread (unless 'callback' is None).
+
+  If 'func' raises an exception, the exception will be re-raised on the main
+  thread instead of invoking 'callback' (in the same stack context as this
+  function was called, so a Tornado request handler will handle it).
+  """
+  if _EXECUTOR is None:
+    result = func(*args)
+    if callback is not None:
+      callback(result)
+    return
+
+  _EXECUTOR.submit(func, args, callback)
+
+
+class Executor(object):
+  def __init__(self, run_on_main_thread):
+    self.run_on_main_thread = run_on_main_thread
+    self.operations = Queue.Queue()
+
+    self.thread = threading.Thread(target=self.execute_operations, name="repository-executor")
+    # Don't let the executor thread keep the process alive.
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, func, args, callback):
+    # Capture the stack context of the caller now, because the callback will
+    # be invoked from a different thread.
+    deliver_result = stack_context.wrap(
+        lambda result, exc_info: deliver_result_or_exception(callback, result, exc_info))
+    self.operations.put((func, args, deliver_result))
+
+  def execute_operations(self):
+    while True:
+      (func, args, deliver_result) = self.operations.get()
+      try:
+        repository.lock_doclib()
+        try:
+          result = func(*args)
+        finally:
+          repository.unlock_doclib()
+        exc_info = None
+      except:
+        result = None
+        exc_info = sys.exc_info()
+
+      self.run_on_main_thread(
+          lambda deliver_result=deliver_result, result=result, exc_info=exc_info:
+              deliver_result(result, exc_info))
+
+
+### Anything below this point is not part of the exported API.
+
+
+_EXECUTOR = None
+
+
+def deliver_result_or_exception(callback, result, exc_info):
+  if exc_info is not None:
+    raise exc_info[0], exc_info[1], exc_info[2]
+  if callback is not None:
+    callback(result)
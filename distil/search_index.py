@@ -0,0 +1,525 @@
+# search_index.py: A persistent inverted index for keyword searching in stored bibs.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import bisect
+import errno
+import marshal
+import multiprocessing
+import os
+
+import bibfile_utils
+import bibgrep
+import config
+import constants
+import filesystem_utils
+import test_framework
+
+
+# The module 'bibgrep' searches by re-parsing a bib-file and then testing every
+# searchable line of every entry against every query token, so each search is
+# O(size of the corpus).  To search the bibs stored in the doclib, we instead
+# build an inverted index from the same searchable lines (as extracted by
+# 'bibgrep.extract_searchable_text'):
+#
+#  - Each cite-key is assigned a small integer "doc ID", in the order in which
+#    the cite-keys were added to the index.
+#  - Each distinct searchable line is a "term".  The terms are stored in a
+#    sorted list, so all the terms that begin with a query token (which is
+#    how 'bibgrep' matches) form a contiguous range that can be found using
+#    two binary searches.
+#  - Each term has a "posting list":  the sorted doc IDs of the cite-keys that
+#    contain that term.  Posting lists are stored compressed, as the deltas
+#    between successive doc IDs, each encoded as a variable-length integer
+#    (7 bits per byte, with the high bit set on all but the last byte).
+#
+# A query is the AND of its tokens:  for each token, the union of the posting
+# lists of all the terms that begin with the token is computed; then these
+# unions are intersected.
+#
+# A very short token (such as "co" or "20") is a prefix of a large fraction
+# of all the terms, so computing its union means decoding most of the posting
+# lists in the index.  Hence, the unions for tokens of at most
+# MAX_CACHED_PREFIX_LEN characters are cached in the index (and kept
+# up-to-date as cite-keys are added), so that these tokens stay fast no
+# matter how large the doclib becomes.
+#
+# The index is stored in the cache subdir of the doclib.  It is updated
+# incrementally whenever the mtime of the bibs subdir changes (which happens
+# whenever a cite-key dir is created, removed or renamed):  new cite-keys are
+# parsed and appended (with new doc IDs, so their IDs can simply be appended
+# to the end of each posting list), while removed cite-keys are recorded as
+# deleted (and filtered out of the results) until the index is compacted.
+#
+# Note that changes to the *contents* of existing bib-files made outside of
+# Distil are not detected; use "regenerate_command.py search-index" after
+# editing bib-files by hand.
+
+
+# Increment this whenever the stored format changes; an index file with any
+# other version will be discarded and re-built.
+FORMAT_VERSION = 1
+
+SEARCH_INDEX_FNAME = "search-index"
+
+# Compact the index (re-number the doc IDs to remove deleted cite-keys) once
+# this fraction of the doc IDs belong to deleted cite-keys.
+MAX_DELETED_FRACTION = 0.25
+
+# The unions of the posting lists of prefixes up to this length are cached.
+MAX_CACHED_PREFIX_LEN = 2
+
+# A character greater than any character that may appear in a term, used to
+# find the end of the range of terms that begin with a particular prefix.
+# (The terms have been transliterated to ASCII, so any non-ASCII will do.)
+AFTER_ALL_TERM_CHARS = u"\uffff"
+
+
+### These are the public functions of the exported API.
+
+
+def search(expr):
+  """Return a sorted list of the cite-keys that match every token in 'expr'.
+
+  A cite-key matches a token if any of its searchable lines (as extracted by
+  'bibgrep.extract_searchable_text') begins with the token.
+  """
+  query = bibgrep.build_query(expr)
+  if not query:
+    return []
+  return get_search_index().search(query)
+
+
+def regenerate_search_index():
+  """Regenerate the search index from scratch, if it somehow gets out of sync
+  (for example, after bib-files have been edited by hand).
+
+  This function is not called by any other Distil code; it's purely
+  for administrator convenience.  (Since the index is never committed
+  to the repository, there is nothing to commit afterwards.)
+
+  The bib-files are parsed in parallel, by a pool of worker processes.
+  """
+  global _SEARCH_INDEX, _SEARCH_INDEX_FILE_MTIME
+
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  bibs_subdir_mtime = os.stat(bibs_subdir_abspath).st_mtime
+  all_cite_keys = sorted(os.listdir(bibs_subdir_abspath))
+
+  pool = multiprocessing.Pool()
+  try:
+    chunksize = max(1, len(all_cite_keys) / (8 * multiprocessing.cpu_count()))
+    all_searchable_lines = pool.map(get_searchable_lines, all_cite_keys, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+  index = SearchIndex.build(zip(all_cite_keys, all_searchable_lines))
+  index.bibs_subdir_mtime = bibs_subdir_mtime
+
+  _SEARCH_INDEX_FILE_MTIME = index.save(get_search_index_fname_abspath())
+  _SEARCH_INDEX = index
+  return index.get_num_cite_keys()
+
+
+class SearchIndex(object):
+  """An inverted index from searchable terms to cite-keys."""
+
+  def __init__(self):
+    # The cite-key of each doc ID (or None, if that cite-key has been deleted).
+    self.cite_keys = []
+    self.doc_ids = {}
+    self.num_deleted = 0
+
+    # The sorted terms, and the (compressed) posting list of each term.
+    self.terms = []
+    self.postings = []
+
+    # The mtime of the bibs subdir when the index was last brought up-to-date.
+    self.bibs_subdir_mtime = None
+
+    # A cache of the set of doc IDs for each short prefix that has been looked
+    # up.  (Doc IDs of deleted cite-keys are not removed from these sets, since
+    # they are filtered out of the search results anyway.)
+    self.prefix_doc_ids = {}
+
+  @classmethod
+  def build(cls, cite_keys_and_searchable_lines):
+    """Build a new index from a sequence of (cite_key, searchable_lines) pairs.
+
+    This is much faster than calling 'add' for each cite-key, since each
+    posting list is encoded only once.
+    """
+    index = cls()
+    doc_ids_for_terms = {}
+    for cite_key, searchable_lines in cite_keys_and_searchable_lines:
+      if cite_key in index.doc_ids:
+        index.remove(cite_key)
+      doc_id = len(index.cite_keys)
+      index.cite_keys.append(cite_key)
+      index.doc_ids[cite_key] = doc_id
+      for term in set(searchable_lines):
+        doc_ids_for_terms.setdefault(term, []).append(doc_id)
+
+    index.terms = sorted(doc_ids_for_terms.keys())
+    index.postings = [encode_postings(doc_ids_for_terms[t]) for t in index.terms]
+    return index
+
+  def get_num_cite_keys(self):
+    return len(self.doc_ids)
+
+  def add(self, cite_key, searchable_lines):
+    """Add 'cite_key' with the (not necessarily distinct) 'searchable_lines'."""
+    if cite_key in self.doc_ids:
+      self.remove(cite_key)
+
+    # Since every new doc ID is larger than all the existing doc IDs, it can
+    # simply be appended to the end of the posting list of each term.
+    doc_id = len(self.cite_keys)
+    self.cite_keys.append(cite_key)
+    self.doc_ids[cite_key] = doc_id
+
+    terms = self.terms
+    postings = self.postings
+    prefix_doc_ids = self.prefix_doc_ids
+    for term in set(searchable_lines):
+      for prefix_len in xrange(1, MAX_CACHED_PREFIX_LEN + 1):
+        if prefix_doc_ids.has_key(term[:prefix_len]):
+          prefix_doc_ids[term[:prefix_len]].add(doc_id)
+
+      i = bisect.bisect_left(terms, term)
+      if i < len(terms) and terms[i] == term:
+        posting_ids = decode_postings(postings[i])
+        posting_ids.append(doc_id)
+        postings[i] = encode_postings(posting_ids)
+      else:
+        terms.insert(i, term)
+        postings.insert(i, encode_postings([doc_id]))
+
+  def remove(self, cite_key):
+    """Mark 'cite_key' as deleted; its doc ID will be removed upon compaction."""
+    doc_id = self.doc_ids.pop(cite_key)
+    self.cite_keys[doc_id] = None
+    self.num_deleted += 1
+
+  def needs_compaction(self):
+    return (self.num_deleted > MAX_DELETED_FRACTION * len(self.cite_keys))
+
+  def compact(self):
+    """Re-number the doc IDs so that no doc IDs belong to deleted cite-keys."""
+    new_doc_ids = {}
+    new_cite_keys = []
+    for old_doc_id, cite_key in enumerate(self.cite_keys):
+      if cite_key is not None:
+        new_doc_ids[old_doc_id] = len(new_cite_keys)
+        new_cite_keys.append(cite_key)
+
+    new_terms = []
+    new_postings = []
+    for term, encoded in zip(self.terms, self.postings):
+      posting_ids = [new_doc_ids[d] for d in decode_postings(encoded) if d in new_doc_ids]
+      if posting_ids:
+        new_terms.append(term)
+        new_postings.append(encode_postings(posting_ids))
+
+    self.cite_keys = new_cite_keys
+    self.doc_ids = dict((ck, d) for d, ck in enumerate(new_cite_keys))
+    self.num_deleted = 0
+    self.terms = new_terms
+    self.postings = new_postings
+    self.prefix_doc_ids = {}
+
+  def get_doc_ids_for_prefix(self, prefix):
+    """Return the set of doc IDs of the terms that begin with 'prefix'.
+
+    The returned set must not be modified by the caller (it may be cached).
+    """
+    if len(prefix) <= MAX_CACHED_PREFIX_LEN:
+      doc_ids = self.prefix_doc_ids.get(prefix)
+      if doc_ids is None:
+        doc_ids = self.compute_doc_ids_for_prefix(prefix)
+        self.prefix_doc_ids[prefix] = doc_ids
+      return doc_ids
+
+    return self.compute_doc_ids_for_prefix(prefix)
+
+  def compute_doc_ids_for_prefix(self, prefix):
+    terms = self.terms
+    start = bisect.bisect_left(terms, prefix)
+    end = bisect.bisect_left(terms, prefix + AFTER_ALL_TERM_CHARS, start)
+
+    doc_ids = set()
+    for encoded in self.postings[start:end]:
+      doc_ids.update(decode_postings(encoded))
+    return doc_ids
+
+  def search(self, query):
+    """Return a sorted list of the cite-keys that match every token in 'query'.
+
+    'query' is a list of tokens, as returned by 'bibgrep.build_query'.
+    """
+    cite_keys = self.cite_keys
+    return sorted(cite_keys[d] for d in self.search_doc_ids(query))
+
+  def search_doc_ids(self, query):
+    """Return a sorted list of the doc IDs that match every token in 'query'.
+
+    Since doc IDs are assigned in the order in which the cite-keys were added,
+    this list is in the same order as the cite-keys were added.
+    """
+    matching_doc_ids = None
+    # Look up the longest (and hence, probably the most selective) tokens first,
+    # so the intersection shrinks as quickly as possible.
+    for token in sorted(set(query), key=len, reverse=True):
+      doc_ids = self.get_doc_ids_for_prefix(token)
+      if matching_doc_ids is None:
+        matching_doc_ids = doc_ids
+      else:
+        matching_doc_ids = matching_doc_ids & doc_ids
+      if not matching_doc_ids:
+        return []
+
+    cite_keys = self.cite_keys
+    return sorted(d for d in matching_doc_ids if cite_keys[d] is not None)
+
+  def save(self, fname_abspath):
+    """Save the index to 'fname_abspath', and return the mtime of the saved file."""
+    contents = {
+      "version": FORMAT_VERSION,
+      "cite-keys": self.cite_keys,
+      "terms": self.terms,
+      "postings": self.postings,
+      "bibs-subdir-mtime": self.bibs_subdir_mtime,
+    }
+
+    # Write to a temporary file and then rename it over the old file, so that
+    # other processes never see a partially-written index.
+    tmp_fname_abspath = "%s.tmp.%d" % (fname_abspath, os.getpid())
+    f = open(tmp_fname_abspath, 'wb')
+    try:
+      marshal.dump(contents, f)
+    finally:
+      f.close()
+    os.rename(tmp_fname_abspath, fname_abspath)
+
+    return os.stat(fname_abspath).st_mtime
+
+  @classmethod
+  def load(cls, fname_abspath):
+    """Load an index from 'fname_abspath'.
+
+    If the file does not exist, or was saved in a different format version,
+    None will be returned.
+    """
+    try:
+      f = open(fname_abspath, 'rb')
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+    try:
+      contents = marshal.load(f)
+    finally:
+      f.close()
+
+    if contents.get("version") != FORMAT_VERSION:
+      return None
+
+    index = cls()
+    index.cite_keys = contents["cite-keys"]
+    index.doc_ids = dict((ck, d) for d, ck in enumerate(index.cite_keys) if ck is not None)
+    index.num_deleted = len(index.cite_keys) - len(index.doc_ids)
+    index.terms = contents["terms"]
+    index.postings = contents["postings"]
+    index.bibs_subdir_mtime = contents["bibs-subdir-mtime"]
+    return index
+
+
+### Anything below this point is not part of the exported API.
+
+
+# The index most recently loaded (or updated) by this process, and the mtime
+# of the index file when it was loaded (or saved), so we can detect whether
+# another process has saved a newer index in the meantime.
+_SEARCH_INDEX = None
+_SEARCH_INDEX_FILE_MTIME = None
+
+
+def get_search_index_fname_abspath():
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  return os.path.join(cache_dir_abspath, SEARCH_INDEX_FNAME)
+
+
+def get_search_index():
+  """Return an up-to-date search index, loading or updating it as necessary."""
+  global _SEARCH_INDEX, _SEARCH_INDEX_FILE_MTIME
+
+  index_fname_abspath = get_search_index_fname_abspath()
+  try:
+    index_file_mtime = os.stat(index_fname_abspath).st_mtime
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    index_file_mtime = None
+
+  if _SEARCH_INDEX is None or index_file_mtime != _SEARCH_INDEX_FILE_MTIME:
+    _SEARCH_INDEX = SearchIndex.load(index_fname_abspath) or SearchIndex()
+    _SEARCH_INDEX_FILE_MTIME = index_file_mtime
+
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  bibs_subdir_mtime = os.stat(bibs_subdir_abspath).st_mtime
+  if bibs_subdir_mtime != _SEARCH_INDEX.bibs_subdir_mtime:
+    # Note that we obtained the mtime *before* listing the directory, so if
+    # the directory changes while we're updating, we'll update again next time.
+    update_search_index(_SEARCH_INDEX, os.listdir(bibs_subdir_abspath))
+    _SEARCH_INDEX.bibs_subdir_mtime = bibs_subdir_mtime
+    _SEARCH_INDEX_FILE_MTIME = _SEARCH_INDEX.save(index_fname_abspath)
+
+  return _SEARCH_INDEX
+
+
+def update_search_index(index, all_cite_keys):
+  """Add any cite-keys in 'all_cite_keys' that are not yet in 'index', and remove
+  any cite-keys in 'index' that are not in 'all_cite_keys'.
+  """
+  all_cite_keys = set(all_cite_keys)
+  indexed_cite_keys = set(index.doc_ids.keys())
+
+  for cite_key in indexed_cite_keys - all_cite_keys:
+    index.remove(cite_key)
+  for cite_key in sorted(all_cite_keys - indexed_cite_keys):
+    index.add(cite_key, get_searchable_lines(cite_key))
+
+  if index.needs_compaction():
+    index.compact()
+
+
+def get_searchable_lines(cite_key):
+  """Return the searchable lines of the bib-entry stored for 'cite_key'.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'regenerate_search_index'.
+  """
+  bib_fname_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR,
+      cite_key, cite_key + ".bib")
+  if not os.path.exists(bib_fname_abspath):
+    return [cite_key]
+
+  searchable_lines = [cite_key]
+  for entry in bibfile_utils.read_entries_from_file(bib_fname_abspath, False):
+    # The parser returns an error string (rather than a dictionary) for any
+    # entry that it could not parse.
+    if isinstance(entry, dict):
+      searchable_lines.extend(bibgrep.extract_searchable_text(entry)[1])
+  return searchable_lines
+
+
+def encode_postings(doc_ids):
+  """Encode the sorted list of 'doc_ids' as a string of variable-length deltas."""
+  encoded = []
+  prev_doc_id = 0
+  for doc_id in doc_ids:
+    delta = doc_id - prev_doc_id
+    prev_doc_id = doc_id
+    while delta >= 0x80:
+      encoded.append(chr((delta & 0x7f) | 0x80))
+      delta >>= 7
+    encoded.append(chr(delta))
+  return "".join(encoded)
+
+
+def decode_postings(encoded):
+  """Decode a string of variable-length deltas into a sorted list of doc IDs."""
+  doc_ids = []
+  doc_id = 0
+  delta = 0
+  shift = 0
+  for c in encoded:
+    b = ord(c)
+    if b & 0x80:
+      delta |= (b & 0x7f) << shift
+      shift += 7
+    else:
+      doc_id += delta | (b << shift)
+      doc_ids.append(doc_id)
+      delta = 0
+      shift = 0
+  return doc_ids
+
+
+def test_encode_decode_postings():
+  def encode_then_decode(doc_ids):
+    return decode_postings(encode_postings(doc_ids))
+
+  tests = [
+    ([], []),
+    ([0], [0]),
+    ([0, 1, 2], [0, 1, 2]),
+    ([127, 128, 129], [127, 128, 129]),
+    ([5, 300, 16384, 2097152, 2097153], [5, 300, 16384, 2097152, 2097153]),
+  ]
+  test_framework.test_and_compare(tests, encode_then_decode, "Encode/decode postings")
+
+
+def test_search():
+  index = SearchIndex()
+  index.add("curran-2002", ["curran-2002", "curran", "scaling", "context", "space", "2002"])
+  index.add("curran-2004", ["curran-2004", "curran", "from", "distributional", "2004"])
+  index.add("manning-1999", ["manning-1999", "manning", "foundations", "statistical", "1999"])
+  index.remove("curran-2004")
+  index.add("curran-2004", ["curran-2004", "curran", "from", "distributional", "2004"])
+
+  tests = [
+    (["curran"], ["curran-2002", "curran-2004"]),
+    (["cur", "200"], ["curran-2002", "curran-2004"]),
+    (["cur", "2002"], ["curran-2002"]),
+    (["curran", "1999"], []),
+    (["stat", "found"], ["manning-1999"]),
+    (["zzz"], []),
+  ]
+  test_framework.test_and_compare(tests, index.search, "Search")
+
+  # Adding a cite-key must update the cached unions of short prefixes.
+  index.search(["cu"])
+  index.add("curran-2006", ["curran-2006", "curran", "2006"])
+  test_framework.test_and_compare([(["cu"], ["curran-2002", "curran-2004", "curran-2006"])],
+      index.search, "Search with cached prefix")
+  index.remove("curran-2006")
+
+  index.compact()
+  test_framework.test_and_compare(tests, index.search, "Search after compaction")
+
+  index = SearchIndex.build([
+    ("curran-2002", ["curran-2002", "curran", "scaling", "context", "space", "2002"]),
+    ("curran-2004", ["curran-2004", "curran", "from", "distributional", "2004"]),
+    ("manning-1999", ["manning-1999", "manning", "foundations", "statistical", "1999"]),
+  ])
+  test_framework.test_and_compare(tests, index.search, "Search after bulk build")
+
+
+def main():
+  test_encode_decode_postings()
+  test_search()
+
+
+if __name__ == "__main__":
+  main()
@@ -22,13 +22,59 @@
 
 import os
 import errno
+import codecs
+import hashlib
+import json
+import multiprocessing
+import shutil
 
+from bibliograph_parsing_improved import bibtex
+
+import backlinks
 import bibfile_utils
+import catalog
 import config
 import constants
 import filesystem_utils
 import repository
 import topic_tag_file_io
+import unicode_string_utils
+
+
+# The topic tags of a newly-stored bib-entry.
+NEW_BIB_TOPIC_TAGS = "new unread"
+
+# The number of bib-entries handed to a worker process at a time, in a bulk
+# import (to amortise the inter-process communication overhead).
+BULK_IMPORT_CHUNKSIZE = 50
+
+# Obtaining the attributes of a cite-key (title, authors, year, doc filename,
+# date-added) used to involve parsing the bib-file (through the whole
+# BibtexParser preprocessing pipeline) and listing the cite-key dir to find
+# the doc filename.
+#
+# Instead, each cite-key dir contains a small metadata file (see
+# 'constants.DOC_ATTRS_FNAME'), written whenever a bib-entry is stored or its
+# cite-key is changed, which contains these attributes, so they can be obtained
+# by reading a single small file.
+#
+# The metadata file also contains the SHA-1 hash of the bib-file from which the
+# attributes were derived, and the name and size of each file in the cite-key
+# dir that might be the doc, so if the bib-file has been edited by hand
+# (outside of Distil), or a doc has been added, removed or replaced, the
+# metadata file is ignored, and the attributes are derived from the bib-file
+# and the doc once again.  Checking these would involve listing the cite-key
+# dir and hashing the bib-file, so it's only done the first time the metadata
+# file is read (in each process), or after the mtime of the cite-key dir, the
+# bib-file, the doc or the metadata file itself has changed; the mtimes (and
+# sizes) at which the metadata file was last checked are remembered in memory.
+#
+# The metadata file is committed along with the rest of the cite-key dir (so it
+# contains no mtimes, which would differ in every clone of the repository).
+# It's written in JSON (rather than the ConfigParser format of the ".metadata"
+# files of the attachments), since the titles and author names may contain any
+# characters.  The metadata files of an existing doclib can be written by
+# 'regenerate_metadata'.
 
 
 ### Errors that may be thrown by this module.
@@ -104,15 +150,118 @@ def store_new_bib(bib_fname, doc_fname=None, abstract_fname=None):
         constants.ABSTRACT_FNAME)
 
   filesystem_utils.add_datestamp(cite_key_dir_abspath)
+  write_metadata(cite_key)
+  catalog.update_cite_key(cite_key)
   repository.add_and_commit_new_cite_key_dir(cite_key)
 
   # Do we want to merge the commit in the following function with the commit
   # in 'add_and_commit_new_cite_key_dir'?
-  topic_tag_file_io.update_topic_tags_for_cite_key(cite_key, [], "new unread")
+  topic_tag_file_io.update_topic_tags_for_cite_key(cite_key, [], NEW_BIB_TOPIC_TAGS)
 
   return (cite_key, cite_key_dir_abspath)
 
 
+def store_new_bibs_in_bulk(bib_fname, num_processes=None):
+  """Store each of the (possibly very many) bib-entries in the bib-file
+  'bib_fname' in the doclib, in a single commit.
+
+  This is intended for importing a large export from a reference manager:
+  Rather than parsing the whole bib-file at once, the entries are streamed out
+  of it, and then parsed, normalised and written (each in its own cite-key dir)
+  by a pool of 'num_processes' worker processes (by default, one per CPU).
+  The cite-key collisions are resolved by this process, as the coordinator:
+   - an entry whose suggested cite-key is already in the doclib is assumed to
+     have been imported already, so it is skipped;
+   - if several entries in 'bib_fname' have the same suggested cite-key, the
+     second is given the suffix "-2", the third "-3", and so on.
+
+  Unlike 'store_new_bib', the bib-file 'bib_fname' is not moved into the doclib.
+  The '@String' macros are expanded, and the comments are removed, in each of
+  the bib-entries that are stored.
+
+  Returns a pair (cite_keys, skipped), where 'cite_keys' is a list of the
+  cite-keys of the stored bib-entries, and 'skipped' is a list of pairs
+  (entry_num, reason) describing the entries that were not stored (numbered
+  from 1, in the order they appear in 'bib_fname').
+  """
+
+  if not os.path.exists(bib_fname):
+    raise filesystem_utils.FileNotFound(bib_fname)
+
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  existing_cite_keys = set(os.listdir(bibs_subdir_abspath))
+  assigned_cite_keys = set(existing_cite_keys)
+
+  pool = multiprocessing.Pool(num_processes)
+  f = unicode_string_utils.open_file_unicode(bib_fname)
+  try:
+    # The worker processes parse the entries and suggest cite-keys for them,
+    # as the entries are streamed out of the bib-file...
+    entry_texts = enumerate(bibtex.iter_entry_texts(f), 1)
+    suggestions = pool.imap(suggest_cite_key_for_entry_text, entry_texts,
+        BULK_IMPORT_CHUNKSIZE)
+
+    # ... while this process resolves the cite-key collisions, in order.
+    entries_to_store = []
+    skipped = []
+    num_cite_keys_suggested = {}
+    for (entry_num, entry_text, cite_key, error) in suggestions:
+      if error is not None:
+        skipped.append((entry_num, error))
+        continue
+      if cite_key in existing_cite_keys:
+        skipped.append((entry_num, str(DirectoryAlreadyExistsInBibs(cite_key))))
+        continue
+
+      suggested_cite_key = cite_key
+      num_suggested = num_cite_keys_suggested.get(suggested_cite_key, 1)
+      while cite_key in assigned_cite_keys:
+        num_suggested += 1
+        cite_key = "%s-%d" % (suggested_cite_key, num_suggested)
+      num_cite_keys_suggested[suggested_cite_key] = num_suggested
+
+      assigned_cite_keys.add(cite_key)
+      entries_to_store.append((entry_num, cite_key, entry_text))
+
+    # Then the worker processes write the cite-key dirs, and derive the
+    # catalog rows for them.
+    results = pool.map(store_entry_text_in_new_cite_key_dir,
+        entries_to_store, BULK_IMPORT_CHUNKSIZE)
+  finally:
+    f.close()
+    pool.close()
+    pool.join()
+
+  # An entry that could not be stored is skipped (and its cite-key dir has
+  # been removed by the worker process), but the other entries are still
+  # indexed and committed, so that no cite-key dirs are left behind in the
+  # doclib, uncommitted.
+  cite_keys = []
+  catalog_rows = []
+  for (entry_num, cite_key, catalog_row, error) in results:
+    if error is not None:
+      skipped.append((entry_num, error))
+      continue
+    cite_keys.append(cite_key)
+    catalog_rows.append(catalog_row)
+  skipped.sort()
+
+  if not cite_keys:
+    return (cite_keys, skipped)
+
+  index_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.TOPIC_TAG_INDEX_SUBDIR)
+  filesystem_utils.ensure_dir_exists(index_dir_abspath)
+  topic_tag_file_io.add_cite_keys_to_topic_tag_index(cite_keys,
+      get_new_bib_topic_tags(), index_dir_abspath)
+  catalog.insert_rows(catalog_rows)
+
+  repository.add_and_commit_new_cite_key_dirs(cite_keys, [index_dir_abspath],
+      "created %d bib-entries from %s" % (len(cite_keys), os.path.basename(bib_fname)))
+
+  return (cite_keys, skipped)
+
+
 def change_cite_key_and_rename_dir(curr_cite_key, new_cite_key):
   """Change 'curr_cite_key' to 'new_cite_key', and rename the cite-key directory
   and the files within it accordingly.
@@ -149,12 +298,15 @@ def change_cite_key_and_rename_dir(curr_cite_key, new_cite_key):
   bibfile_utils.replace_cite_key_in_file(new_cite_key, new_bib_fname_abspath)
 
   doc_attrs = get_doc_attrs(new_cite_key, curr_cite_key)
-  if doc_attrs:
+  if doc_attrs.has_key("doc-name"):
     # There is a doc in this cite-key dir.
     curr_doc_fname_abspath = os.path.join(new_cite_key_dir_abspath, doc_attrs["doc-name"])
     new_doc_fname_abspath = os.path.join(new_cite_key_dir_abspath, new_cite_key + doc_attrs["doc-suffix"])
     repository.move(curr_doc_fname_abspath, new_doc_fname_abspath)
 
+  # The cite-key in the bib-file (and the doc filename) have changed.
+  write_metadata(new_cite_key)
+
   topic_tags_fname_abspath = os.path.join(new_cite_key_dir_abspath, constants.TOPIC_TAGS_FNAME)
   if os.path.exists(topic_tags_fname_abspath):
     # There are topic tags, so we need to update the indices.
@@ -170,6 +322,10 @@ def change_cite_key_and_rename_dir(curr_cite_key, new_cite_key):
 
     dirs_modified_abspaths.append(index_dir_abspath)
 
+  catalog.remove_cite_key(curr_cite_key)
+  catalog.update_cite_key(new_cite_key)
+  backlinks.rename_referrer((backlinks.NOTES, curr_cite_key), (backlinks.NOTES, new_cite_key))
+
   repository.commit(dirs_modified_abspaths,
       "Renamed cite-key '%s' to '%s'" % (curr_cite_key, new_cite_key))
 
@@ -188,14 +344,97 @@ def get_doc_attrs(cite_key, doc_fname_startswith=None):
   should be supplied is when the doc filename does *not* begin with 'cite_key',
   which should only be the case when invoked by 'change_cite_key_and_rename_dir',
   mid-way through the file-renaming process.)
-  """
 
+  The attributes are read from the metadata file of the cite-key, unless it's
+  missing or out of date (see 'constants.DOC_ATTRS_FNAME'), in which case they're
+  derived from the bib-file and the doc.
+  """
+  cite_key_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR, cite_key)
   if not doc_fname_startswith:
+    doc_attrs = read_metadata(cite_key_dir_abspath, cite_key)
+    if doc_attrs is not None:
+      return doc_attrs
     doc_fname_startswith = cite_key
 
-  doc_attrs = {}
+  return derive_doc_attrs(cite_key_dir_abspath, cite_key, doc_fname_startswith)
 
+
+def write_metadata(cite_key):
+  """Write the metadata file of 'cite_key' (see 'constants.DOC_ATTRS_FNAME'), deriving the
+  attributes from the bib-file and the doc in the cite-key dir.
+
+  The metadata file is not added to the repository; the caller should commit
+  the cite-key dir afterwards.
+
+  Returns True if the metadata file was created or changed.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'regenerate_metadata'.
+  """
   cite_key_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR, cite_key)
+  doc_attrs = derive_doc_attrs(cite_key_dir_abspath, cite_key, cite_key)
+
+  metadata = dict(doc_attrs)
+  # The doc type is derived from the doc suffix when the metadata is read.
+  metadata.pop("doc-type", None)
+  metadata["bib-sha1"] = get_bib_sha1(cite_key_dir_abspath, cite_key)
+  metadata["doc-candidates"] = get_doc_candidates(cite_key_dir_abspath, cite_key)
+  metadata_text = json.dumps(metadata, indent=1, separators=(",", ": "), sort_keys=True) + "\n"
+
+  metadata_fname_abspath = os.path.join(cite_key_dir_abspath, constants.DOC_ATTRS_FNAME)
+  if os.path.exists(metadata_fname_abspath) and \
+      open(metadata_fname_abspath).read() == metadata_text:
+    return False
+
+  f = open(metadata_fname_abspath, 'w')
+  try:
+    f.write(metadata_text)
+  finally:
+    f.close()
+  # The metadata file has just been derived, so it doesn't need to be checked
+  # when it's next read.
+  _CHECKED_STAMPS[cite_key_dir_abspath] = get_stamp(cite_key_dir_abspath, cite_key,
+      doc_attrs.get("doc-name"), os.stat(metadata_fname_abspath))
+  return True
+
+
+def regenerate_metadata(num_processes=None):
+  """Write the metadata file of every cite-key, if it's missing or out of date
+  (for example, in a doclib that was created before the metadata files existed).
+
+  This function is not called by any other Distil code; it's purely
+  for administrator convenience.  You'll also need to commit the changes
+  to the repository manually after invoking this function.
+
+  The cite-keys are processed in parallel, by a pool of 'num_processes' worker
+  processes (by default, one per CPU).
+
+  Returns a pair (number of cite-keys, number of metadata files written).
+  """
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  filesystem_utils.ensure_dir_exists(bibs_subdir_abspath)
+  all_cite_keys = os.listdir(bibs_subdir_abspath)
+
+  pool = multiprocessing.Pool(num_processes)
+  try:
+    chunksize = max(1, len(all_cite_keys) / (8 * multiprocessing.cpu_count()))
+    written = pool.map(write_metadata, all_cite_keys, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+  return (len(all_cite_keys), written.count(True))
+
+
+### Anything below this point is not part of the exported API.
+
+
+def derive_doc_attrs(cite_key_dir_abspath, cite_key, doc_fname_startswith):
+  """Derive the attributes of 'cite_key' (as returned by 'get_doc_attrs') from
+  the bib-file and the doc in the cite-key dir.
+  """
+  doc_attrs = {}
+
   if not os.path.exists(cite_key_dir_abspath):
     raise filesystem_utils.DirectoryNotFound(cite_key_dir_abspath)
 
@@ -212,12 +451,7 @@ def get_doc_attrs(cite_key, doc_fname_startswith=None):
   # We don't know what the filename of the document will be, only that it will
   # begin with the cite-key, and not end with ".bib".  Hence, we will traverse
   # the directory, looking for any files that match these criteria.
-  # FIXME:  This seems inefficient.  Would it be better to store the suffix in
-  # a per-cite-key-dir ".meta" file instead?  Is it faster to parse a simple
-  # config file or traverse a directory each time?
-  matched_doc_fname = [fname
-      for fname in os.listdir(cite_key_dir_abspath)
-      if fname.startswith(doc_fname_startswith) and fname[-4:] != ".bib"]
+  matched_doc_fname = list_doc_candidate_fnames(cite_key_dir_abspath, doc_fname_startswith)
   if matched_doc_fname:
     doc_fname = matched_doc_fname[0]
     doc_attrs["doc-name"] = doc_fname
@@ -225,6 +459,7 @@ def get_doc_attrs(cite_key, doc_fname_startswith=None):
     suffix = filesystem_utils.get_suffix(doc_fname)
     doc_attrs["doc-suffix"] = suffix
     doc_attrs["doc-type"] = suffix[1:].upper()
+    doc_attrs["doc-size"] = os.path.getsize(os.path.join(cite_key_dir_abspath, doc_fname))
 
   date_added = open(os.path.join(cite_key_dir_abspath, ".date-added.txt")).read().split()[0]
   doc_attrs["date-added"] = date_added
@@ -232,7 +467,189 @@ def get_doc_attrs(cite_key, doc_fname_startswith=None):
   return doc_attrs
 
 
-### Anything below this point is not part of the exported API.
+def read_metadata(cite_key_dir_abspath, cite_key):
+  """Return the attributes of 'cite_key' from its metadata file, or None if the
+  metadata file doesn't exist, or is out of date.
+  """
+  try:
+    f = open(os.path.join(cite_key_dir_abspath, constants.DOC_ATTRS_FNAME))
+  except IOError as e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+  try:
+    metadata_st = os.fstat(f.fileno())
+    metadata = json.load(f)
+  except ValueError:
+    # The metadata file is corrupt.
+    return None
+  finally:
+    f.close()
+
+  if not isinstance(metadata, dict):
+    # The metadata file is corrupt.
+    return None
+  try:
+    bib_sha1 = metadata.pop("bib-sha1")
+    doc_candidates = metadata.pop("doc-candidates")
+  except KeyError:
+    # The metadata file was written by an older version of Distil.
+    return None
+
+  # The JSON strings are Unicode, but the attributes derived from the bib-file
+  # are UTF-8-encoded strings.
+  doc_attrs = {}
+  for key, value in metadata.items():
+    if isinstance(value, unicode):
+      value = value.encode("utf8")
+    elif isinstance(value, list):
+      value = [v.encode("utf8") for v in value]
+    doc_attrs[key.encode("utf8")] = value
+
+  try:
+    stamp = get_stamp(cite_key_dir_abspath, cite_key, doc_attrs.get("doc-name"), metadata_st)
+    if _CHECKED_STAMPS.get(cite_key_dir_abspath) != stamp:
+      if doc_candidates != get_doc_candidates(cite_key_dir_abspath, cite_key):
+        # A doc has been added, removed or replaced since the metadata file was
+        # written.  (The JSON strings are Unicode, but the filenames aren't;
+        # this comparison is fine for the ASCII filenames of docs, and merely
+        # causes the attributes to be derived again otherwise.)
+        return None
+      if bib_sha1 != get_bib_sha1(cite_key_dir_abspath, cite_key):
+        # The bib-file has been edited since the metadata file was written.
+        return None
+      _CHECKED_STAMPS[cite_key_dir_abspath] = stamp
+  except EnvironmentError:
+    return None
+
+  if doc_attrs.has_key("doc-suffix"):
+    doc_attrs["doc-type"] = doc_attrs["doc-suffix"][1:].upper()
+  return doc_attrs
+
+
+def list_doc_candidate_fnames(cite_key_dir_abspath, doc_fname_startswith):
+  # The files that might be the doc (see 'derive_doc_attrs'), in sorted order.
+  return sorted([fname
+      for fname in os.listdir(cite_key_dir_abspath)
+      if fname.startswith(doc_fname_startswith) and fname[-4:] != ".bib"])
+
+
+def get_doc_candidates(cite_key_dir_abspath, cite_key):
+  """Return a sorted list of [fname, size] of each file in the cite-key dir
+  that might be the doc.
+
+  The doc attributes depend only upon the filename and size of the doc, so this
+  list (unlike the mtimes of the files) is enough to detect when a doc has been
+  added, removed or replaced, and it remains valid in a fresh clone of the
+  repository.
+  """
+  return [[fname, os.path.getsize(os.path.join(cite_key_dir_abspath, fname))]
+      for fname in list_doc_candidate_fnames(cite_key_dir_abspath, cite_key)]
+
+
+def get_bib_sha1(cite_key_dir_abspath, cite_key):
+  f = open(os.path.join(cite_key_dir_abspath, cite_key + ".bib"), 'rb')
+  try:
+    return hashlib.sha1(f.read()).hexdigest()
+  finally:
+    f.close()
+
+
+def get_stamp(cite_key_dir_abspath, cite_key, doc_fname, metadata_st):
+  """Return the mtimes (and sizes) of the cite-key dir, the bib-file, the doc
+  'doc_fname' (if any) and the metadata file (whose stat is 'metadata_st').
+
+  Adding, removing or renaming a doc changes the mtime of the cite-key dir;
+  replacing the bib-file or the doc in place changes its own mtime.
+  """
+  def get_size_and_mtime(st):
+    return (st.st_size, st.st_mtime)
+  bib_st = os.stat(os.path.join(cite_key_dir_abspath, cite_key + ".bib"))
+  if doc_fname:
+    doc_stamp = get_size_and_mtime(os.stat(os.path.join(cite_key_dir_abspath, doc_fname)))
+  else:
+    doc_stamp = None
+  return (os.stat(cite_key_dir_abspath).st_mtime, get_size_and_mtime(bib_st), doc_stamp,
+      get_size_and_mtime(metadata_st))
+
+
+def suggest_cite_key_for_entry_text(entry_num_and_text):
+  """Parse the text of a single bib-entry, and suggest a cite-key for it.
+
+  Returns a tuple (entry_num, entry_text, cite_key, error), where 'error' is
+  None if the entry could be parsed.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'store_new_bibs_in_bulk'.
+  """
+  (entry_num, entry_text) = entry_num_and_text
+  entries = bibfile_utils.parse_entries_from_string(entry_text,
+      unicode_string_utils.contains_non_ascii_unicode(entry_text))
+  if entries is None:
+    return (entry_num, None, None, "invalid BibTeX format")
+  if len(entries) != 1 or not isinstance(entries[0], dict):
+    # The BibTeX parser returns a string to describe a malformed entry.
+    return (entry_num, None, None, "unable to parse entry")
+
+  try:
+    cite_key = bibfile_utils.suggest_cite_key(entries[0])
+  except bibfile_utils.Error as e:
+    return (entry_num, None, None, str(e))
+
+  return (entry_num, entry_text, cite_key, None)
+
+
+def store_entry_text_in_new_cite_key_dir(entry_num_and_cite_key_and_text):
+  """Store the text of a single bib-entry in a new cite-key dir, but don't add
+  it to the repository.
+
+  Returns a tuple (entry_num, cite_key, catalog_row, error), where 'error' is
+  None if the entry was stored.  If the entry could not be stored, the new
+  cite-key dir (if it was created) is removed again.
+
+  This is a module-level function so that it can be invoked by the worker
+  processes in 'store_new_bibs_in_bulk'.
+  """
+  (entry_num, cite_key, entry_text) = entry_num_and_cite_key_and_text
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+  cite_key_dir_abspath = os.path.join(bibs_subdir_abspath, cite_key)
+  try:
+    os.mkdir(cite_key_dir_abspath)
+  except EnvironmentError as e:
+    # If the dir already exists, it's not ours to remove.
+    return (entry_num, cite_key, None, str(e))
+
+  try:
+    entry_text = bibfile_utils.replace_cite_key_in_string(cite_key, entry_text, cite_key)
+    bib_fname_abspath = os.path.join(cite_key_dir_abspath, cite_key + ".bib")
+    # Write the entry in UTF-8 (without a byte-order mark), in case it contains
+    # any non-ASCII code-points.
+    f = codecs.open(bib_fname_abspath, 'w', encoding="utf-8")
+    try:
+      f.write(entry_text + "\n")
+    finally:
+      f.close()
+
+    filesystem_utils.add_datestamp(cite_key_dir_abspath)
+    write_metadata(cite_key)
+    topic_tags_fname_abspath = os.path.join(cite_key_dir_abspath, constants.TOPIC_TAGS_FNAME)
+    topic_tag_file_io.write_topic_tags(topic_tags_fname_abspath,
+        list(get_new_bib_topic_tags()), update_repository=False)
+
+    catalog_row = catalog.derive_row_for_cite_key(cite_key)
+  except Exception as e:
+    # Any exception raised in a worker process would abort the whole import
+    # (leaving the cite-key dirs stored by the other workers uncommitted), so
+    # this entry is reported as skipped instead.
+    shutil.rmtree(cite_key_dir_abspath, ignore_errors=True)
+    return (entry_num, cite_key, None, "unable to store entry as '%s': %s" % (cite_key, e))
+
+  return (entry_num, cite_key, catalog_row, None)
+
+
+def get_new_bib_topic_tags():
+  return set(map(topic_tag_file_io.sanitize_tag,
+      topic_tag_file_io.split_at_whitespace_and_commas(NEW_BIB_TOPIC_TAGS)))
 
 
 def get_one_cite_key(bib_fname):
@@ -249,3 +666,8 @@ def get_one_cite_key(bib_fname):
   # dictionary of BibTeX entries.
   return keys_and_citations[0][0]
 
+
+
+# Maps the abspath of each cite-key dir to the stamp (see 'get_stamp') at which
+# its metadata file was last found to be up to date.
+_CHECKED_STAMPS = {}
@@ -18,62 +18,112 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 
+import errno
 import itertools
+import multiprocessing.pool
 import os
 import shutil
 import string
+import tempfile
 from collections import defaultdict
 
+import catalog
 import config
 import constants
 import filesystem_utils
 import repository
+import topic_tag_index
 import unicode_string_utils
 
 
+# The number of threads that read the topic-tags files of the cite-keys when
+# the topic tag index is regenerated.  (The threads spend most of their time
+# waiting for the filesystem, so there can be more threads than CPUs.)
+NUM_REGENERATE_THREADS = 8
+
+
 def regenerate_topic_tag_index():
   """Regenerate the topic tag index, if it somehow gets messed up.
   
   This function is not called by any other Distil code; it's purely
   for administrator convenience.  You'll also need to commit the changes
   to the repository manually after invoking this function.
-  """
 
-  # First, nuke the existing index, if there is any of it left.
-  index_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.TOPIC_TAG_INDEX_SUBDIR)
-  if os.path.exists(index_dir_abspath):
-    shutil.rmtree(index_dir_abspath)
+  The topic-tags files of the cite-keys are read in parallel, and the new index
+  is compared to the existing index, so only the index files whose contents
+  have changed are replaced (or removed).  Each changed index file is written
+  into a temporary directory first, and then renamed over the existing index
+  file, so the existing index remains complete and usable (by a webserver, for
+  example) while it's being regenerated.
 
-  # Then re-create it.
-  os.makedirs(index_dir_abspath)
+  Returns a pair (number of topic tags, number of index files changed).
+  """
+  index_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.TOPIC_TAG_INDEX_SUBDIR)
+  filesystem_utils.ensure_dir_exists(index_dir_abspath)
 
-  # Now traverse all the cite-key subdirectories, and collect any topic tags we find.
+  # Traverse all the cite-key subdirectories, and collect any topic tags we find.
   bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
   all_cite_keys = os.listdir(bibs_subdir_abspath)
-  topic_tag_index = collect_topic_tags(bibs_subdir_abspath, all_cite_keys)
-
-  for topic_tag, cite_keys in topic_tag_index.items():
-    topic_tag_index_abspath = os.path.join(index_dir_abspath, topic_tag)
-    write_topic_tag_index(topic_tag_index_abspath, cite_keys, update_repository=False)
+  cite_keys_by_topic_tag = collect_topic_tags(bibs_subdir_abspath, all_cite_keys)
+
+  prev_topic_tags = set(os.listdir(index_dir_abspath))
+  changed_topic_tags = []
+  for topic_tag, cite_keys in cite_keys_by_topic_tag.items():
+    cite_keys.sort()
+    if topic_tag in prev_topic_tags and \
+        read_topic_tag_index(os.path.join(index_dir_abspath, topic_tag)) == cite_keys:
+      continue
+    changed_topic_tags.append(topic_tag)
+  removed_topic_tags = prev_topic_tags - set(cite_keys_by_topic_tag.keys())
+
+  # The temporary directory must be on the same filesystem as the index (so
+  # that a rename is atomic), but must not be committed to the repository.
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  tmp_dir_abspath = tempfile.mkdtemp(prefix="topic-tag-index-", dir=cache_dir_abspath)
+  try:
+    for topic_tag in changed_topic_tags:
+      open_file_write_one_per_line(os.path.join(tmp_dir_abspath, topic_tag),
+          cite_keys_by_topic_tag[topic_tag])
+    for topic_tag in changed_topic_tags:
+      os.rename(os.path.join(tmp_dir_abspath, topic_tag),
+          os.path.join(index_dir_abspath, topic_tag))
+  finally:
+    shutil.rmtree(tmp_dir_abspath, ignore_errors=True)
+
+  for topic_tag in removed_topic_tags:
+    os.remove(os.path.join(index_dir_abspath, topic_tag))
+
+  return (len(cite_keys_by_topic_tag), len(changed_topic_tags) + len(removed_topic_tags))
 
 
 def collect_topic_tags(bibs_subdir_abspath, cite_keys):
   """Collect topic tags from all the 'cite_keys' specified.
 
+  The topic-tags files are read in parallel, by a pool of threads.
+
   Returns a defaultdict instance that maps topic tags to the cite-keys tagged
   with the topic tags.
   """
-  topic_tag_index = defaultdict(list)
-
-  for cite_key in cite_keys:
+  def read_topic_tags_for_cite_key(cite_key):
     topic_tags_fname_abspath = \
         os.path.join(bibs_subdir_abspath, cite_key, constants.TOPIC_TAGS_FNAME)
-    if os.path.exists(topic_tags_fname_abspath):
-      tags = read_topic_tags(topic_tags_fname_abspath)
-      for t in tags:
-        topic_tag_index[t].append(cite_key)
+    return read_topic_tags_if_exists(topic_tags_fname_abspath)
+
+  pool = multiprocessing.pool.ThreadPool(NUM_REGENERATE_THREADS)
+  try:
+    chunksize = max(1, len(cite_keys) / (8 * NUM_REGENERATE_THREADS))
+    tags_per_cite_key = pool.map(read_topic_tags_for_cite_key, cite_keys, chunksize)
+  finally:
+    pool.close()
+    pool.join()
+
+  cite_keys_by_topic_tag = defaultdict(list)
+  for cite_key, tags in zip(cite_keys, tags_per_cite_key):
+    for t in tags:
+      cite_keys_by_topic_tag[t].append(cite_key)
 
-  return topic_tag_index
+  return cite_keys_by_topic_tag
 
 
 # See http://en.wikipedia.org/wiki/Percent-encoding#Types_of_URI_characters
@@ -143,6 +193,7 @@ def update_topic_tags_for_cite_key(cite_key, chosen_tags, new_tags_str):
   remove_cite_key_from_topic_tag_index(cite_key, removed_tags, index_dir_abspath)
   add_cite_key_to_existing_topic_tag_index(cite_key, added_tags, index_dir_abspath)
   add_cite_key_to_new_topic_tag_index(cite_key, new_tags, index_dir_abspath)
+  catalog.update_cite_key_mtimes(cite_key, chosen_tags | new_tags)
 
   # If this function was called, then something must have been changed...
   # so commit something.
@@ -150,6 +201,72 @@ def update_topic_tags_for_cite_key(cite_key, chosen_tags, new_tags_str):
       "updated topic tags for cite-key %s" % cite_key)
 
 
+def update_topic_tags_for_cite_keys(cite_keys, added_tags, removed_tags):
+  """Add the topic tags 'added_tags' to, and remove the topic tags 'removed_tags'
+  from, every one of 'cite_keys' (skipping any cite-key that doesn't exist).
+
+  This function will sanitise all the tags.  A tag that is in both 'added_tags'
+  and 'removed_tags' will be added.
+
+  Unlike 'update_topic_tags_for_cite_key', the index file of each affected topic
+  tag is read and written only once, however many cite-keys are updated, and
+  all the changes are committed in a single commit.
+
+  Returns the number of cite-keys whose topic tags were changed.
+  """
+  index_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.TOPIC_TAG_INDEX_SUBDIR)
+  filesystem_utils.ensure_dir_exists(index_dir_abspath)
+  bibs_subdir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR)
+
+  added_tags = set(map(sanitize_tag, added_tags))
+  removed_tags = set(map(sanitize_tag, removed_tags)) - added_tags
+
+  # Map each topic tag to the cite-keys to be added to (or removed from) its index.
+  cite_keys_to_add = defaultdict(set)
+  cite_keys_to_remove = defaultdict(set)
+  changed_fname_abspaths = []
+
+  for cite_key in set(cite_keys):
+    if not os.path.isdir(os.path.join(bibs_subdir_abspath, cite_key)):
+      continue
+
+    prev_tags = set(get_topic_tags_for_cite_key(cite_key, sort_tags=False))
+    tags = (prev_tags | added_tags) - removed_tags
+    if tags == prev_tags:
+      continue
+
+    for topic_tag in tags - prev_tags:
+      cite_keys_to_add[topic_tag].add(cite_key)
+    for topic_tag in prev_tags - tags:
+      cite_keys_to_remove[topic_tag].add(cite_key)
+
+    topic_tags_fname_abspath = \
+        os.path.join(bibs_subdir_abspath, cite_key, constants.TOPIC_TAGS_FNAME)
+    write_topic_tags(topic_tags_fname_abspath, list(tags))
+    catalog.update_cite_key_mtimes(cite_key, tags)
+    changed_fname_abspaths.append(topic_tags_fname_abspath)
+
+  if not changed_fname_abspaths:
+    return 0
+
+  for topic_tag in set(cite_keys_to_add.keys()) | set(cite_keys_to_remove.keys()):
+    topic_tag_index_abspath = os.path.join(index_dir_abspath, topic_tag)
+    if os.path.exists(topic_tag_index_abspath):
+      prev_cite_keys = set(read_topic_tag_index(topic_tag_index_abspath))
+    else:
+      prev_cite_keys = set()
+    all_cite_keys = (prev_cite_keys | cite_keys_to_add[topic_tag]) - cite_keys_to_remove[topic_tag]
+    write_topic_tag_index(topic_tag_index_abspath, list(all_cite_keys))
+
+    topic_tag_index.update_cite_keys(cite_keys_to_add[topic_tag], [topic_tag], [])
+    topic_tag_index.update_cite_keys(cite_keys_to_remove[topic_tag], [], [topic_tag])
+
+  num_changed = len(changed_fname_abspaths)
+  repository.commit(changed_fname_abspaths + [index_dir_abspath],
+      "updated topic tags for %d cite-key%s" % (num_changed, "" if num_changed == 1 else "s"))
+  return num_changed
+
+
 def remove_cite_key_from_topic_tag_index(cite_key, topic_tags, index_dir_abspath):
   """Remove 'cite_key' from the index for each topic tag.
 
@@ -169,6 +286,8 @@ def remove_cite_key_from_topic_tag_index(cite_key, topic_tags, index_dir_abspath
 
     write_topic_tag_index(topic_tag_index_abspath, cite_keys)
 
+  topic_tag_index.update_cite_keys([cite_key], [], topic_tags)
+
 
 def add_cite_key_to_existing_topic_tag_index(cite_key, topic_tags, index_dir_abspath):
   """Add 'cite_key' to the index for each topic tag.
@@ -185,6 +304,8 @@ def add_cite_key_to_existing_topic_tag_index(cite_key, topic_tags, index_dir_abs
       cite_keys.append(cite_key)
     write_topic_tag_index(topic_tag_index_abspath, cite_keys)
 
+  topic_tag_index.update_cite_keys([cite_key], topic_tags, [])
+
 
 def add_cite_key_to_new_topic_tag_index(cite_key, topic_tags, index_dir_abspath):
   """Add 'cite_key' to the newly-created index for each topic tag.
@@ -196,6 +317,28 @@ def add_cite_key_to_new_topic_tag_index(cite_key, topic_tags, index_dir_abspath)
     topic_tag_index_abspath = os.path.join(index_dir_abspath, topic_tag)
     write_topic_tag_index(topic_tag_index_abspath, [cite_key])
 
+  topic_tag_index.update_cite_keys([cite_key], topic_tags, [])
+
+
+def add_cite_keys_to_topic_tag_index(cite_keys, topic_tags, index_dir_abspath):
+  """Add all of 'cite_keys' to the index for each topic tag, creating the index
+  for a topic tag if it doesn't exist yet.
+
+  This is for adding many new cite-keys at once (for example, in a bulk import),
+  so the index files are not added to the repository; the caller should add and
+  commit 'index_dir_abspath' afterwards.
+  """
+  for topic_tag in topic_tags:
+    topic_tag_index_abspath = os.path.join(index_dir_abspath, topic_tag)
+    if os.path.exists(topic_tag_index_abspath):
+      prev_cite_keys = read_topic_tag_index(topic_tag_index_abspath)
+    else:
+      prev_cite_keys = []
+    all_cite_keys = list(set(prev_cite_keys) | set(cite_keys))
+    write_topic_tag_index(topic_tag_index_abspath, all_cite_keys, update_repository=False)
+
+  topic_tag_index.update_cite_keys(cite_keys, topic_tags, [])
+
 
 def write_topic_tag_index(fname_abspath, cite_keys, update_repository=True):
   """Write the list of cite-keys 'cite_keys' into the new topic tag index file
@@ -257,7 +400,7 @@ def get_topic_tags_for_cite_key(cite_key, sort_tags=True):
     return []
 
 
-def write_topic_tags(fname_abspath, topic_tags):
+def write_topic_tags(fname_abspath, topic_tags, update_repository=True):
   """Write the list of topic tags 'topic_tags' into the new topic tags file
   'fname_abspath'.
 
@@ -277,7 +420,7 @@ def write_topic_tags(fname_abspath, topic_tags):
   else:
     open_file_write_one_per_line(fname_abspath, topic_tags)
 
-  if not file_exists_before_write:
+  if not file_exists_before_write and update_repository:
     repository.add(fname_abspath)
 
 
@@ -306,3 +449,22 @@ def read_topic_tags(fname):
   s = open(fname).read()
   return s.split()
 
+
+def read_topic_tags_if_exists(fname):
+  """Return a list of the tags found in file 'fname', or an empty list if the
+  file doesn't exist.
+
+  (This costs a single failed 'open', rather than an 'os.path.exists' followed
+  by an 'open'.)
+  """
+  try:
+    f = open(fname)
+  except IOError as e:
+    if e.errno == errno.ENOENT:
+      return []
+    raise
+  try:
+    return f.read().split()
+  finally:
+    f.close()
+
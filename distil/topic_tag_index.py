@@ -0,0 +1,315 @@
+# topic_tag_index.py: An in-memory index of the cite-keys tagged with each topic tag.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import os
+import threading
+
+import config
+import constants
+import test_framework
+import topic_tag_file_io
+
+
+# To list the cite-keys tagged with a topic tag (on the "/tag/X" page), the
+# cite-keys in the topic tag index file of the tag were read, and then (to
+# filter by further tags, the "shta" query arguments) the topic tags of every
+# one of those cite-keys were compared against the tags to filter by, one
+# cite-key at a time.
+#
+# Instead, this module keeps the topic tag index resident in memory.  Each
+# cite-key is assigned a dense integer ID (in the order in which the cite-keys
+# are first seen), and the cite-keys tagged with each topic tag are stored as
+# a bitmap (a Python long, in which bit N is set if the cite-key with ID N is
+# tagged with the topic tag).  So the cite-keys tagged with several topic tags
+# are obtained by a single bitwise AND of the bitmaps of the tags, and the
+# number of cite-keys in a bitmap is the number of set bits (its "popcount").
+#
+# The bitmaps are loaded from the topic tag index files (see 'topic_tag_file_io'),
+# and the bitmap of a topic tag is re-loaded whenever the mtime or size of its
+# index file changes (that is, whenever the index file is changed by another
+# process, or outside of Distil), just as topic tags are added or removed when
+# the mtime of the index subdir changes.  Within this process, the bitmaps are
+# updated incrementally by the functions in 'topic_tag_file_io' that add
+# cite-keys to (or remove cite-keys from) the index files.
+#
+# The bitmaps are also the structure from which the co-occurrence of tags is
+# counted:  on the "/tag/X" page, the number of the listed cite-keys that are
+# also tagged with each other tag (the "facet counts", which suggest which tag
+# to filter by next) is the popcount of the AND of two bitmaps, with no files
+# read at all.
+#
+# The IDs of cite-keys are never re-used, so the ID of a cite-key that has been
+# renamed or removed simply remains unset in every bitmap.
+
+
+### These are the public functions of the exported API.
+
+
+def has_topic_tag(topic_tag):
+  """Return whether the topic tag 'topic_tag' exists."""
+  return _INDEX.has_topic_tag(topic_tag)
+
+
+def get_cite_keys_tagged_with_all(topic_tags):
+  """Return a sorted list of the cite-keys that are tagged with every one of
+  the topic tags in 'topic_tags'.
+  """
+  return _INDEX.get_cite_keys(_INDEX.get_bitmap_of_all(topic_tags))
+
+
+def count_cite_keys_tagged_with_all(topic_tags):
+  """Return the number of cite-keys that are tagged with every one of the topic
+  tags in 'topic_tags'.
+  """
+  return count_bits(_INDEX.get_bitmap_of_all(topic_tags))
+
+
+def get_co_occurring_tag_counts(topic_tags):
+  """Return a dictionary that maps each other topic tag to the number of the
+  cite-keys tagged with every one of 'topic_tags' that are also tagged with
+  that topic tag.
+
+  Topic tags that occur with none of those cite-keys are omitted.
+  """
+  return _INDEX.get_co_occurring_tag_counts(topic_tags)
+
+
+def update_cite_keys(cite_keys, added_tags, removed_tags):
+  """Record that 'cite_keys' have been added to the index files of 'added_tags'
+  and removed from the index files of 'removed_tags'.
+
+  This should be invoked after the index files have been written.
+  """
+  _INDEX.update_cite_keys(cite_keys, added_tags, removed_tags)
+
+
+### Anything below this point is not part of the exported API.
+
+
+class TopicTagIndex(object):
+  def __init__(self):
+    # The index may be updated (by the repository executor thread) at the same
+    # time as it's read (by the thread that's handling a request).
+    self.lock = threading.Lock()
+
+    self.subdir_mtime = None
+    self.cite_key_ids = {}
+    self.cite_keys_by_id = []
+    self.bitmaps = {}
+    self.fname_stamps = {}
+
+  def has_topic_tag(self, topic_tag):
+    self.lock.acquire()
+    try:
+      self.refresh_topic_tags()
+      return self.bitmaps.has_key(topic_tag)
+    finally:
+      self.lock.release()
+
+  def get_bitmap_of_all(self, topic_tags):
+    self.lock.acquire()
+    try:
+      self.refresh_topic_tags()
+      bitmap = None
+      for topic_tag in topic_tags:
+        if not self.refresh_bitmap(topic_tag):
+          return 0L
+        if bitmap is None:
+          bitmap = self.bitmaps[topic_tag]
+        else:
+          bitmap &= self.bitmaps[topic_tag]
+      if bitmap is None:
+        return 0L
+      return bitmap
+    finally:
+      self.lock.release()
+
+  def get_cite_keys(self, bitmap):
+    cite_keys = [self.cite_keys_by_id[i] for i in iterate_bits(bitmap)]
+    cite_keys.sort()
+    return cite_keys
+
+  def get_co_occurring_tag_counts(self, topic_tags):
+    bitmap = self.get_bitmap_of_all(topic_tags)
+    counts = {}
+    if not bitmap:
+      return counts
+
+    self.lock.acquire()
+    try:
+      for topic_tag in self.bitmaps.keys():
+        if topic_tag in topic_tags or not self.refresh_bitmap(topic_tag):
+          continue
+        count = count_bits(bitmap & self.bitmaps[topic_tag])
+        if count:
+          counts[topic_tag] = count
+    finally:
+      self.lock.release()
+    return counts
+
+  def update_cite_keys(self, cite_keys, added_tags, removed_tags):
+    self.lock.acquire()
+    try:
+      bits = make_bitmap(map(self.get_cite_key_id, cite_keys))
+      for topic_tag in added_tags:
+        if self.fname_stamps.has_key(topic_tag):
+          self.bitmaps[topic_tag] |= bits
+          self.fname_stamps[topic_tag] = self.get_fname_stamp(topic_tag)
+        else:
+          # The bitmap has not been loaded yet, so it will be loaded (including
+          # this cite-key) from the index file when it's first needed.
+          self.bitmaps.setdefault(topic_tag, 0L)
+      for topic_tag in removed_tags:
+        if not self.fname_stamps.has_key(topic_tag):
+          continue
+        bitmap = self.bitmaps[topic_tag] & ~bits
+        if bitmap:
+          self.bitmaps[topic_tag] = bitmap
+          self.fname_stamps[topic_tag] = self.get_fname_stamp(topic_tag)
+        else:
+          # The index file of an unused topic tag is removed.
+          self.forget_topic_tag(topic_tag)
+    finally:
+      self.lock.release()
+
+  def refresh_topic_tags(self):
+    """Add or remove topic tags if the mtime of the index subdir has changed."""
+    try:
+      mtime = os.stat(get_index_dir_abspath()).st_mtime
+    except OSError:
+      # The subdir doesn't exist yet, so neither do any topic tags.
+      mtime = None
+    if mtime == self.subdir_mtime:
+      return
+
+    # Note that we obtain the mtime *before* listing the directory, so if
+    # the directory changes while we're listing it, we'll re-read it next time.
+    if mtime is None:
+      topic_tags = set()
+    else:
+      topic_tags = set(os.listdir(get_index_dir_abspath()))
+    for topic_tag in self.bitmaps.keys():
+      if topic_tag not in topic_tags:
+        self.forget_topic_tag(topic_tag)
+    for topic_tag in topic_tags:
+      if not self.bitmaps.has_key(topic_tag):
+        self.bitmaps[topic_tag] = 0L
+    self.subdir_mtime = mtime
+
+  def refresh_bitmap(self, topic_tag):
+    """Re-load the bitmap of 'topic_tag' if its index file has changed.
+
+    Returns False if the topic tag doesn't exist.
+    """
+    if not self.bitmaps.has_key(topic_tag):
+      return False
+
+    stamp = self.get_fname_stamp(topic_tag)
+    if stamp is None:
+      self.forget_topic_tag(topic_tag)
+      return False
+    if stamp != self.fname_stamps.get(topic_tag):
+      cite_keys = topic_tag_file_io.read_topic_tag_index(
+          os.path.join(get_index_dir_abspath(), topic_tag))
+      self.bitmaps[topic_tag] = make_bitmap(map(self.get_cite_key_id, cite_keys))
+      self.fname_stamps[topic_tag] = stamp
+    return True
+
+  def forget_topic_tag(self, topic_tag):
+    self.bitmaps.pop(topic_tag, None)
+    self.fname_stamps.pop(topic_tag, None)
+
+  def get_cite_key_id(self, cite_key):
+    cite_key_id = self.cite_key_ids.get(cite_key)
+    if cite_key_id is None:
+      cite_key_id = len(self.cite_keys_by_id)
+      self.cite_key_ids[cite_key] = cite_key_id
+      self.cite_keys_by_id.append(cite_key)
+    return cite_key_id
+
+  def get_fname_stamp(self, topic_tag):
+    """Return the (mtime, size) of the index file of 'topic_tag', or None if it
+    doesn't exist.
+    """
+    try:
+      st = os.stat(os.path.join(get_index_dir_abspath(), topic_tag))
+    except OSError:
+      return None
+    return (st.st_mtime, st.st_size)
+
+
+def get_index_dir_abspath():
+  return os.path.join(config.DOCLIB_BASE_ABSPATH, constants.TOPIC_TAG_INDEX_SUBDIR)
+
+
+def make_bitmap(ids):
+  """Return a bitmap in which the bits of 'ids' are set."""
+  if not ids:
+    return 0L
+
+  # Setting the bits one at a time would create a new (ever longer) long for
+  # each bit, so instead set the bits in a string of binary digits.
+  digits = bytearray("0" * (max(ids) + 1))
+  for i in ids:
+    digits[-1 - i] = "1"
+  return long(str(digits), 2)
+
+
+def iterate_bits(bitmap):
+  """Iterate through the set bits of 'bitmap', from the least significant."""
+  # The binary digits, reversed so the index of each digit is its bit.
+  digits = bin(bitmap)[:1:-1]
+  i = digits.find("1")
+  while i >= 0:
+    yield i
+    i = digits.find("1", i + 1)
+
+
+def count_bits(bitmap):
+  return bin(bitmap).count("1")
+
+
+_INDEX = TopicTagIndex()
+
+
+def test_bitmaps():
+  tests = [
+    ([], []),
+    ([0], [0]),
+    ([3, 1, 64], [1, 3, 64]),
+    ([2, 2, 5], [2, 5]),
+  ]
+  test_framework.test_and_compare(tests, lambda ids: list(iterate_bits(make_bitmap(ids))),
+      "Bitmap")
+
+  tests = [
+    (0L, 0),
+    (make_bitmap([0, 7, 100]), 3),
+    (make_bitmap([0, 7, 100]) & make_bitmap([7, 8, 100]), 2),
+  ]
+  test_framework.test_and_compare(tests, count_bits, "Count bits")
+
+
+def main():
+  test_bitmaps()
+
+
+if __name__ == "__main__":
+  main()
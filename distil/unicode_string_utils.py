@@ -46,10 +46,7 @@ def open_file_read_unicode(fname, which_error_handler="replace-if-possible"):
   error_handler = codecs.lookup_error(which_error_handler)
   error_handler.reset()
 
-  # Note that we open the file with the encoding "utf-8-sig", since this
-  # encoding will remove the BOM (byte-order mark) if present.
-  # See http://docs.python.org/library/codecs.html ; search for "-sig".
-  f = codecs.open(fname, encoding="utf-8-sig", errors=which_error_handler)
+  f = open_file_unicode(fname, which_error_handler)
 
   # 's' will be a Unicode string, which may or may not contain non-ASCII.
   s = f.read()
@@ -57,6 +54,20 @@ def open_file_read_unicode(fname, which_error_handler="replace-if-possible"):
   return (s, contains_non_ascii_unicode(s), error_handler.errors)
 
 
+def open_file_unicode(fname, which_error_handler="replace-if-possible"):
+  """Open the file named 'fname' for reading, returning a file object that will
+  return Unicode strings.
+
+  This is for files that are too large to read into a single string; it will
+  gloss over Unicode-decoding errors in the same way as 'open_file_read_unicode'.
+  """
+
+  # Note that we open the file with the encoding "utf-8-sig", since this
+  # encoding will remove the BOM (byte-order mark) if present.
+  # See http://docs.python.org/library/codecs.html ; search for "-sig".
+  return codecs.open(fname, encoding="utf-8-sig", errors=which_error_handler)
+
+
 ErrorDescription = namedtuple('ErrorDescription',
     'encoding reason start end bad_data result replacement preceding following')
 
@@ -0,0 +1,224 @@
+# url_fetches.py: Fetch URL attachments in the background.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import errno
+import marshal
+import os
+import threading
+import time
+
+import attachments
+import config
+import filesystem_utils
+import repository_executor
+
+
+# When the user creates an attachment from a URL, the webserver used to fetch
+# the URL inside the request handler, so a slow remote host would freeze the
+# whole webserver until the download was complete.
+#
+# Instead, each URL is fetched by a background thread, which streams the
+# contents chunk by chunk into a file in the cache subdir of the doclib (see
+# 'attachments.download_url'), subject to the limits 'config.URL_FETCH_MAX_NUM_BYTES'
+# and 'config.URL_FETCH_TIMEOUT'.  Only once the download is complete is the
+# file moved into a new attachment dir and committed, by the repository executor
+# (see 'repository_executor').
+#
+# The status of each fetch is stored in a status file (alongside the download),
+# so that the progress of the fetch can be displayed on the attachments page,
+# by any of the webserver processes.  The status file is removed when the
+# attachment has been stored; if the fetch fails, the status file (containing
+# the error message) is kept for 'FAILED_FETCH_LIFETIME' seconds.
+
+
+# The maximum number of URLs to fetch simultaneously (in each process);
+# any other fetches will wait until one of these is complete.
+MAX_SIMULTANEOUS_FETCHES = 4
+
+# The minimum interval (in seconds) between updates of the status file.
+STATUS_UPDATE_INTERVAL = 1.0
+
+# The number of seconds for which to display the status of a failed fetch.
+FAILED_FETCH_LIFETIME = 60 * 60
+
+# The possible states of a fetch.
+WAITING = "waiting"
+DOWNLOADING = "downloading"
+STORING = "storing"
+FAILED = "failed"
+
+
+### These are the public functions of the exported API.
+
+
+# Don't change these parameter names, because we use double-asterisk
+# function invocation to pass parameters by name.
+def start_fetch(filename, dirpath="", new_filename="", short_descr="", source_url=""):
+  """Start fetching the URL 'filename' in the background, to be stored as a new
+  attachment when the fetch is complete.
+
+  Returns the fetch ID.
+  """
+  fetch_id = attachments.generate_unique_string_26()
+  fetch = Fetch(fetch_id, filename, new_filename, short_descr, source_url)
+  fetch.write_status()
+
+  thread = threading.Thread(target=fetch.run, name="url-fetch-%s" % fetch_id)
+  # Don't let an unfinished fetch keep the process alive.
+  thread.daemon = True
+  thread.start()
+
+  return fetch_id
+
+
+def get_fetch_statuses():
+  """Return a list of the statuses of the fetches that are in progress (or that
+  have recently failed), in the order they were started.
+
+  Each status is a dictionary with the keys "url", "state", "started",
+  "num-bytes", "total-num-bytes" and "error".
+  """
+  downloads_dir_abspath = attachments.get_downloads_dir_abspath()
+  statuses = []
+  for fname in os.listdir(downloads_dir_abspath):
+    if not fname.endswith(STATUS_FNAME_SUFFIX):
+      continue
+
+    status_fname_abspath = os.path.join(downloads_dir_abspath, fname)
+    status = read_status_file(status_fname_abspath)
+    if status is None:
+      # The fetch has finished in the meantime.
+      continue
+
+    age = time.time() - status["updated"]
+    if (status["state"] == DOWNLOADING and
+            age > config.URL_FETCH_TIMEOUT + STATUS_UPDATE_INTERVAL) or \
+        (status["state"] != FAILED and age > FAILED_FETCH_LIFETIME):
+      # The process that was fetching this URL must have exited.
+      status["state"] = FAILED
+      status["error"] = "The fetch was interrupted"
+    if status["state"] == FAILED and age > FAILED_FETCH_LIFETIME:
+      remove_if_exists(status_fname_abspath)
+      continue
+
+    statuses.append(status)
+
+  statuses.sort(key=lambda status: status["started"])
+  return statuses
+
+
+class Fetch(object):
+  def __init__(self, fetch_id, url, new_filename, short_descr, source_url):
+    self.url = url
+    self.new_filename = new_filename
+    self.short_descr = short_descr
+    self.source_url = source_url
+
+    self.download_fname_abspath = attachments.get_download_fname_abspath(fetch_id)
+    self.status_fname_abspath = os.path.join(attachments.get_downloads_dir_abspath(),
+        fetch_id + STATUS_FNAME_SUFFIX)
+    self.status = {
+      "url": url,
+      "state": WAITING,
+      "started": time.time(),
+      "updated": time.time(),
+      "num-bytes": 0,
+      "total-num-bytes": None,
+      "error": "",
+    }
+
+  def run(self):
+    _FETCH_SLOTS.acquire()
+    try:
+      self.update_status(state=DOWNLOADING)
+      attachments.download_url(self.url, self.download_fname_abspath,
+          config.URL_FETCH_MAX_NUM_BYTES, config.URL_FETCH_TIMEOUT, self.update_progress)
+    except (attachments.Error, EnvironmentError) as e:
+      self.update_status(state=FAILED, error=str(e))
+      return
+    finally:
+      _FETCH_SLOTS.release()
+
+    self.update_status(state=STORING)
+    repository_executor.submit(self.store_attachment, ())
+
+  def store_attachment(self):
+    """Store the downloaded file as a new attachment (on the repository executor thread)."""
+    try:
+      attachments.store_new_attachment(self.url, self.short_descr, self.source_url,
+          self.new_filename, self.download_fname_abspath)
+    except (attachments.Error, filesystem_utils.Error, EnvironmentError) as e:
+      remove_if_exists(self.download_fname_abspath)
+      self.update_status(state=FAILED, error=str(e))
+      return
+    remove_if_exists(self.status_fname_abspath)
+
+  def update_progress(self, num_bytes, total_num_bytes):
+    self.status["num-bytes"] = num_bytes
+    self.status["total-num-bytes"] = total_num_bytes
+    if time.time() - self.status["updated"] >= STATUS_UPDATE_INTERVAL:
+      self.write_status()
+
+  def update_status(self, **kwargs):
+    self.status.update(kwargs)
+    self.write_status()
+
+  def write_status(self):
+    self.status["updated"] = time.time()
+
+    # Write to a temporary file and then rename it over the old file, so that
+    # other processes never see a partially-written status.
+    tmp_fname_abspath = "%s.tmp" % self.status_fname_abspath
+    f = open(tmp_fname_abspath, 'wb')
+    try:
+      marshal.dump(self.status, f)
+    finally:
+      f.close()
+    os.rename(tmp_fname_abspath, self.status_fname_abspath)
+
+
+### Anything below this point is not part of the exported API.
+
+
+STATUS_FNAME_SUFFIX = ".status"
+
+_FETCH_SLOTS = threading.BoundedSemaphore(MAX_SIMULTANEOUS_FETCHES)
+
+
+def read_status_file(status_fname_abspath):
+  """Return the status in 'status_fname_abspath', or None if it doesn't exist."""
+  try:
+    f = open(status_fname_abspath, 'rb')
+  except IOError as e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+  try:
+    return marshal.load(f)
+  finally:
+    f.close()
+
+
+def remove_if_exists(fname_abspath):
+  try:
+    os.remove(fname_abspath)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
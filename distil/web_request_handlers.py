@@ -18,11 +18,11 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 
-import operator
 import os
 import string
 import sys
 import types
+import urllib
 import tornado.web
 
 from collections import defaultdict
@@ -31,15 +31,22 @@ from PIL import Image
 import abstract_file_io
 import attachments
 import authentication
+import backlinks
 import bibfile_utils
+import catalog
 import config
 import constants
 import filesystem_utils
 import form_button_actions
+import repository_executor
+import search_index
 import stored_bibs
 import topic_tag_file_io
+import topic_tag_index
+import url_fetches
 import wiki_file_io
 import wiki_markup
+import wiki_render_cache
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -56,19 +63,43 @@ class BaseHandler(tornado.web.RequestHandler):
     except filesystem_utils.DirectoryNotFound:
       raise tornado.web.HTTPError(404)
 
+    self.add_doc_path(cite_key, doc_attrs)
+    return doc_attrs
+
+  def add_doc_path(self, cite_key, doc_attrs):
     # Note that, even if no exception was thrown, 'doc_attrs' might have no
     # details about the doc if there was simply no doc stored for that cite-key.
     if doc_attrs.has_key("doc-name"):
       doc_fname = doc_attrs["doc-name"]
       doc_attrs["doc-path"] = "/static/%s/bibs/%s/%s" % (config.DOCLIB_SYMLINK_NAME, cite_key, doc_fname)
 
-    return doc_attrs
-
   def get_submit_button_pressed(self):
     if not self.get_arguments("submit-button"):
       return None
     return self.get_arguments("submit-button")[0]
 
+  def invoke_submit_button_action(self, submit_buttons, wiki_id, render_page_args, callback):
+    """Invoke the action (in the dictionary 'submit_buttons') of the submit button
+    that was pressed; the action will invoke 'callback' when it has finished.
+
+    If no submit button was pressed, 'callback' is invoked immediately.
+    """
+    submit_button_pressed = self.get_submit_button_pressed()
+    if not submit_button_pressed:
+      callback()
+      return
+
+    try:
+      action = submit_buttons[submit_button_pressed]
+    except KeyError as e:
+      # There is a new submit button which we need to add to the 'submit_buttons' dictionary.
+      sys.stderr.write("Error in %s, class %s: unhandled submit button '%s'" %
+          (__file__, self.__class__.__name__, submit_button_pressed))
+      callback()
+      return
+
+    action(self, wiki_id, render_page_args, self.async_callback(callback))
+
   def get_text(self, name, strip=True):
     text_list = self.get_arguments(name, strip)
     # 'text_list' will either be an empty list (if there was no text)
@@ -164,6 +195,12 @@ class AttachmentsHandler(BaseHandler):
       self.render_page(fields, "Please supply the filename of the attachment")
       return
 
+    if attachments.is_url(fields["filename"]):
+      # Fetch the URL in the background; its progress is displayed on this page.
+      url_fetches.start_fetch(**fields)
+      self.redirect("/attachments")
+      return
+
     try:
       attachment_id = attachments.store_new_attachment_incl_dirpath(**fields)
       self.redirect("/attachment/%s" % attachment_id)
@@ -194,13 +231,24 @@ class AttachmentsHandler(BaseHandler):
         create_attachment_form_params[fn_var_name_init] = ""
 
     self.render("attachments.html", title="Attachments", items=attachments_with_attrs,
+        fetches=self.get_fetches_with_progress(),
         create_attachment_form_params=create_attachment_form_params)
 
+  def get_fetches_with_progress(self):
+    fetches_with_progress = []
+    for status in url_fetches.get_fetch_statuses():
+      progress = status["state"]
+      if status["state"] == url_fetches.DOWNLOADING:
+        progress = "%s: %s" % (progress,
+            attachments.get_human_readable_size(status["num-bytes"]))
+        if status["total-num-bytes"]:
+          progress = "%s of %s" % (progress,
+              attachments.get_human_readable_size(status["total-num-bytes"]))
+      fetches_with_progress.append((status["url"], progress, status["error"]))
+    return fetches_with_progress
+
   def get_attachments_with_attrs(self):
-    filesystem_utils.ensure_dir_exists(self.attachments_subdir_abspath)
-    all_attachment_dirnames = os.listdir(self.attachments_subdir_abspath)
-    attachments_with_attrs = [attachments.get_attachment_attrs(dirname)
-        for dirname in all_attachment_dirnames]
+    attachments_with_attrs = catalog.get_attachments_attrs()
 
     # We want the attachment index to be sorted primarily by the
     # human-readable filename (compared case-INSENSITIVELY), and
@@ -231,7 +279,16 @@ def extract_attachment_form_fields(calling_obj):
   return extracted_form_fields
 
 
+# The number of items on each page of a list of cite-keys, unless the "limit"
+# query argument specifies otherwise.
+DEFAULT_PAGE_SIZE = 100
+
 class CiteKeyListBaseHandler(BaseHandler):
+  defaultdict_render_page_args = defaultdict(str)
+
+  # This instance provides the callback function of the batch tag-editing form.
+  batch_tag_button_actions = form_button_actions.BatchTagButtonActions()
+
   def __init__(self, *args, **kwargs):
     BaseHandler.__init__(self, *args, **kwargs)
 
@@ -243,9 +300,10 @@ class CiteKeyListBaseHandler(BaseHandler):
       return "-".join(words)
 
     # When there are new options added, simply insert the (text, functions) to this list.
-    # Everything else will update automatically.
+    # Everything else will update automatically.  The functions are applied to
+    # catalog rows (see 'catalog.get_cite_key_rows'), whose columns are the sort keys.
     option_text_and_functions = [
-      ("Cite Key",                                      [operator.itemgetter(0)]),
+      ("Cite Key",                                      [catalog.get_column_getter("cite_key")]),
       ("Date Imported (Oldest First)",                  date_added_getter()),
       ("Date Imported (Newest First)",                  date_added_getter(True)),
       ("Year Published (Oldest First), then Cite Key",  year_published_getter()),
@@ -260,109 +318,223 @@ class CiteKeyListBaseHandler(BaseHandler):
     self.order_by_choices_and_text = [(option_value, text)
         for (option_value, text, func) in list_of_triples]
 
-  def get_cite_keys_and_attrs(self, cite_key):
-    attrs = self.get_doc_attrs(cite_key)
-    attrs["topic-tags"] = topic_tag_file_io.get_topic_tags_for_cite_key(cite_key)
-    return (cite_key, attrs)
+  def get_cite_keys_and_attrs(self, cite_keys=None):
+    """Return a list of (cite_key, attrs) pairs from the catalog.
+
+    If 'cite_keys' is None, all the cite-keys in the doclib will be returned.
+    """
+    try:
+      cite_keys_and_attrs = catalog.get_cite_keys_and_attrs(cite_keys)
+    except filesystem_utils.DirectoryNotFound:
+      raise tornado.web.HTTPError(404)
+
+    for cite_key, attrs in cite_keys_and_attrs:
+      self.add_doc_path(cite_key, attrs)
+    return cite_keys_and_attrs
+
+  def get_cite_key_rows(self, cite_keys=None):
+    """Return a list of catalog rows (see 'catalog.get_cite_key_rows')."""
+    try:
+      return catalog.get_cite_key_rows(cite_keys)
+    except filesystem_utils.DirectoryNotFound:
+      raise tornado.web.HTTPError(404)
 
-  def sort_cite_keys_and_attrs(self, cite_keys_and_attrs, order_by):
+  def sort_cite_key_rows(self, rows, order_by):
     sorting_keys = self.order_by_choices_and_functions[order_by]
     for k in sorting_keys:
       if type(k) == types.TupleType:
         # There was a 'reverse' parameter provided too.
-        cite_keys_and_attrs.sort(key=k[0], reverse=k[1])
+        rows.sort(key=k[0], reverse=k[1])
       else:
-        cite_keys_and_attrs.sort(key=k)
+        rows.sort(key=k)
 
   def get_order_by_choice(self):
-    if not self.get_arguments("reload-button"):
-      return None
-    return self.get_arguments("order-by-choice")[0]
+    if self.get_arguments("reload-button"):
+      order_by = self.get_argument("order-by-choice", "cite-key")
+    else:
+      # The order may instead be specified in a query argument (by the page links).
+      order_by = self.get_argument("order-by", "cite-key")
+    if order_by not in self.order_by_choices_and_functions:
+      return "cite-key"
+    return order_by
+
+  def get_page_window(self):
+    """Return the (offset, limit) of the page of items specified in the query arguments."""
+    try:
+      offset = max(0, int(self.get_argument("offset", "0")))
+      limit = max(1, int(self.get_argument("limit", str(DEFAULT_PAGE_SIZE))))
+    except ValueError:
+      raise tornado.web.HTTPError(400)
+    return (offset, limit)
+
+  def convert_page_of_rows(self, rows, offset, limit):
+    """Return the (cite_key, attrs) pairs of just the rows in the page of items
+    from 'offset' to 'offset + limit'.
+    """
+    cite_keys_and_attrs = catalog.convert_rows_to_cite_keys_and_attrs(rows[offset:offset + limit])
+    for cite_key, attrs in cite_keys_and_attrs:
+      self.add_doc_path(cite_key, attrs)
+    return cite_keys_and_attrs
+
+  def get_page_links_params(self, path, query_args, num_items, offset, limit):
+    """Return the parameters of the 'PageLinks' UI module, for the page of
+    items from 'offset' to 'offset + limit' (of 'num_items' items in total).
+
+    'query_args' is a list of (name, value) pairs of the other query arguments
+    that should be retained when moving to another page.
+    """
+    def make_page_url(page_offset):
+      return "%s?%s" % (path, urllib.urlencode(query_args +
+          [("offset", page_offset), ("limit", limit)]))
+
+    prev_url = None
+    if offset > 0:
+      prev_url = make_page_url(max(0, offset - limit))
+    next_url = None
+    if offset + limit < num_items:
+      next_url = make_page_url(offset + limit)
+
+    return dict(
+        first_item_num=min(offset + 1, num_items),
+        last_item_num=min(offset + limit, num_items),
+        num_items=num_items,
+        prev_url=prev_url,
+        next_url=next_url)
+
+  def post_and_render_page(self, list_id, render_page):
+    """Invoke the action of the submit button that was pressed (if any), then
+    invoke 'render_page(order_by, args)' to render the page.
+    """
+    order_by = self.get_order_by_choice()
+    args = CiteKeyListBaseHandler.defaultdict_render_page_args.copy()
+    submit_buttons = {
+      "Update Tags": CiteKeyListBaseHandler.batch_tag_button_actions.update_tags,
+    }
+
+    # The button action may change the doclib on the repository executor
+    # thread, so the page is rendered in a callback, once it has finished.
+    def render_page_callback():
+      render_page(order_by, args)
+
+    self.invoke_submit_button_action(submit_buttons, list_id, args, render_page_callback)
+
+  def get_batch_tags_params(self, order_by, args):
+    """Return the parameters of the 'BatchTagsForm' UI module."""
+    return dict(
+        message=args["batch_tags_message"],
+        message_class=args["batch_tags_message_class"],
+        selected_cite_keys=(args["selected_cite_keys"] or []),
+        add_tags=args["add_tags"],
+        remove_tags=args["remove_tags"],
+        order_by=order_by)
 
 
 def year_published_getter(reverse=False):
-  def get_year_published(obj):
-    return obj[1]["year-published"]
-  return [operator.itemgetter(0), (get_year_published, reverse)]
+  return [catalog.get_column_getter("cite_key"),
+      (catalog.get_column_getter("year_published"), reverse)]
 
 
 def date_added_getter(reverse=False):
-  def get_date_added(obj):
-    return obj[1]["date-added"]
-  return [(get_date_added, reverse)]
+  return [(catalog.get_column_getter("date_added"), reverse)]
 
 
 class CiteKeysHandler(CiteKeyListBaseHandler):
   @tornado.web.authenticated
   def get(self):
-    self.render_page()
+    self.render_page(self.get_order_by_choice())
 
+  @tornado.web.asynchronous
   @tornado.web.authenticated
   def post(self):
-    order_by_choice = self.get_order_by_choice()
-    self.render_page(order_by_choice)
+    self.post_and_render_page(None, self.render_page)
+
+  def render_page(self, order_by="cite-key", args=CiteKeyListBaseHandler.defaultdict_render_page_args):
+    (offset, limit) = self.get_page_window()
+    rows = self.get_cite_key_rows()
+    self.sort_cite_key_rows(rows, order_by)
+    page_links_params = self.get_page_links_params("/cite-keys", [("order-by", order_by)],
+        len(rows), offset, limit)
+
+    self.render("cite-keys.html", title="Cite Keys", items=self.convert_page_of_rows(rows, offset, limit),
+        page_links_params=page_links_params,
+        batch_tags_params=self.get_batch_tags_params(order_by, args),
+        choices_and_text=self.order_by_choices_and_text, order_by_choice=order_by)
 
-  def render_page(self, order_by="cite-key"):
-    filesystem_utils.ensure_dir_exists(self.bibs_subdir_abspath)
-    cite_keys = os.listdir(self.bibs_subdir_abspath)
-    cite_keys_and_attrs = map(self.get_cite_keys_and_attrs, cite_keys)
-    self.sort_cite_keys_and_attrs(cite_keys_and_attrs, order_by)
 
-    self.render("cite-keys.html", title="Cite Keys", items=cite_keys_and_attrs,
-        choices_and_text=self.order_by_choices_and_text, order_by_choice=order_by)
+class SearchHandler(CiteKeyListBaseHandler):
+  @tornado.web.authenticated
+  def get(self):
+    query = self.get_argument("q", default="").strip()
+    if query:
+      # The search index is keyed by cite-key, so look up the other attributes
+      # (title, authors, etc.) of the matching cite-keys in the catalog.
+      cite_keys_and_attrs = self.get_cite_keys_and_attrs(search_index.search(query))
+    else:
+      cite_keys_and_attrs = []
+
+    self.render("search.html", title="Search", query=query, items=cite_keys_and_attrs)
 
 
 class TagXHandler(CiteKeyListBaseHandler):
   @tornado.web.authenticated
   def get(self, topic_tag):
-    self.render_page(topic_tag)
+    self.render_page(topic_tag, self.get_order_by_choice())
 
+  @tornado.web.asynchronous
   @tornado.web.authenticated
   def post(self, topic_tag):
-    order_by_choice = self.get_order_by_choice()
-    self.render_page(topic_tag, order_by_choice)
-
-  def filter_by_tags(self, cite_keys_and_attrs, topic_tag):
-    if self.get_arguments("shta"):
-      filtered_by_tags = set(self.get_arguments("shta"))
-      # Remove the current topic-tag from every topic-tag list.
-      filtered_by_tags.add(topic_tag)
-
-      # Remove any element of 'cite_keys_and_attrs' which is not tagged with
-      # all the tags in 'filtered_by_tags'.
-      filtered = []
-      for cite_key, attrs in cite_keys_and_attrs:
-        if attrs.has_key("topic-tags"):
-          topic_tags = set(attrs["topic-tags"])
-          if filtered_by_tags <= topic_tags:
-            # We keep this item.
-            # But first, remove these tags from being displayed.
-            topic_tags -= filtered_by_tags
-            attrs["topic-tags"] = list(topic_tags)
-            attrs["topic-tags"].sort()
-            filtered.append((cite_key, attrs))
-        else:
-          # Since this item has no topic tags, there's no way it can have even
-          # the current topic-tag, so of course we won't keep it.
-          pass
-      cite_keys_and_attrs = filtered
-    else:
-      # Remove the current topic-tag from every topic-tag list.
-      for cite_key, attrs in cite_keys_and_attrs:
-        if attrs.has_key("topic-tags"):
-          attrs["topic-tags"].remove(topic_tag)
-
-  def render_page(self, topic_tag, order_by="cite-key"):
-    topic_tag_index_fname_abspath = os.path.join(self.index_dir_abspath, topic_tag)
-    if not os.path.exists(topic_tag_index_fname_abspath):
+    def render_page(order_by, args):
+      self.render_page(topic_tag, order_by, args)
+
+    self.post_and_render_page(topic_tag, render_page)
+
+  def remove_filtered_by_tags(self, cite_keys_and_attrs, topic_tag):
+    """Remove the current topic-tag, and the tags to filter by, from being displayed."""
+    filtered_by_tags = set(self.get_arguments("shta"))
+    filtered_by_tags.add(topic_tag)
+    for cite_key, attrs in cite_keys_and_attrs:
+      attrs["topic-tags"] = [t for t in attrs["topic-tags"] if t not in filtered_by_tags]
+
+  def get_tag_facets(self, topic_tag, order_by):
+    """Return a list of (tag, count, url) triples for the other topic tags of
+    the listed cite-keys, where 'count' is the number of the listed cite-keys
+    that are tagged with 'tag', and 'url' filters the list by 'tag' too.
+
+    The triples are sorted by decreasing count, then by tag.
+    """
+    filter_by_tags = self.get_arguments("shta")
+    tag_counts = topic_tag_index.get_co_occurring_tag_counts([topic_tag] + filter_by_tags)
+    tags_and_counts = sorted(tag_counts.items(), key=lambda (tag, count): (-count, tag))
+
+    return [(tag, count, "/tag/%s?%s" % (topic_tag, urllib.urlencode([("order-by", order_by)] +
+            [("shta", t) for t in filter_by_tags + [tag]])))
+        for (tag, count) in tags_and_counts]
+
+  def render_page(self, topic_tag, order_by="cite-key",
+      args=CiteKeyListBaseHandler.defaultdict_render_page_args):
+    if not topic_tag_index.has_topic_tag(topic_tag) and not args["batch_tags_message"]:
+      # (If the topic tag was just removed from all its cite-keys by the batch
+      # tag-editing form, the page is displayed with no items instead.)
       raise tornado.web.HTTPError(404)
 
-    cite_keys = topic_tag_file_io.read_topic_tag_index(topic_tag_index_fname_abspath)
-    cite_keys_and_attrs = map(self.get_cite_keys_and_attrs, cite_keys)
-    self.filter_by_tags(cite_keys_and_attrs, topic_tag)
-    self.sort_cite_keys_and_attrs(cite_keys_and_attrs, order_by)
+    (offset, limit) = self.get_page_window()
+    # Only the cite-keys tagged with the current topic-tag and all the tags to
+    # filter by are looked up in the catalog.
+    cite_keys = topic_tag_index.get_cite_keys_tagged_with_all(
+        [topic_tag] + self.get_arguments("shta"))
+    rows = self.get_cite_key_rows(cite_keys)
+    self.sort_cite_key_rows(rows, order_by)
+    page_links_params = self.get_page_links_params("/tag/%s" % topic_tag,
+        [("order-by", order_by)] + [("shta", t) for t in self.get_arguments("shta")],
+        len(rows), offset, limit)
+
+    cite_keys_and_attrs = self.convert_page_of_rows(rows, offset, limit)
+    self.remove_filtered_by_tags(cite_keys_and_attrs, topic_tag)
 
     self.render("tag-x.html", title=topic_tag, items=cite_keys_and_attrs,
+        page_links_params=page_links_params,
+        tag_facets=self.get_tag_facets(topic_tag, order_by),
+        batch_tags_params=self.get_batch_tags_params(order_by, args),
         choices_and_text=self.order_by_choices_and_text, order_by_choice=order_by,
         topic_tag=topic_tag, filter_by_tags=self.get_arguments("shta"))
 
@@ -451,7 +623,7 @@ class BibXHandler(BaseHandler):
     notes_with_html_markup = []
     wiki_markup_error = None
     try:
-      notes_with_html_markup = wiki_markup.read_wiki_lines_and_transform(wiki_markup_lines, {})
+      notes_with_html_markup = wiki_render_cache.read_wiki_lines_and_transform(wiki_markup_lines)
     except wiki_markup.InputSyntaxError as e:
       (args["notes_message"], wiki_markup_error) = format_wiki_markup_errors(e, wiki_markup_lines)
       args["notes_message_class"] = "message-error"
@@ -471,8 +643,10 @@ class BibXHandler(BaseHandler):
         bib_entries=multiple_bib_entries[0], doc_attrs=self.get_doc_attrs(cite_key),
         notes_params=notes_params, tags=tags, new_tags=args["new_tags"],
         tags_message=args["tags_message"], tags_message_class=args["tags_message_class"],
-        abstract=abstract_file_io.get_abstract_for_cite_key(cite_key))
+        abstract=abstract_file_io.get_abstract_for_cite_key(cite_key),
+        backlinks=backlinks.get_backlinks((wiki_markup.CITE_LINK, cite_key)))
 
+  @tornado.web.asynchronous
   @tornado.web.authenticated
   def post(self, cite_key):
     args_to_pass_to_render_page = BibXHandler.defaultdict_render_page_args.copy()
@@ -482,16 +656,14 @@ class BibXHandler(BaseHandler):
       "Save Notes": BibXHandler.notes_wiki_button_actions.save_wiki_text,
       "Save Tags": BibXHandler.tag_button_actions.save_tags,
     }
-    submit_button_pressed = self.get_submit_button_pressed()
-    if submit_button_pressed:
-      try:
-        submit_buttons[submit_button_pressed](self, cite_key, args_to_pass_to_render_page)
-      except KeyError as e:
-        # There is a new submit button which we need to add to the 'submit_buttons' dictionary.
-        sys.stderr.write("Error in %s, class %s: unhandled submit button '%s'" %
-            (__file__, self.__class__.__name__, submit_button_pressed))
 
-    self.render_page(cite_key, args_to_pass_to_render_page)
+    # The button action may change the doclib on the repository executor
+    # thread, so the page is rendered in a callback, once it has finished.
+    def render_page():
+      self.render_page(cite_key, args_to_pass_to_render_page)
+
+    self.invoke_submit_button_action(submit_buttons, cite_key, args_to_pass_to_render_page,
+        render_page)
 
 
 class WikiXHandler(BaseHandler):
@@ -518,7 +690,7 @@ class WikiXHandler(BaseHandler):
     text_with_html_markup = []
     wiki_markup_error = None
     try:
-      text_with_html_markup = wiki_markup.read_wiki_lines_and_transform(wiki_markup_lines, {})
+      text_with_html_markup = wiki_render_cache.read_wiki_lines_and_transform(wiki_markup_lines)
     except wiki_markup.InputSyntaxError as e:
       (args["text_message"], wiki_markup_error) = format_wiki_markup_errors(e, wiki_markup_lines)
       args["text_message_class"] = "message-error"
@@ -534,8 +706,10 @@ class WikiXHandler(BaseHandler):
         wiki_area_name="text",
         wiki_area_title="Text")
 
-    self.render("wiki-x.html", title=wiki_word, wiki_word=wiki_word, text_params=text_params)
+    self.render("wiki-x.html", title=wiki_word, wiki_word=wiki_word, text_params=text_params,
+        backlinks=backlinks.get_backlinks((wiki_markup.WIKI_LINK, wiki_word)))
 
+  @tornado.web.asynchronous
   @tornado.web.authenticated
   def post(self, wiki_word):
     wiki_word = wiki_markup.normalise_string_for_wiki_word(wiki_word)
@@ -546,23 +720,22 @@ class WikiXHandler(BaseHandler):
       "Reset Text": WikiXHandler.text_wiki_button_actions.reset_wiki_text,
       "Save Text": WikiXHandler.text_wiki_button_actions.save_wiki_text,
     }
-    submit_button_pressed = self.get_submit_button_pressed()
-    if submit_button_pressed:
-      try:
-        submit_buttons[submit_button_pressed](self, wiki_word, args_to_pass_to_render_page)
-      except KeyError as e:
-        # There is a new submit button which we need to add to the 'submit_buttons' dictionary.
-        sys.stderr.write("Error in %s, class %s: unhandled submit button '%s'" %
-            (__file__, self.__class__.__name__, submit_button_pressed))
 
-    self.render_page(wiki_word, args_to_pass_to_render_page)
+    # The button action may change the doclib on the repository executor
+    # thread, so the page is rendered in a callback, once it has finished.
+    def render_page():
+      self.render_page(wiki_word, args_to_pass_to_render_page)
 
-  def create_wiki_page(self, handler, wiki_word, render_page_args):
+    self.invoke_submit_button_action(submit_buttons, wiki_word, args_to_pass_to_render_page,
+        render_page)
+
+  def create_wiki_page(self, handler, wiki_word, render_page_args, callback):
     """Ensure the wiki-word directory and wiki-word file exist.
     
     Will also create the wiki-subdir if it doesn't already exist.
     """
-    wiki_file_io.create_wiki_page(self.wiki_subdir_abspath, wiki_word)
+    repository_executor.submit(wiki_file_io.create_wiki_page,
+        (self.wiki_subdir_abspath, wiki_word), lambda result: callback())
 
 
 class WikiCreateHandler(BaseHandler):
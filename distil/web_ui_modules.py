@@ -20,6 +20,9 @@
 
 import tornado.web
 
+import backlinks
+
+
 class WikiArea(tornado.web.UIModule):
   def render(self, params):
     return self.render_string("ui-module-wiki-area.html", **params)
@@ -29,3 +32,24 @@ class CreateAttachmentForm(tornado.web.UIModule):
   def render(self, params):
     return self.render_string("ui-module-create-attachment-form.html", **params)
 
+
+
+class Backlinks(tornado.web.UIModule):
+  def render(self, referrers):
+    links = []
+    for (referrer_type, referrer) in referrers:
+      if referrer_type == backlinks.NOTES:
+        links.append(("/bib/%s#notes-section" % referrer, "Notes of %s" % referrer))
+      else:
+        links.append(("/wiki/%s" % referrer, referrer))
+    return self.render_string("ui-module-backlinks.html", links=links)
+
+
+class PageLinks(tornado.web.UIModule):
+  def render(self, params):
+    return self.render_string("ui-module-page-links.html", **params)
+
+
+class BatchTagsForm(tornado.web.UIModule):
+  def render(self, params):
+    return self.render_string("ui-module-batch-tags-form.html", **params)
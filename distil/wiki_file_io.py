@@ -21,6 +21,8 @@
 import os
 import time
 
+import backlinks
+import catalog
 import config
 import constants
 import filesystem_utils
@@ -48,7 +50,13 @@ def update_notes_for_cite_key(cite_key, notes, change_descr):
   change_descrs_fname_abspath = \
       os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR, cite_key, constants.NOTES_CHANGE_DESCRS_FNAME)
 
-  update_wiki_text(notes, notes_fname_abspath, change_descr, change_descrs_fname_abspath, "cite-key %s" % cite_key)
+  # Writing the notes may create new files in the cite-key dir, which will
+  # change the mtime of the dir; let the catalog know that this is expected.
+  def update_catalog():
+    catalog.update_cite_key_mtimes(cite_key)
+
+  update_wiki_text(notes, notes_fname_abspath, change_descr, change_descrs_fname_abspath, "cite-key %s" % cite_key,
+      (backlinks.NOTES, cite_key), update_catalog)
 
 
 def update_text_for_wiki_page(wiki_word, text, change_descr):
@@ -57,10 +65,21 @@ def update_text_for_wiki_page(wiki_word, text, change_descr):
   change_descrs_fname_abspath = \
       os.path.join(config.DOCLIB_BASE_ABSPATH, constants.WIKI_SUBDIR, wiki_word, constants.WIKI_TEXT_CHANGE_DESCRS_FNAME)
 
-  update_wiki_text(text, wiki_fname_abspath, change_descr, change_descrs_fname_abspath, "wiki page '%s'" % wiki_word)
+  update_wiki_text(text, wiki_fname_abspath, change_descr, change_descrs_fname_abspath, "wiki page '%s'" % wiki_word,
+      (backlinks.WIKI_PAGE, wiki_word))
+
+
+def update_wiki_text(wiki_text, wiki_text_fname_abspath, change_descr, change_descrs_fname_abspath, what_was_changed,
+    referrer, before_commit_func=None):
+  """Write 'wiki_text' and append 'change_descr' to the change-descriptions,
+  then commit both files.
 
+  The links in 'wiki_text' will replace the links from 'referrer' (a pair of
+  the referrer type and the cite-key or wiki-word) in the backlinks index.
 
-def update_wiki_text(wiki_text, wiki_text_fname_abspath, change_descr, change_descrs_fname_abspath, what_was_changed):
+  If 'before_commit_func' is supplied, it will be invoked (with no arguments)
+  after the files have been written but before they are committed.
+  """
   ensure_file_added_to_repo_if_created(open_file_write_string,
       wiki_text_fname_abspath, wiki_text)
 
@@ -80,6 +99,11 @@ def update_wiki_text(wiki_text, wiki_text_fname_abspath, change_descr, change_de
   ensure_file_added_to_repo_if_created(open_file_append_strings,
       change_descrs_fname_abspath, [datestamp, change_descr])
 
+  backlinks.update_links_from(referrer, wiki_text)
+
+  if before_commit_func:
+    before_commit_func()
+
   repository.commit([wiki_text_fname_abspath, change_descrs_fname_abspath],
       "updated notes for %s: %s" % (what_was_changed, change_descr))
 
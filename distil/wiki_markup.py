@@ -22,18 +22,19 @@ import sys
 import string
 import re
 import os
-import itertools
+import functools
+import random
 
 from xml.sax.saxutils import escape as xml_escape
 
-import attachments
-import config
-import constants
+import link_targets
+import test_framework
 import unicode_string_utils
 
 
 # You probably don't want to edit any of these...
 CURRENT_LIST_NESTING = "CURRENT_LIST_NESTING"
+LINK_TARGETS = "LINK_TARGETS"
 
 # Open/close tags.
 # FIXME:  We can do these more minimally, in the style of the list tags below.
@@ -50,6 +51,12 @@ END_HIGHLIGHT = "</span>"
 ITEMIZE = "ul"
 ENUMERATE = "ol"
 
+# Preformatted (HTML <pre>) text and literal (raw HTML) text.
+BEGIN_PREFORMAT = '{{{pre'
+END_PREFORMAT = 'pre}}}'
+BEGIN_LITERAL = '{{{'
+END_LITERAL = '}}}'
+
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -94,23 +101,25 @@ def read_wiki_lines_and_transform(f, state):
   if not state.has_key(CURRENT_LIST_NESTING):
     state[CURRENT_LIST_NESTING] = []
 
-  BEGIN_PREFORMAT = '{{{pre'
-  END_PREFORMAT = 'pre}}}'
-  preformatted_text = False
+  # Read all the lines first, so that the link targets can be collected from them.
+  lines = list(f)
+  if not state.has_key(LINK_TARGETS):
+    state[LINK_TARGETS] = collect_and_resolve_link_targets(lines)
 
-  BEGIN_LITERAL = '{{{'
-  END_LITERAL = '}}}'
+  preformatted_text = False
   literal_text = False
 
   line_num = 0
-  for line in f:
+  for line in lines:
     line_num += 1
 
     s = line.rstrip()
+    # (Every line that begins preformatted text also begins literal text.)
+    begins_literal = s.startswith(BEGIN_LITERAL)
 
     # First, we need to pass any preformatted (HTML <pre>) text HTML-quoted.
     # We only recognise the beginning of preformatted text ('{{{pre') at the start of the line.
-    if s.startswith(BEGIN_PREFORMAT):
+    if begins_literal and s.startswith(BEGIN_PREFORMAT):
       preformatted_text = True
       output_lines.append('<pre>')
       # For convenience, we allow preformatted text to continue on the same line as the '{{{pre'.
@@ -141,7 +150,7 @@ def read_wiki_lines_and_transform(f, state):
 
     # First, we need to pass any literal (raw HTML) text unchanged.
     # We only recognise the beginning of literal text ('{{{') at the start of the line.
-    if s.startswith(BEGIN_LITERAL):
+    if begins_literal:
       literal_text = True
       # For convenience, we allow literal text to continue on the same line as the '{{{'.
       # But if there is no text after the '{{{', don't output an empty line.
@@ -191,90 +200,119 @@ def read_wiki_lines_and_transform(f, state):
   return markup_paragraphs(output_lines)
 
 
+def iter_markup_lines(lines):
+  """Yield a pair (i, s) for each line 'lines[i]' that contains wiki markup
+  (rather than preformatted or literal text), where 's' is the line without
+  any trailing whitespace.
+  """
+  preformatted_text = False
+  literal_text = False
+
+  # This follows the recognition of preformatted and literal text in
+  # 'read_wiki_lines_and_transform'.
+  for i, line in enumerate(lines):
+    s = line.rstrip()
+
+    if s.startswith(BEGIN_PREFORMAT):
+      preformatted_text = True
+      s = s[len(BEGIN_PREFORMAT):]
+      if not s:
+        continue
+    if preformatted_text:
+      if s.find(END_PREFORMAT) != -1:
+        preformatted_text = False
+      continue
+
+    if s.startswith(BEGIN_LITERAL):
+      literal_text = True
+      s = s[len(BEGIN_LITERAL):]
+      if not s:
+        continue
+    if literal_text:
+      if s.find(END_LITERAL) != -1:
+        literal_text = False
+      continue
+
+    yield (i, s)
+
+
+def split_into_blocks(lines):
+  """Split the lines of wiki markup 'lines' into a list of blocks (lists of lines).
+
+  Each block but the last ends with an empty line that is not in preformatted
+  or literal text.  At such a line, any open lists have been closed (so the
+  list nesting in 'CURRENT_LIST_NESTING' is empty), and the paragraphs of the
+  block can't extend beyond it.  So transforming each block separately, and
+  concatenating the lines of HTML, gives the same result as transforming all
+  the lines at once (except for the line numbers in an 'InputSyntaxError').
+  """
+  blocks = []
+  block_start = 0
+  for i, s in iter_markup_lines(lines):
+    if not s:
+      blocks.append(lines[block_start:i + 1])
+      block_start = i + 1
+
+  if block_start < len(lines):
+    blocks.append(lines[block_start:])
+  return blocks
+
+
 BLOCK_OPEN_TAG_PATTERNS = re.compile(r'^<ol>|^<ul>|^<h\d>|^<pre>')
 BLOCK_CLOSE_TAG_PATTERNS = re.compile(r'</ol>$|</ul>$|</li>$|</h\d>$|</pre>$')
 
 def markup_paragraphs(lines):
-  if not lines:
-    # Nothing to do.
-    return lines
-
-  # Otherwise, we know that 'lines' is a non-empty list.
   result_lines = []
 
-  # Open paragraphs where appropriate.
-  curr = lines[0]
-  if curr and not BLOCK_OPEN_TAG_PATTERNS.search(curr):
-    curr = '<p>' + curr
-  result_lines.append(curr)
+  # Note that every block open tag begins with '<' and every block close tag
+  # ends with '>', which are much faster to check than the patterns.
+  starts_block = [(line.startswith('<') and BLOCK_OPEN_TAG_PATTERNS.search(line) is not None)
+      for line in lines]
+  ends_block = [(line.endswith('>') and BLOCK_CLOSE_TAG_PATTERNS.search(line) is not None)
+      for line in lines]
 
-  for prev, curr in pairs(lines):
+  last_i = len(lines) - 1
+  for i, curr in enumerate(lines):
     if not curr:
       # Nothing to do for empty line.
-      pass
-    elif BLOCK_OPEN_TAG_PATTERNS.search(curr):
-      # This line is already starting a list or heading, so no need to start a paragraph.
-      pass
-    elif prev:
-      # The previous line is not empty, so we don't need to wonder whether
-      # this line is the start of a block of text.
-      pass
-    else:
-      curr = '<p>' + curr
-    result_lines.append(curr)
+      result_lines.append(curr)
+      continue
 
-  lines = result_lines
-  result_lines = []
+    # Open a paragraph if this line is the start of a block of text:  if it's
+    # not already starting a list or heading, and the previous line is empty.
+    if not starts_block[i] and (i == 0 or not lines[i - 1]):
+      curr = '<p>' + curr
 
-  # Close paragraphs where appropriate.
-  for curr, next in pairs(lines):
-    if not curr:
-      # Nothing to do for empty line.
-      pass
-    elif BLOCK_CLOSE_TAG_PATTERNS.search(curr):
-      # This line is already ending a list or heading, so no need to end a paragraph.
-      pass
-    elif next and not BLOCK_OPEN_TAG_PATTERNS.search(next):
-      # The next line is neither empty nor the start of a list or heading,
-      # so we don't need to wonder whether this line is the end of a block of text.
-      pass
-    else:
+    # Close a paragraph if this line is the end of a block of text:  if it's
+    # not already ending a list or heading, and the next line is either empty
+    # or the start of a list or heading.
+    if not ends_block[i] and (i == last_i or not lines[i + 1] or starts_block[i + 1]):
       curr = curr + '</p>'
+
     result_lines.append(curr)
 
-  curr = lines[-1]
-  if curr and not BLOCK_CLOSE_TAG_PATTERNS.search(curr):
-    curr = curr + '</p>'
-  result_lines.append(curr)
-    
   return result_lines
 
 
-def pairs(s):
-  """Given an iterable sequence 's', return an iterable object of all pairs of adjacent elements.
-  
-  s -> (s0, s1), (s1, s2), (s2, s3), ...
-
-  If 's' contains fewer than two elements, an iterable object of no iterations will be returned.
-
-  Recommended by http://stackoverflow.com/questions/5434891/iterate-a-list-as-pair-current-next-in-python
-  """
-  a, b = itertools.tee(s)
-  next(b, None)
-  return itertools.izip(a, b)
-
-
 def escape_html_entities(s, line_num, output_lines, state):
   return xml_escape(s)
 
 
+SPACED_HYPHEN_REGEX = re.compile(r'(\s)-(\s)')
+NUMERIC_RANGE_HYPHEN_REGEX = re.compile(r'(\d)-(\d)')
+
 def convert_dashes(s, line_num, output_lines, state):
   # Convert double-hyphens, or single hyphens surrounded by spaces, to em-dashes.
-  s = s.replace('--', '&mdash;')
-  s = re.sub(r'(\s)-(\s)', r'\1&mdash;\2', s)
+  if '--' in s:
+    s = s.replace('--', '&mdash;')
+  # (Searching first avoids the overhead of preparing the substitution,
+  # since most hyphens are in hyphenated words.)
+  if SPACED_HYPHEN_REGEX.search(s):
+    s = SPACED_HYPHEN_REGEX.sub(r'\1&mdash;\2', s)
 
   # Convert hyphens in numeric ranges to en-dashes.
-  s = re.sub(r'(\d)-(\d)', r'\1&ndash;\2', s)
+  if NUMERIC_RANGE_HYPHEN_REGEX.search(s):
+    s = NUMERIC_RANGE_HYPHEN_REGEX.sub(r'\1&ndash;\2', s)
 
   return s
 
@@ -315,15 +353,7 @@ def process_lists(s, line_num, output_lines, state):
   for (regexp, list_type) in LIST_TYPES:
     regexp_matches = regexp.match(s)
     if regexp_matches:
-      spaces = regexp_matches.group("spaces")
-      # List depth >= 1, where 1 is the most shallow level of list.
-      list_depth = (len(spaces) / 2) + 1
-      if len(state[CURRENT_LIST_NESTING]) > list_depth:
-        # We're already in nested sub-lists, which we need to close to get back to this depth.
-        close_any_lists(output_lines, state, list_depth)
-      elif len(state[CURRENT_LIST_NESTING]) < list_depth:
-        # We need to start a list.
-        open_a_list(list_type, line_num, output_lines, state)
+      enter_a_list_item(regexp_matches, list_type, line_num, output_lines, state)
 
       # Now finally we can output the actual list item.
       length_of_match = regexp_matches.end(0)
@@ -338,61 +368,185 @@ def process_lists(s, line_num, output_lines, state):
   return s
 
 
+def enter_a_list_item(regexp_matches, list_type, line_num, output_lines, state):
+  """Open or close lists as necessary for the list item matched by 'regexp_matches'."""
+  spaces = regexp_matches.group("spaces")
+  # List depth >= 1, where 1 is the most shallow level of list.
+  list_depth = (len(spaces) / 2) + 1
+  if len(state[CURRENT_LIST_NESTING]) > list_depth:
+    # We're already in nested sub-lists, which we need to close to get back to this depth.
+    close_any_lists(output_lines, state, list_depth)
+  elif len(state[CURRENT_LIST_NESTING]) < list_depth:
+    # We need to start a list.
+    open_a_list(list_type, line_num, output_lines, state)
+
+
 def open_a_list(list_type, line_num, output_lines, state):
   state[CURRENT_LIST_NESTING].append(list_type)
   output_lines.append("<%s>" % list_type)
 
 
+# Links are resolved in two phases:  first, the targets of all the links in the
+# wiki-text are collected, and checked all at once against the sets of existing
+# cite-keys, wiki-words and attachments (see 'link_targets'); then, as each line
+# is transformed, each link is looked up in the resolved targets.
+#
+# The targets are collected from the lines after the filters that precede the
+# style markup, so almost every link will have been resolved in advance; any
+# link that wasn't (for example, a link whose text was changed by other style
+# markup) is resolved when it's made.
+CITE_LINK = 'cite'
+ATTACH_LINK = 'attach'
+WIKI_LINK = 'wiki'
+
+
+def collect_and_resolve_link_targets(lines):
+  """Return a dictionary that maps each link target in 'lines' (a pair of the
+  link type and the link text) to its resolved target.
+  """
+  cite_keys = set()
+  attachment_ids = set()
+  wiki_words = set()
+  for line in lines:
+    s = line.rstrip()
+    if '[' not in s:
+      # There are no links in this line (and the filters won't create any).
+      continue
+    for f in LINE_FILTERS_BEFORE_STYLE_MARKUP:
+      s = f(s, None, None, None)
+    cite_keys.update([m.group('text') for m in CITE_REGEX.finditer(s)])
+    attachment_ids.update([m.group('text') for m in ATTACH_REGEX.finditer(s)])
+    wiki_words.update([m.group('text') for m in WIKILINK_REGEX.finditer(s)])
+
+  resolved_targets = {}
+  existing_cite_keys = link_targets.get_cite_keys()
+  for cite_key in cite_keys:
+    resolved_targets[(CITE_LINK, cite_key)] = (cite_key in existing_cite_keys)
+
+  existing_attachment_ids = link_targets.get_attachment_ids()
+  for attachment_id in attachment_ids:
+    resolved_targets[(ATTACH_LINK, attachment_id)] = \
+        resolve_attachment(attachment_id, existing_attachment_ids)
+
+  existing_wiki_words = link_targets.get_wiki_words()
+  for wiki_word in wiki_words:
+    try:
+      resolved_targets[(WIKI_LINK, wiki_word)] = resolve_wiki_word(wiki_word, existing_wiki_words)
+    except UnicodeDecodeError:
+      # This might not actually be a link (for example, it might be in
+      # preformatted text), so we'll only complain if it is.
+      pass
+
+  return resolved_targets
+
+
+def get_link_targets(lines):
+  """Return the set of the targets of the links in the wiki markup 'lines'.
+
+  Each target is a pair of the link type ('CITE_LINK', 'ATTACH_LINK' or
+  'WIKI_LINK') and the cite-key, attachment ID or normalised wiki-word.
+
+  Unlike 'collect_and_resolve_link_targets', this ignores preformatted and
+  literal text, and doesn't mistake a citation or attachment for a wiki-link.
+  """
+  targets = set()
+  for i, s in iter_markup_lines(lines):
+    if '[' not in s:
+      continue
+    for f in LINE_FILTERS_BEFORE_STYLE_MARKUP:
+      s = f(s, None, None, None)
+
+    # As in 'process_style_markup', citations and attachments are matched
+    # before wiki-links, so remove them before looking for wiki-links.
+    for m in CITE_REGEX.finditer(s):
+      targets.add((CITE_LINK, m.group('text')))
+    s = CITE_REGEX.sub(' ', s)
+    for m in ATTACH_REGEX.finditer(s):
+      targets.add((ATTACH_LINK, m.group('text')))
+    s = ATTACH_REGEX.sub(' ', s)
+    for m in WIKILINK_REGEX.finditer(s):
+      targets.add((WIKI_LINK, normalise_string_for_wiki_word(m.group('text'))))
+
+  return targets
+
+
+def resolve_link_target(link_type, text, state, resolve_func, get_existing_func):
+  try:
+    return state[LINK_TARGETS][(link_type, text)]
+  except KeyError:
+    resolved_target = resolve_func(text, get_existing_func())
+    state[LINK_TARGETS][(link_type, text)] = resolved_target
+    return resolved_target
+
+
+def resolve_attachment(attachment_id, existing_attachment_ids):
+  """Return a pair (whether the attachment exists, its filename)."""
+  if attachment_id in existing_attachment_ids:
+    return (True, link_targets.get_attachment_fname(attachment_id))
+  return (False, None)
+
+
+def resolve_wiki_word(wiki_word, existing_wiki_words):
+  """Return a pair (the normalised wiki-word, whether it exists)."""
+  normalised_ww = normalise_string_for_wiki_word(wiki_word)
+  return (normalised_ww, (normalised_ww in existing_wiki_words))
+
+
 # This approach inspired by Tim Dawborn's "wikiprocessor.py".
-def make_bold(obj):
+def make_bold(obj, state):
   return '%s%s%s' % (BEGIN_BOLD, obj.group('text'), END_BOLD)
 
-def make_italic(obj):
+def make_italic(obj, state):
   return '%s%s%s' % (BEGIN_ITALIC, obj.group('text'), END_ITALIC)
 
-def make_monospace(obj):
+def make_monospace(obj, state):
   # FIXME:  This function really should ensure (somehow) that no other processing is performed
   # upon this text.
   return '%s%s%s' % (BEGIN_CODE, obj.group('text'), END_CODE)
 
-def make_highlight(obj):
+def make_highlight(obj, state):
   return '%s%s%s' % (BEGIN_HIGHLIGHT, obj.group('text'), END_HIGHLIGHT)
 
-def make_cite(obj):
-  def exists(ck):
-    ck_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.BIBS_SUBDIR, ck)
-    return os.path.exists(ck_dir_abspath)
+LINK_FORMAT = '<a class="%s" href="%s">%s</a>'
+
+
+def make_cite(obj, state):
+  return LINK_FORMAT % resolve_cite(obj.group('text'), state)
 
+
+def resolve_cite(cite_key, state):
+  """Return a triple (the link class, the URL, the visible text) for the citation."""
   def make_url(ck):
     return '/bib/' + ck
 
-  cite_key = obj.group('text')
-  if exists(cite_key):
+  if resolve_link_target(CITE_LINK, cite_key, state,
+      lambda ck, existing: (ck in existing), link_targets.get_cite_keys):
     link_class = "wiki-normal"
   else:
     link_class = "wiki-not-found"
 
-  return '<a class="%s" href="%s">%s</a>' % (link_class, make_url(cite_key), cite_key)
+  return (link_class, make_url(cite_key), cite_key)
+
 
+def make_attach(obj, state):
+  return LINK_FORMAT % resolve_attach(obj.group('text'), state)
 
-def make_attach(obj):
-  def exists(a):
-    a_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.ATTACHMENTS_SUBDIR, a)
-    return (os.path.exists(a_dir_abspath), a_dir_abspath)
 
+def resolve_attach(attachment, state):
+  """Return a triple (the link class, the URL, the visible text) for the attachment."""
   def make_url(a):
     return '/attachment/' + a
 
-  attachment = obj.group('text')
-  (e, a) = exists(attachment)
+  (e, fname) = resolve_link_target(ATTACH_LINK, attachment, state,
+      resolve_attachment, link_targets.get_attachment_ids)
   if e:
     link_class = "wiki-normal"
-    visible_text = attachments.get_attachment_attrs(a)[0]
+    visible_text = fname
   else:
     link_class = "wiki-not-found"
     visible_text = attachment
 
-  return '<a class="%s" href="%s">%s</a>' % (link_class, make_url(attachment), visible_text)
+  return (link_class, make_url(attachment), visible_text)
 
 
 # See http://en.wikipedia.org/wiki/Percent-encoding#Types_of_URI_characters
@@ -408,59 +562,65 @@ def normalise_string_for_wiki_word(s):
   return STRIP_PUNCTUATION_AND_WHITESPACE(unicode(s.lower().replace(' ', '-')))
 
 
-def make_wikilink(obj):
-  def normalise(ww):
-    return normalise_string_for_wiki_word(ww)
+def make_wikilink(obj, state):
+  return LINK_FORMAT % resolve_wikilink(obj.group('text'), state)
 
-  def exists(ww):
-    ww_fname_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.WIKI_SUBDIR, ww)
-    return os.path.exists(ww_fname_abspath)
 
+def resolve_wikilink(wiki_word, state):
+  """Return a triple (the link class, the URL, the visible text) for the wiki-link."""
   def make_url(ww):
     return '/wiki/' + ww
 
-  wiki_word = obj.group('text')
-  normalised_ww = normalise(wiki_word)
-  if exists(normalised_ww):
+  (normalised_ww, e) = resolve_link_target(WIKI_LINK, wiki_word, state,
+      resolve_wiki_word, link_targets.get_wiki_words)
+  if e:
     link_class = "wiki-normal"
   else:
     link_class = "wiki-not-found"
 
-  return '<a class="%s" href="%s">%s</a>' % (link_class, make_url(normalised_ww), wiki_word)
+  return (link_class, make_url(normalised_ww), wiki_word)
 
-def make_url(obj):
+def make_url(obj, state):
   url = obj.group('text')
-  return '<a class="%s" href="%s">%s</a>' % ("external", url, url)
+  return LINK_FORMAT % ("external", url, url)
 
-def make_footnote(obj):
+def make_footnote(obj, state):
   return r'\footnote{%s}' % obj.group('text').strip()
 
-def make_email(obj):
+def make_email(obj, state):
   return r'{\small {\tt %s}}' % obj.group('text').strip()
 
+CITE_REGEX = re.compile(r'\[cite:(?P<text>.+?)\]', re.I)
+ATTACH_REGEX = re.compile(r'\[attach:(?P<text>.+?)\]', re.I)
+WIKILINK_REGEX = re.compile(r'\[(?P<text>.+?)\]', re.I)
+
+# Each markup is accompanied by a substring that must occur in the line for the
+# regex to match, which is checked first (since a substring test is much faster
+# than a regex search).
 RECOGNISED_MARKUP = [
   # Match "non-greedily" between the start and end "**", using ".+?" rather than ".+".
-  (re.compile(r'\*\*(?P<text>.+?)\*\*'), make_bold),
+  (re.compile(r'\*\*(?P<text>.+?)\*\*'), make_bold, '**'),
 
   # The extra-complicated regex for italics is to avoid matching a colon (":") before the "//"
   # (which would occur in "http://", "ftp://" and "file://", for example).
-  (re.compile(r'(?<!:)//(?P<text>.+?)(?<!:)//'), make_italic),
+  (re.compile(r'(?<!:)//(?P<text>.+?)(?<!:)//'), make_italic, '//'),
 
-  (re.compile(r'\+\+\+(?P<text>.+?)\+\+\+'), make_highlight),
-  (re.compile(r'`(?P<text>[^`]+)`'), make_monospace),
+  (re.compile(r'\+\+\+(?P<text>.+?)\+\+\+'), make_highlight, '+++'),
+  (re.compile(r'`(?P<text>[^`]+)`'), make_monospace, '`'),
 
   # A minor extension of the Trac syntax, to support citations to other entries.
-  (re.compile(r'\[cite:(?P<text>.+?)\]', re.I), make_cite),
+  (CITE_REGEX, make_cite, '['),
 
   # A minor extension of the Trac syntax, to support references to attachments.
-  (re.compile(r'\[attach:(?P<text>.+?)\]', re.I), make_attach),
+  (ATTACH_REGEX, make_attach, '['),
 
   # A minor extension of the Trac syntax, to support wiki-links.
-  (re.compile(r'\[(?P<text>.+?)\]', re.I), make_wikilink),
+  (WIKILINK_REGEX, make_wikilink, '['),
 
   # Excuse the fairly arbitrary definition of which characters a URL can contain, or where
   # a URL ends...
-  (re.compile(r'(?P<text>https?://(?:[^][{}()<> ,.;:!?"]|[,;:!?](?! )|[.](?![.]))+)'), make_url),
+  (re.compile(r'(?P<text>https?://(?:[^][{}()<> ,.;:!?"]|[,;:!?](?! )|[.](?![.]))+)'), make_url,
+      '://'),
 
   # A minor extension of the Trac syntax, to support footnotes.
   #(re.compile(r'\[\[Footnote\((?P<text>.+?)\)\]\]', re.I), make_footnote),
@@ -471,8 +631,9 @@ RECOGNISED_MARKUP = [
 
 
 def process_style_markup(s, line_num, output_lines, state):
-  for (regexp, markup) in RECOGNISED_MARKUP:
-    s = regexp.sub(markup, s)
+  for (regexp, markup, required_substring) in RECOGNISED_MARKUP:
+    if required_substring in s:
+      s = regexp.sub(functools.partial(markup, state=state), s)
 
   return s
 
@@ -496,7 +657,8 @@ ABBREV_MAPPINGS = [
 
 def process_abbrevs(s, line_num, output_lines, state):
   for raw_text, styled_abbrev in ABBREV_MAPPINGS:
-    s = s.replace(raw_text, styled_abbrev)
+    if raw_text in s:
+      s = s.replace(raw_text, styled_abbrev)
 
   return s
 
@@ -523,6 +685,8 @@ def convert_multi_char_seqs(s, line_num, output_lines, state):
   return s
 
 
+OPENING_QUOTE_REGEX = re.compile('([ (])"')
+
 def convert_double_quotes(s, line_num, output_lines, state):
   """Convert double-quote characters to HTML-friendly "&ldquo;" or "&rdquo;" as appropriate."""
 
@@ -530,21 +694,27 @@ def convert_double_quotes(s, line_num, output_lines, state):
   #  1. If it's at the start of the line, or preceded by a space, or preceded by a left-paren,
   #     assume it's the beginning of a quote, and replace with "&ldquo;".
   #  2. Otherwise, assume it's a closing-quote, and replace with "&rdquo;".
-  s = re.sub('^"', '&ldquo;', s)
-  s = re.sub('([ (])"', r'\1&ldquo;', s)
-  s = re.sub(r'"', "&rdquo;", s)
+  if s.startswith('"'):
+    s = '&ldquo;' + s[1:]
+  if OPENING_QUOTE_REGEX.search(s):
+    s = OPENING_QUOTE_REGEX.sub(r'\1&ldquo;', s)
+  s = s.replace('"', "&rdquo;")
 
   return s
 
 
-LINE_FILTERS = [
+# These filters don't use the line number, output lines or state, so they
+# can also be applied when collecting the link targets.
+LINE_FILTERS_BEFORE_STYLE_MARKUP = [
   escape_html_entities,
 
   # This should be before handling of style markup, since this will
   # convert double-quotes to HTML entities (which will break the hyperlinks
   # created by the style markup.
   convert_double_quotes,
+]
 
+LINE_FILTERS = LINE_FILTERS_BEFORE_STYLE_MARKUP + [
   process_headings,
   process_lists,
   process_style_markup,
@@ -557,14 +727,372 @@ LINE_FILTERS = [
 ]
 
 def apply_line_filters(s, line_num, output_lines, state):
-  for f in LINE_FILTERS:
-    s = f(s, line_num, output_lines, state)
+  """Transform the line 's', with the same result as applying each of the
+  filters in 'LINE_FILTERS' in turn.
+
+  Most lines are transformed in a single pass (see 'transform_in_one_pass').
+  Any line whose markup might interact between the filters (which the single
+  pass can't reproduce) is instead passed through the filters in turn.
+  """
+  try:
+    return transform_in_one_pass(s, line_num, output_lines, state)
+  except (NotInOnePass, UnicodeError):
+    # (A wiki-link can't be joined to a line of non-ASCII text; let the filters
+    # in turn raise the exception, if they also can't.)
+    return apply_line_filters_in_turn(s, line_num, output_lines, state)
+
+
+def apply_line_filters_in_turn(s, line_num, output_lines, state):
+  """Apply each of the filters in 'LINE_FILTERS' in turn to the line 's'.
+
+  Rather than invoking every filter on the line, we first check (much faster
+  than a regex) whether the line contains the text that each filter could
+  change, and skip the filter if not.
+  """
+  if '&' in s or '<' in s or '>' in s:
+    s = escape_html_entities(s, line_num, output_lines, state)
+  if '"' in s:
+    s = convert_double_quotes(s, line_num, output_lines, state)
+
+  if s.startswith('='):
+    s = process_headings(s, line_num, output_lines, state)
+  elif s.startswith(' '):
+    s = process_lists(s, line_num, output_lines, state)
+
+  s = process_style_markup(s, line_num, output_lines, state)
+  s = process_abbrevs(s, line_num, output_lines, state)
+
+  # Every arrow contains '&gt;'.
+  if '...' in s or '&gt;' in s:
+    s = convert_multi_char_seqs(s, line_num, output_lines, state)
+  if '-' in s:
+    s = convert_dashes(s, line_num, output_lines, state)
 
   return s
 
 
+# The single pass finds the style markup and the text that the other filters
+# would change (the "tokens") in one left-to-right regex search over the line.
+# The filters in turn would find the same spans of markup, and make the same
+# replacements, unless the tokens overlap or the markup nests.  For example:
+#  - In "x-->", the arrow filter converts '->' before the dash filter sees '--'.
+#  - In "[see http://x.org]", the URL becomes a link within the wiki-link.
+#  - In "[cite:a--b]", the dash filter changes the URL of the citation.
+# Whenever the single pass encounters such a case, it raises 'NotInOnePass',
+# and the line is passed through the filters in turn instead.  (These cases are
+# rare in practice, but are exercised by the "fuzz" golden file, and compared
+# by 'test_transform_in_one_pass'.)
+class NotInOnePass(Exception):
+  """The line can't be transformed in a single pass."""
+  pass
+
+
+def unescape_arrow(wiki_arrow):
+  return wiki_arrow.replace('&lt;', '<').replace('&gt;', '>')
+
+# The replacement for each token of text (except the double-quotes and the
+# single hyphens, which depend upon the surrounding characters).  Each
+# abbreviation is matched without the character after it (which remains in the
+# line, to be matched by the other filters), so that character is instead
+# required to follow it.
+ONE_PASS_REPLACEMENTS = dict(
+    [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('...', '&hellip;'), ('--', '&mdash;')] +
+    [(raw_text[:-1], styled_abbrev[:-1]) for raw_text, styled_abbrev in ABBREV_MAPPINGS] +
+    [(unescape_arrow(wiki_arrow), html_arrow) for wiki_arrow, html_arrow in ARROW_MAPPINGS])
+ONE_PASS_FOLLOWING_CHARS = {}
+for raw_text, styled_abbrev in ABBREV_MAPPINGS:
+  ONE_PASS_FOLLOWING_CHARS[raw_text[:-1]] = \
+      ONE_PASS_FOLLOWING_CHARS.get(raw_text[:-1], '') + raw_text[-1]
+
+def make_token_pattern(tokens, following_chars={}):
+  """Return a regex pattern that matches the longest of 'tokens' at each position.
+
+  If a token is in 'following_chars', it only matches if followed by one of
+  those characters.  The tokens are grouped by their first character, since the
+  regex engine can skip an alternative that begins with a character other than
+  the next one.
+  """
+  tokens_by_first_char = {}
+  for token in tokens:
+    tokens_by_first_char.setdefault(token[0], []).append(token)
+  alternatives = []
+  for first_char, same_first_char in sorted(tokens_by_first_char.items()):
+    same_first_char.sort(key=len, reverse=True)
+    rests = [re.escape(token[1:]) for token in same_first_char]
+    for i, token in enumerate(same_first_char):
+      if token in following_chars:
+        rests[i] += '(?=[%s])' % re.escape(following_chars[token])
+    if rests == ['']:
+      alternatives.append(re.escape(first_char))
+    else:
+      alternatives.append('%s(?:%s)' % (re.escape(first_char), '|'.join(rests)))
+  return '|'.join(alternatives)
+
+# Each markup pattern (in the same order as 'RECOGNISED_MARKUP') has exactly
+# one group, after its first character, which identifies the markup by its
+# group number.  The italic markup omits the check for a preceding colon,
+# which is instead checked by 'replace_markup_in_one_pass'.  A URL scheme that
+# isn't followed by a URL might be followed by an escaped character (which the
+# URL markup would match), so it's also matched.
+ONE_PASS_MARKUP = [
+  ('bold', r'\*\*(.+?)\*\*'),
+  ('italic', r'//(.+?)//'),
+  ('highlight', r'\+\+\+(.+?)\+\+\+'),
+  ('monospace', r'`([^`]+)`'),
+  ('cite', r'\[[Cc][Ii][Tt][Ee]:(.+?)\]'),
+  ('attach', r'\[[Aa][Tt][Tt][Aa][Cc][Hh]:(.+?)\]'),
+  ('wikilink', r'\[(.+?)\]'),
+  ('url', r'h(ttps?://(?:[^][{}()<> ,.;:!?"]|[,;:!?](?! )|[.](?![.]))+)'),
+  ('url scheme', r'h(ttps?://)'),
+]
+ONE_PASS_MARKUP_NAMES = [None] + [name for name, pattern in ONE_PASS_MARKUP]
+
+# Most lines contain no URL and no abbreviation, and the regex search can skip
+# many more characters without those patterns.  (The URL patterns are last, so
+# the group numbers are the same without them.)  So there is a regex for each
+# combination of whether a line might contain a URL or an abbreviation.
+def make_one_pass_regex(with_urls, with_abbrevs):
+  tokens = ONE_PASS_REPLACEMENTS.keys() + ['"', '-']
+  if not with_abbrevs:
+    tokens = [token for token in tokens if token not in ONE_PASS_FOLLOWING_CHARS]
+  return re.compile('|'.join(
+      [pattern for name, pattern in ONE_PASS_MARKUP if with_urls or not name.startswith('url')] +
+      [make_token_pattern(tokens, ONE_PASS_FOLLOWING_CHARS)]))
+
+ONE_PASS_REGEXES = dict(((with_urls, with_abbrevs), make_one_pass_regex(with_urls, with_abbrevs))
+    for with_urls in (False, True) for with_abbrevs in (False, True))
+
+# The text within bold, italic, highlight or monospace markup is transformed
+# in a single pass (like the rest of the line) only if it contains no other
+# markup, nor any character that would be escaped before the markup is found.
+NESTED_MARKUP_REGEX = re.compile(r'\*\*|//|\+\+\+|`|\[|\]|[&<>"]')
+
+# The URL or text of a link is left unchanged only if it contains no text that
+# any filter would change.
+CHANGED_LINK_TEXT_REGEX = re.compile(NESTED_MARKUP_REGEX.pattern + '|' +
+    make_token_pattern([raw_text for raw_text, styled_abbrev in ABBREV_MAPPINGS] +
+        ['...', '--']) +
+    r'|\s-\s|\d-\d')
+
+# The characters that match '\s' and '\d' (without the 're.UNICODE' flag).
+WHITESPACE = string.whitespace
+DIGITS = string.digits
+
+
+def transform_in_one_pass(s, line_num, output_lines, state):
+  """Transform the line 's' in a single pass, if possible; otherwise raise 'NotInOnePass'."""
+  first_char = s[0]
+  if first_char == '=':
+    # Headings are rare enough to leave to the filters in turn.
+    raise NotInOnePass()
+
+  if first_char != ' ':
+    return transform_text_in_one_pass(s, state)
+
+  for (regexp, list_type) in LIST_TYPES:
+    regexp_matches = regexp.match(s)
+    if regexp_matches:
+      item = s[regexp_matches.end(0):].lstrip()
+      if item.startswith('"') and s[len(s) - len(item) - 1] not in ' (':
+        # The double-quote is converted according to the character before it.
+        raise NotInOnePass()
+      item = transform_text_in_one_pass(item, state)
+      enter_a_list_item(regexp_matches, list_type, line_num, output_lines, state)
+      return '<li>' + item + '</li>'
+
+  # Let the filters in turn complain about the indentation.
+  raise NotInOnePass()
+
+
+def transform_text_in_one_pass(s, state):
+  regexp = ONE_PASS_REGEXES[('://' in s,
+      ('etc.' in s or 'eg' in s or 'ie' in s or 'vs' in s or 'aka' in s))]
+  return regexp.sub(functools.partial(replace_in_one_pass, state=state), s)
+
+
+def replace_in_one_pass(obj, state):
+  if obj.lastindex is not None:
+    return replace_markup_in_one_pass(obj, state)
+
+  token = obj.group()
+  if token == '"':
+    i = obj.start()
+    if i == 0 or obj.string[i - 1] in ' (':
+      return '&ldquo;'
+    return '&rdquo;'
+
+  elif token == '-':
+    s = obj.string
+    i = obj.start()
+    if 0 < i < len(s) - 1:
+      if s[i - 1] in WHITESPACE and s[i + 1] in WHITESPACE:
+        if i >= 3 and s[i - 2] == '-' and s[i - 3] in WHITESPACE:
+          # The hyphen before might be converted instead of this one.
+          raise NotInOnePass()
+        return '&mdash;'
+      elif s[i - 1] in DIGITS and s[i + 1] in DIGITS:
+        if i >= 3 and s[i - 2] == '-' and s[i - 3] in DIGITS:
+          # The hyphen before might be converted instead of this one.
+          raise NotInOnePass()
+        return '&ndash;'
+    return token
+
+  elif token == '--' and obj.string.startswith('>', obj.end()):
+    # The arrow filter converts the '->' before the dash filter sees the '--'.
+    raise NotInOnePass()
+
+  return ONE_PASS_REPLACEMENTS[token]
+
+
+def replace_markup_in_one_pass(obj, state):
+  markup = ONE_PASS_MARKUP_NAMES[obj.lastindex]
+  text = obj.group(obj.lastindex)
+
+  if markup == 'url scheme':
+    raise NotInOnePass()
+  elif markup == 'url':
+    url = obj.group()
+    # (The italic markup could begin with the second slash after the scheme.)
+    if CHANGED_LINK_TEXT_REGEX.search(url, url.index('//') + 1) or \
+        obj.string.startswith(('<', '>', '"'), obj.end()):
+      # The URL would be changed by other filters, or extended by an escaped character.
+      raise NotInOnePass()
+    return LINK_FORMAT % ("external", url, url)
+
+  if markup in ('cite', 'attach', 'wikilink'):
+    if markup == 'cite':
+      link = resolve_cite(text, state)
+    elif markup == 'attach':
+      link = resolve_attach(text, state)
+    else:
+      link = resolve_wikilink(text, state)
+    if CHANGED_LINK_TEXT_REGEX.search(link[1]) or CHANGED_LINK_TEXT_REGEX.search(link[2]):
+      raise NotInOnePass()
+    return LINK_FORMAT % link
+
+  if NESTED_MARKUP_REGEX.search(text):
+    raise NotInOnePass()
+  if markup == 'italic':
+    # The italic markup may not follow a colon (as in "http://").
+    i = obj.start()
+    if (i > 0 and obj.string[i - 1] == ':') or text.endswith(':'):
+      raise NotInOnePass()
+    return BEGIN_ITALIC + transform_text_in_one_pass(text, state) + END_ITALIC
+  elif markup == 'bold':
+    return BEGIN_BOLD + transform_text_in_one_pass(text, state) + END_BOLD
+  elif markup == 'highlight':
+    return BEGIN_HIGHLIGHT + transform_text_in_one_pass(text, state) + END_HIGHLIGHT
+  else:
+    return BEGIN_CODE + transform_text_in_one_pass(text, state) + END_CODE
+
+
 def close_any_lists(output_lines, state, target_depth=0):
   while len(state[CURRENT_LIST_NESTING]) > target_depth:
     output_lines.append('</%s>' % state[CURRENT_LIST_NESTING][-1])
     state[CURRENT_LIST_NESTING].pop()
 
+
+# Each file "NAME.wiki" in this directory (relative to this module) is a test
+# input, and the file "NAME.html" is the expected output.
+GOLDEN_FILES_DIR = "wiki_markup_golden"
+
+
+class GoldenLinkTargets(dict):
+  """Resolved link targets for the golden-file tests, which don't depend on
+  the contents of the doclib:  a link target exists if it begins with "known".
+  """
+
+  def __missing__(self, (link_type, text)):
+    if link_type == CITE_LINK:
+      resolved_target = text.startswith("known")
+    elif link_type == ATTACH_LINK:
+      resolved_target = (text.startswith("known"), text + ".pdf")
+    else:
+      normalised_ww = normalise_string_for_wiki_word(text)
+      resolved_target = (normalised_ww, normalised_ww.startswith("known"))
+    self[(link_type, text)] = resolved_target
+    return resolved_target
+
+
+def transform_golden_file(wiki_fname_abspath, in_blocks=False):
+  lines = open(wiki_fname_abspath).read().split('\n')
+  if in_blocks:
+    html_lines = []
+    for block in split_into_blocks(lines):
+      html_lines.extend(read_wiki_lines_and_transform(block, {LINK_TARGETS: GoldenLinkTargets()}))
+  else:
+    html_lines = read_wiki_lines_and_transform(lines, {LINK_TARGETS: GoldenLinkTargets()})
+  # Some lines may be Unicode strings (for example, if they contain a wiki-link).
+  return ''.join([encode_if_unicode(line) + '\n' for line in html_lines])
+
+
+def encode_if_unicode(s):
+  if isinstance(s, unicode):
+    return s.encode("utf8")
+  return s
+
+
+def test_golden_files(in_blocks=False):
+  def transform_and_compare(wiki_fname_abspath):
+    html_fname_abspath = wiki_fname_abspath[:-len(".wiki")] + ".html"
+    # Return just the filename, rather than the entire HTML, if it matches.
+    if transform_golden_file(wiki_fname_abspath, in_blocks) == open(html_fname_abspath).read():
+      return os.path.basename(wiki_fname_abspath)
+    return None
+
+  golden_files_dir_abspath = os.path.join(os.path.dirname(os.path.abspath(__file__)), GOLDEN_FILES_DIR)
+  tests = [(os.path.join(golden_files_dir_abspath, fname), fname)
+      for fname in sorted(os.listdir(golden_files_dir_abspath)) if fname.endswith(".wiki")]
+  if in_blocks:
+    test_framework.test_and_compare(tests, transform_and_compare, "Golden file (in blocks)")
+  else:
+    test_framework.test_and_compare(tests, transform_and_compare, "Golden file")
+
+
+def test_split_into_blocks():
+  test_golden_files(in_blocks=True)
+
+
+# Fragments of markup (and of text that the filters change) from which to
+# generate random lines for 'test_transform_in_one_pass'.
+ONE_PASS_TEST_FRAGMENTS = [
+  '**', '//', '+++', '`', '[', ']', '[cite:', '[CITE:', '[attach:', 'http://', 'https://', ':',
+  '<', '>', '&', '"', '(', ')', '=', '-', '--', '<-', '->', '=>', '>>', '<=', '.', '...', ',',
+  ' ', ' ', ' ', '  ', '\t', 'etc', 'eg', 'ie', 'vs', 'aka', 'a', 'e', 'h', 'i', 'v', 'x',
+  '1', '2', 'known', 'Known', 'word', 'caf\xc3\xa9', '**x**', '//a b//', '+++y+++', '`c-d`',
+  '[Known Page]', '[unknown  x]', '[cite:known-1999]', '[attach:known1]', 'http://x.org/a-b',
+  ' - ', '1-2', '2009-10-11', '(\"', ' \"',
+]
+
+
+def test_transform_in_one_pass(num_lines=20000):
+  def transform(line_filters_func, s):
+    state = {CURRENT_LIST_NESTING: [ITEMIZE], LINK_TARGETS: GoldenLinkTargets()}
+    output_lines = []
+    try:
+      s = line_filters_func(s, 1, output_lines, state)
+    except Exception as e:
+      s = repr(e)
+    return (s, output_lines, state[CURRENT_LIST_NESTING])
+
+  r = random.Random(0)
+  tests = []
+  for i in xrange(num_lines):
+    s = ''.join([r.choice(ONE_PASS_TEST_FRAGMENTS) for j in xrange(r.randint(1, 12))])
+    if r.random() < 0.2:
+      s = r.choice([' * ', '   * ', ' 1. ', '== ', ' ', '"']) + s
+    s = s.rstrip()
+    if s:
+      tests.append((s, transform(apply_line_filters_in_turn, s)))
+  test_framework.test_and_compare(tests, functools.partial(transform, apply_line_filters),
+      "Transform in one pass")
+
+
+def main():
+  test_golden_files()
+  test_split_into_blocks()
+  test_transform_in_one_pass()
+
+
+if __name__ == "__main__":
+  main()
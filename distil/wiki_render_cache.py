@@ -0,0 +1,228 @@
+# wiki_render_cache.py: A two-tier cache of wiki-text rendered as HTML.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import hashlib
+import marshal
+import os
+import sqlite3
+
+import config
+import constants
+import filesystem_utils
+import parsed_entries_cache
+import wiki_markup
+
+
+# Every time a wiki page or the notes of a bib-entry are displayed, the wiki
+# markup is transformed into HTML by 'wiki_markup.read_wiki_lines_and_transform',
+# which applies a series of regex-heavy filters to every line, and checks
+# whether the target of every link exists.
+#
+# Instead, the HTML is cached, keyed by the hash of the wiki-text and the
+# "link-target generation":  the mtimes of the bibs, wiki and attachments
+# subdirs, which change whenever a cite-key, wiki-word or attachment (the
+# possible targets of links) is created or removed.  So whenever a link target
+# appears or disappears, every page is rendered afresh (and the HTML of the
+# previous generation is discarded), but otherwise an unchanged page is
+# served from the cache.
+#
+# Like 'parsed_entries_cache', the cache has two tiers:  an in-process LRU
+# cache, and an SQLite database in the cache subdir of the doclib (which is
+# shared by all the webserver processes).  Wiki-text that contains syntax
+# errors is not cached.
+#
+# When the user previews an edit, the wiki-text is (by definition) new, so the
+# page is not in the cache.  But most of the page is unchanged, so the wiki-text
+# is also split into blocks (see 'wiki_markup.split_into_blocks'), and the HTML
+# of each block is kept in a third, in-process LRU cache, keyed by the hash of
+# the block.  Only the blocks that have changed since the last preview (or
+# display) of the page are transformed, so the cost of a preview is in
+# proportion to the size of the edit, rather than the size of the page.
+
+
+# Increment this whenever the wiki markup output (or the table definition)
+# changes; a database with any other version will be discarded and re-created.
+SCHEMA_VERSION = 1
+
+RENDERED_WIKI_FNAME = "rendered-wiki.sqlite"
+
+# The maximum total size (in bytes) of the marshalled HTML in the LRU cache.
+MAX_MEMORY_CACHE_SIZE = 4 * 1024 * 1024
+
+# The maximum total size (in bytes) of the HTML in the LRU cache of blocks.
+MAX_BLOCK_CACHE_SIZE = 4 * 1024 * 1024
+
+CREATE_RENDERED_TABLE = """CREATE TABLE IF NOT EXISTS rendered (
+    key TEXT PRIMARY KEY,
+    generation TEXT,
+    marshalled_html_lines BLOB)"""
+
+
+### These are the public functions of the exported API.
+
+
+def read_wiki_lines_and_transform(wiki_markup_lines):
+  """Return the lines of HTML for the lines of wiki markup 'wiki_markup_lines',
+  exactly as 'wiki_markup.read_wiki_lines_and_transform' would.
+
+  If the wiki markup contains a syntax error, 'wiki_markup.InputSyntaxError'
+  will be raised.
+  """
+  generation = get_link_target_generation()
+  key = get_cache_key(wiki_markup_lines)
+
+  memory_key = (key, generation)
+  marshalled = _MEMORY_CACHE.get(memory_key)
+  if marshalled is not None:
+    STATS["memory-hits"] += 1
+    return marshal.loads(marshalled)
+
+  conn = open_rendered_wiki_db()
+  try:
+    row = conn.execute("SELECT marshalled_html_lines FROM rendered WHERE key = ? AND generation = ?",
+        (key, generation)).fetchone()
+    if row is not None:
+      STATS["disk-hits"] += 1
+      marshalled = str(row[0])
+    else:
+      STATS["misses"] += 1
+      html_lines = transform_blocks(wiki_markup_lines, generation)
+      marshalled = marshal.dumps(html_lines)
+
+      # Discard the HTML of any previous generation, since its links may be stale.
+      conn.execute("DELETE FROM rendered WHERE generation != ?", (generation,))
+      conn.execute("INSERT OR REPLACE INTO rendered VALUES (?, ?, ?)",
+          (key, generation, sqlite3.Binary(marshalled)))
+      conn.commit()
+  finally:
+    conn.close()
+
+  _MEMORY_CACHE.put(memory_key, marshalled, len(marshalled))
+  return marshal.loads(marshalled)
+
+
+def get_stats():
+  """Return a dictionary of the hit and miss counters of this process.
+
+  The keys are "memory-hits", "disk-hits" and "misses" (for pages), and
+  "block-hits" and "block-misses" (for the blocks of the pages that missed).
+  """
+  return dict(STATS)
+
+
+### Anything below this point is not part of the exported API.
+
+
+_MEMORY_CACHE = parsed_entries_cache.LRUCache(MAX_MEMORY_CACHE_SIZE)
+_BLOCK_CACHE = parsed_entries_cache.LRUCache(MAX_BLOCK_CACHE_SIZE)
+
+STATS = {
+  "memory-hits": 0,
+  "disk-hits": 0,
+  "misses": 0,
+  "block-hits": 0,
+  "block-misses": 0,
+}
+
+LINK_TARGET_SUBDIRS = [
+  constants.BIBS_SUBDIR,
+  constants.WIKI_SUBDIR,
+  constants.ATTACHMENTS_SUBDIR,
+]
+
+
+def get_link_target_generation():
+  mtimes = []
+  for subdir in LINK_TARGET_SUBDIRS:
+    try:
+      mtimes.append(repr(os.stat(os.path.join(config.DOCLIB_BASE_ABSPATH, subdir)).st_mtime))
+    except OSError:
+      mtimes.append("-")
+  return " ".join(mtimes)
+
+
+def get_cache_key(wiki_markup_lines):
+  # The lines may be regular (UTF-8-encoded) strings (read from a file), or
+  # Unicode strings (submitted in a form), which produce HTML lines of the same
+  # type, so the type is part of the key.
+  h = hashlib.sha1()
+  for line in wiki_markup_lines:
+    if isinstance(line, unicode):
+      h.update("u")
+      h.update(line.encode("utf8"))
+    else:
+      h.update("s")
+      h.update(line)
+    h.update("\n")
+  return h.hexdigest()
+
+
+def transform_blocks(wiki_markup_lines, generation):
+  """Transform the lines of wiki markup block by block, using the cached HTML
+  of any block that has been transformed before (in this link-target generation).
+  """
+  blocks = wiki_markup.split_into_blocks(wiki_markup_lines)
+  block_keys = [(get_cache_key(block), generation) for block in blocks]
+
+  # Collect and resolve the link targets of all the changed blocks at once.
+  changed_lines = []
+  for block, block_key in zip(blocks, block_keys):
+    if _BLOCK_CACHE.get(block_key) is None:
+      changed_lines.extend(block)
+  resolved_link_targets = wiki_markup.collect_and_resolve_link_targets(changed_lines)
+
+  html_lines = []
+  try:
+    for block, block_key in zip(blocks, block_keys):
+      block_html_lines = _BLOCK_CACHE.get(block_key)
+      if block_html_lines is not None:
+        STATS["block-hits"] += 1
+      else:
+        STATS["block-misses"] += 1
+        block_html_lines = tuple(wiki_markup.read_wiki_lines_and_transform(block,
+            {wiki_markup.LINK_TARGETS: resolved_link_targets}))
+        _BLOCK_CACHE.put(block_key, block_html_lines, sum([len(line) for line in block_html_lines]))
+      html_lines.extend(block_html_lines)
+  except wiki_markup.InputSyntaxError:
+    # Transform all the lines at once, so the error has the right line number.
+    return wiki_markup.read_wiki_lines_and_transform(wiki_markup_lines, {})
+
+  return html_lines
+
+
+def open_rendered_wiki_db():
+  """Open (creating if necessary) the rendered-wiki database, and return a connection."""
+  cache_dir_abspath = os.path.join(config.DOCLIB_BASE_ABSPATH, constants.CACHE_SUBDIR)
+  filesystem_utils.ensure_cache_dir_exists(cache_dir_abspath)
+  db_fname_abspath = os.path.join(cache_dir_abspath, RENDERED_WIKI_FNAME)
+
+  # Several Distil processes may access the database simultaneously,
+  # so wait for locks rather than fail.
+  conn = sqlite3.connect(db_fname_abspath, timeout=30)
+  conn.text_factory = str
+
+  schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+  if schema_version != SCHEMA_VERSION:
+    conn.execute("DROP TABLE IF EXISTS rendered")
+    conn.execute(CREATE_RENDERED_TABLE)
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    conn.commit()
+
+  return conn
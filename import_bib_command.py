@@ -58,7 +58,19 @@ MISSING_FILENAME = """%s: missing BibTeX filename
 Try `%s --help' for more information."""
 
 USAGE = """Usage: %s BIB [DOC [ABSTRACT]]
-Import BibTeX file BIB, plus document DOC and abstract ABS file if specified."""
+  or:  %s --bulk [--processes=N] BIB
+Import BibTeX file BIB, plus document DOC and abstract ABS file if specified.
+
+With --bulk, import every entry in BibTeX file BIB (which may contain many
+entries), using N worker processes (default: one per CPU), in a single commit.
+Entries whose cite-keys are already in the doclib will be skipped."""
+
+BULK_MISSING_FILENAME = """%s: --bulk requires exactly one BibTeX filename
+Try `%s --help' for more information."""
+
+BULK_SKIPPED_ENTRY = """%s: skipped entry %d in '%s': %s"""
+
+BULK_SUMMARY = """Imported %d entries from '%s' (skipped %d)."""
 
 ARG_ERROR = """%s: error: supplied file '%s' as a %s argument.
 Try `%s --help' for more information."""
@@ -78,15 +90,39 @@ def main():
 
   if sys.argv[1] == "--help":
     # Request for usage information.
-    print USAGE % PROGNAME
+    print USAGE % (PROGNAME, PROGNAME)
     sys.exit(0)
 
+  if sys.argv[1] == "--bulk":
+    bulk_import(sys.argv[2:])
+    return
+
   args = parse_commandline_args(sys.argv[1:])
   if SANITY_CHECK_SUFFIXES:
     sanity_check_suffixes(args)
   stored_bibs.store_new_bib(args[BIB_FNAME], args[DOC_FNAME], args[ABS_FNAME])
 
 
+def bulk_import(commandline_args):
+  num_processes = None
+  if commandline_args and commandline_args[0].startswith("--processes="):
+    num_processes = int(commandline_args[0][len("--processes="):])
+    commandline_args = commandline_args[1:]
+
+  if len(commandline_args) != 1:
+    print >> sys.stderr, BULK_MISSING_FILENAME % (PROGNAME, PROGNAME)
+    sys.exit(1)
+
+  bib_fname = commandline_args[0]
+  if SANITY_CHECK_SUFFIXES:
+    sanity_check_suffixes({BIB_FNAME: bib_fname})
+
+  (cite_keys, skipped) = stored_bibs.store_new_bibs_in_bulk(bib_fname, num_processes)
+  for entry_num, reason in skipped:
+    print >> sys.stderr, BULK_SKIPPED_ENTRY % (PROGNAME, entry_num, bib_fname, reason)
+  print BULK_SUMMARY % (len(cite_keys), bib_fname, len(skipped))
+
+
 def sanity_check_suffixes(args):
   # Initialisation of data-structures that will be used for all sanity checks.
   all_suffixes = set(itertools.chain(*EXPECTED_SUFFIXES.values()))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# regenerate_command.py: Regenerate derived data (indices, catalogs) in the doclib.
+#
+# Copyright 2011 James Boyden <jboy@jboy.id.au>
+#
+# This file is part of Distil.
+#
+# Distil is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# Distil is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License,
+# version 3, for more details.
+#
+# You should have received a copy of the GNU General Public License,
+# version 3, along with this program; if not, see
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+
+import sys
+
+from distil import backlinks, catalog, search_index, stored_bibs, topic_tag_file_io
+
+
+# Messages to the user.
+
+MISSING_WHAT = """%s: missing name of what to regenerate
+Try `%s --help' for more information."""
+
+USAGE = """Usage: %s WHAT...
+Regenerate each WHAT from the contents of the doclib, where WHAT is one of:
+  backlinks        the index of the links in the notes and wiki pages
+  catalog          the cache of bib-entry and attachment metadata
+  metadata         the metadata file in each cite-key dir (commit the changes
+                   manually afterwards)
+  search-index     the keyword search index of the stored bib-entries
+  topic-tag-index  the topic-tag index (commit the changes manually afterwards)"""
+
+BAD_WHAT = """%s: unknown thing to regenerate: '%s'
+Try `%s --help' for more information."""
+
+
+def regenerate_backlinks():
+  (num_referrers, num_links) = backlinks.regenerate_backlinks()
+  print "Indexed %d links in the notes and wiki pages of %d cite-keys and wiki-words." % \
+      (num_links, num_referrers)
+
+
+def regenerate_catalog():
+  (num_cite_keys, num_attachments) = catalog.regenerate_catalog()
+  print "Catalogued %d cite-keys and %d attachments." % (num_cite_keys, num_attachments)
+
+
+def regenerate_metadata():
+  (num_cite_keys, num_written) = stored_bibs.regenerate_metadata()
+  print "Wrote the metadata files of %d of %d cite-keys." % (num_written, num_cite_keys)
+
+
+def regenerate_search_index():
+  num_cite_keys = search_index.regenerate_search_index()
+  print "Indexed %d cite-keys for searching." % num_cite_keys
+
+
+def regenerate_topic_tag_index():
+  (num_topic_tags, num_changed) = topic_tag_file_io.regenerate_topic_tag_index()
+  print "Regenerated the topic-tag index of %d topic tags (%d index files changed)." % \
+      (num_topic_tags, num_changed)
+
+
+# When there are new things to regenerate, simply insert the (name, function) to this list.
+REGENERATE_FUNCTIONS = [
+  ("backlinks",       regenerate_backlinks),
+  ("catalog",         regenerate_catalog),
+  ("metadata",        regenerate_metadata),
+  ("search-index",    regenerate_search_index),
+  ("topic-tag-index", regenerate_topic_tag_index),
+]
+
+
+def main():
+  global PROGNAME
+
+  PROGNAME = sys.argv[0]
+  if len(sys.argv) == 1:
+    # Missing any command-line args.
+    print >> sys.stderr, MISSING_WHAT % (PROGNAME, PROGNAME)
+    sys.exit(1)
+
+  if sys.argv[1] == "--help":
+    # Request for usage information.
+    print USAGE % PROGNAME
+    sys.exit(0)
+
+  regenerate_functions = dict(REGENERATE_FUNCTIONS)
+  for what in sys.argv[1:]:
+    if what not in regenerate_functions:
+      print >> sys.stderr, BAD_WHAT % (PROGNAME, what, PROGNAME)
+      sys.exit(1)
+
+  for what in sys.argv[1:]:
+    regenerate_functions[what]()
+
+
+if __name__ == "__main__":
+  main()
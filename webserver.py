@@ -19,8 +19,11 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 
+import multiprocessing
+import signal
 import sys
 import os
+import time
 
 import tornado.autoreload
 
@@ -28,11 +31,16 @@ from tornado import options
 from tornado.ioloop import IOLoop
 from tornado.httpserver import HTTPServer
 
-from distil import config, constants, web_request_handlers, web_ui_modules
+from distil import config, constants, repository, repository_executor, web_request_handlers, web_ui_modules
 
 
 # Define the command-line options.
 options.define("port", default=8888, help="Specify the port on which to listen.", type=int)
+options.define("processes", default=1, type=int,
+    help="Specify the number of server processes to fork (0 means one per CPU).  "
+        "Multiple processes require --production.")
+options.define("production", default=False, type=bool,
+    help="Disable debug mode and automatic reloading.")
 
 
 HANDLERS = [
@@ -46,6 +54,7 @@ HANDLERS = [
   (r"/attachment/([a-zA-Z0-9]+)",   web_request_handlers.AttachmentXHandler),
   (r"/cite-keys",                   web_request_handlers.CiteKeysHandler),
   (r"/bib/([a-z0-9-]+)",            web_request_handlers.BibXHandler),
+  (r"/search",                      web_request_handlers.SearchHandler),
   (r"/tag/([a-z0-9-_+.:]+)",        web_request_handlers.TagXHandler),
   (r"/wiki-words",                  web_request_handlers.WikiWordsHandler),
   (r"/wiki-create",                 web_request_handlers.WikiCreateHandler),
@@ -67,30 +76,101 @@ SETTINGS = dict(
   template_path=os.path.join(os.path.dirname(__file__), "templates"),
   ui_modules=web_ui_modules,
   xsrf_cookies=True,
-  debug=True
 )
 
-APPLICATION = tornado.web.Application(HANDLERS, **SETTINGS)
-
 
 def main():
   options.parse_command_line()
+  production = options.options.production
+  num_processes = options.options.processes
+  if num_processes <= 0:
+    num_processes = multiprocessing.cpu_count()
+  if num_processes > 1 and not production:
+    # "Multiple processes are not compatible with the autoreload module
+    # (or the debug=True option to tornado.web.Application)":
+    # https://github.com/facebook/tornado/blob/master/tornado/httpserver.py
+    print >> sys.stderr, "Error: --processes=%d requires --production.\nAborting." % num_processes
+    sys.exit(1)
+
   ensure_symlink_to_doclib()
 
-  http_server = HTTPServer(APPLICATION)
+  # In debug mode (the default), the Application starts the autoreload module,
+  # and re-compiles the templates on every request.
+  application = tornado.web.Application(HANDLERS, debug=(not production), **SETTINGS)
+  http_server = HTTPServer(application)
 
   # "By default, listen() runs in a single thread in a single process.
   # You can utilize all available CPUs on this machine by calling bind()
   # and start() instead of listen()":
   # https://github.com/facebook/tornado/blob/master/tornado/httpserver.py
+  #
+  # The server processes share no memory, but every in-process cache (the
+  # search index, the parsed bib-file entries) is checked against the mtimes
+  # of the files (or directories) it was derived from, and is shared between
+  # the processes through the files in the cache subdir of the doclib.
+  # Changes to the doclib are serialised between the processes by the doclib
+  # lock (see 'repository.lock_doclib').
 
   print "Listening on port", options.options.port
-  http_server.listen(options.options.port)
-  print "Service available at http://localhost:8888/"
+  http_server.bind(options.options.port)
+  parent_pid = os.getpid()
+  # No IOLoop may be created (and no threads started) before this point.
+  http_server.start(num_processes)
+  if os.getpid() == parent_pid and num_processes > 1:
+    # In the parent process, 'start' only returns when one of the forked server
+    # processes has exited.
+    print >> sys.stderr, "Error: a server process exited unexpectedly.\nAborting."
+    # Terminate the other server processes (which are in the same process
+    # group as this process), so they don't remain bound to the port.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(0, signal.SIGTERM)
+    sys.exit(1)
+  print "Service available at http://localhost:%d/" % options.options.port
 
   io_loop = IOLoop.instance()
-  # Automatically restart the server when a module is modified.
-  tornado.autoreload.start(io_loop)
+  # Change the doclib (and flush the repository commit queue) on the repository
+  # executor thread, so the IOLoop can handle other requests in the meantime.
+  repository_executor.start(io_loop.add_callback)
+  def schedule_flush(delay, callback):
+    # This is invoked on the repository executor thread, so the timeout must
+    # be added (and removed) on the IOLoop thread, using 'add_callback' (the
+    # only IOLoop method that may be invoked from another thread).  The handle
+    # of the timeout is stored in a list, once the timeout has been added.
+    timeout = []
+    def add_timeout():
+      timeout.append(io_loop.add_timeout(time.time() + delay,
+          lambda: repository_executor.submit(callback, ())))
+    def remove_timeout():
+      if timeout:
+        io_loop.remove_timeout(timeout[0])
+    io_loop.add_callback(add_timeout)
+    return lambda: io_loop.add_callback(remove_timeout)
+  repository.set_flush_scheduler(schedule_flush)
+
+  # The commit queue is flushed at exit (using 'atexit'), but the 'atexit'
+  # functions are not invoked when a server process is terminated by SIGTERM
+  # (as by the parent process above), nor when the autoreload module replaces
+  # the process using 'os.execv'.  In either case, flush the commit queue first,
+  # and then keep holding the doclib lock, so the repository executor thread
+  # can't start another operation before the process is terminated or replaced.
+  # (The doclib lock is not inherited across 'os.execv'.)
+  def flush_and_terminate(signum, frame):
+    repository.lock_doclib()
+    repository.close()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+  signal.signal(signal.SIGTERM, flush_and_terminate)
+  if not production:
+    # Tornado 2.0 has no 'autoreload.add_reload_hook' (that's new in 2.1), so
+    # wrap the 'os.execv' that the autoreload module invokes instead.
+    execv = os.execv
+    def flush_and_execv(path, args):
+      repository.lock_doclib()
+      repository.close()
+      execv(path, args)
+    os.execv = flush_and_execv
+    # Automatically restart the server when a module is modified.
+    tornado.autoreload.start(io_loop)
   io_loop.start()
 
 